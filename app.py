@@ -1,16 +1,53 @@
-import os
+import hashlib
 import io
-import re
+import math
+import os
+import threading
 import time
-import random
+from concurrent.futures import Future
+from dataclasses import replace
 from typing import Dict, Any, Optional
 
 import streamlit as st
-from PIL import Image
-
-import google.generativeai as genai
-from google.api_core.exceptions import ResourceExhausted, GoogleAPIError
-import docx
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from magi import (
+    DELIBERATION_ENGINES,
+    EMPTY_CONTEXT,
+    IMAGE_FORMATS,
+    MODEL_CHOICES,
+    REPORT_FORMATS,
+    DOCUMENT_MIME_TYPES,
+    BackendUnavailable,
+    PreparedImage,
+    RoundPolicy,
+    RoutePlan,
+    analyze_media,
+    available_report_formats,
+    combine_document,
+    condense_text,
+    configure_api,
+    enqueue_deliberation,
+    estimate_deliberation,
+    get_history_store,
+    get_job_queue,
+    get_metrics,
+    get_rate_limiter,
+    get_round_policy,
+    get_semantic_recall,
+    ingest_document,
+    needs_condensing,
+    parse_magi_output,
+    prepare_image,
+    register_context_propagator,
+    route_by_size,
+    set_notifier,
+    stage,
+    start_media_analysis,
+    submit_report,
+    transcribe_audio_chunked,
+    write_reports_zip,
+)
 
 # ======================================================
 # ページ設定
@@ -22,227 +59,74 @@ st.set_page_config(
 )
 
 # ======================================================
-# MAGI風 モダンUI CSS (FUIデザイン)
+# MAGI風 モダンUI CSS (FUIデザイン) とヘッダー
 # ======================================================
-st.markdown(
-    """
-    <style>
-    @import url('https://fonts.googleapis.com/css2?family=Orbitron:wght@400;500;700;900&family=Share+Tech+Mono&display=swap');
-
-    /* 全体設定 */
-    .stApp {
-        background-color: #050505;
-        background-image: 
-            linear-gradient(rgba(0, 20, 40, 0.9), rgba(5, 5, 10, 0.95)),
-            url("data:image/svg+xml,%3Csvg width='60' height='60' viewBox='0 0 60 60' xmlns='http://www.w3.org/2000/svg'%3E%3Cg fill='none' fill-rule='evenodd'%3E%3Cg fill='%231a2639' fill-opacity='0.4'%3E%3Cpath d='M36 34v-4h-2v4h-4v2h4v4h2v-4h4v-2h-4zm0-30V0h-2v4h-4v2h4v4h2V6h4V4h-4zM6 34v-4H4v4H0v2h4v4h2v-4h4v-2H6zM6 4V0H4v4H0v2h4v4h2V6h4V4H6z'/%3E%3C/g%3E%3C/g%3E%3C/svg%3E");
-        color: #d0f0ff;
-        font-family: 'Share Tech Mono', monospace;
-    }
+MAGI_HEADER = """
+<div class="magi-header">
+    <div>
+        <div class="magi-title">MAGI SYSTEM</div>
+        <div class="magi-subtitle">SUPER COMPUTER SYSTEM 3.0</div>
+    </div>
+    <div class="magi-sys-status">
+        CODE: 771<br>
+        PRIORITY: AAA<br>
+        STATUS: <span style="color:#00ff00; animation: blink 1s infinite;">ONLINE</span>
+    </div>
+</div>
+"""
 
-    /* ヘッダー */
-    .magi-header {
-        border-bottom: 2px solid #ff4d00;
-        padding: 20px 0;
-        margin-bottom: 30px;
-        display: flex;
-        justify-content: space-between;
-        align-items: flex-end;
-        background: linear-gradient(90deg, rgba(255,77,0,0.1) 0%, rgba(0,0,0,0) 80%);
-    }
-    .magi-title {
-        font-family: 'Orbitron', sans-serif;
-        font-size: 42px;
-        font-weight: 900;
-        color: #ff4d00;
-        letter-spacing: 0.15em;
-        text-shadow: 0 0 10px rgba(255, 77, 0, 0.6);
-        line-height: 1;
-    }
-    .magi-subtitle {
-        font-size: 14px;
-        color: #ff8c00;
-        letter-spacing: 0.3em;
-        margin-top: 5px;
-    }
-    .magi-sys-status {
-        text-align: right;
-        font-size: 12px;
-        color: #00ffcc;
-    }
 
-    /* カードデザイン共通 */
-    .magi-card {
-        background: rgba(10, 15, 20, 0.85);
-        border: 1px solid #334455;
-        border-radius: 4px;
-        padding: 15px;
-        margin-bottom: 15px;
-        box-shadow: 0 0 15px rgba(0, 0, 0, 0.8);
-        position: relative;
-        overflow: hidden;
-        transition: all 0.3s ease;
-    }
-    .magi-card::before {
-        content: "";
-        position: absolute;
-        top: 0; left: 0; width: 100%; height: 2px;
-        background: linear-gradient(90deg, transparent, rgba(255,255,255,0.5), transparent);
-        opacity: 0.3;
-    }
+@st.cache_resource
+def load_chrome() -> str:
+    """CSS (static/magi.css) とヘッダーの HTML。ファイルの読み込みはプロセスで1度だけ"""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "magi.css"), encoding="utf-8") as f:
+        return f"<style>\n{f.read()}</style>\n{MAGI_HEADER}"
 
-    /* 各エージェントの色分け */
-    .agent-logic {
-        border-color: #00ccff;
-        box-shadow: 0 0 10px rgba(0, 204, 255, 0.15);
-    }
-    .agent-logic h4 { color: #00ccff; text-shadow: 0 0 5px rgba(0,204,255,0.5); }
-    
-    .agent-human {
-        border-color: #ff9900;
-        box-shadow: 0 0 10px rgba(255, 153, 0, 0.15);
-    }
-    .agent-human h4 { color: #ff9900; text-shadow: 0 0 5px rgba(255,153,0,0.5); }
 
-    .agent-reality {
-        border-color: #ff3366;
-        box-shadow: 0 0 10px rgba(255, 51, 102, 0.15);
-    }
-    .agent-reality h4 { color: #ff3366; text-shadow: 0 0 5px rgba(255,51,102,0.5); }
-
-    .agent-media { border-color: #aa00ff; }
-    .agent-media h4 { color: #d066ff; }
-    
-    .agent-title {
-        font-family: 'Orbitron', sans-serif;
-        font-size: 18px;
-        letter-spacing: 0.1em;
-        margin-bottom: 10px;
-        border-bottom: 1px solid rgba(255,255,255,0.1);
-        padding-bottom: 5px;
-        display: flex;
-        justify-content: space-between;
-    }
+st.markdown(load_chrome(), unsafe_allow_html=True)
 
-    /* 判定表示 */
-    .decision-box {
-        font-family: 'Orbitron', sans-serif;
-        font-weight: 700;
-        font-size: 24px;
-        text-align: center;
-        padding: 8px 0;
-        margin: 10px 0;
-        border: 1px solid;
-        letter-spacing: 0.2em;
-    }
-    .decision-go { color: #00ff66; border-color: #00ff66; background: rgba(0,255,102,0.1); }
-    .decision-nogo { color: #ff0033; border-color: #ff0033; background: rgba(255,0,51,0.1); }
-    .decision-hold { color: #ffcc00; border-color: #ffcc00; background: rgba(255,204,0,0.1); }
-
-    /* 統合結果 */
-    .magi-aggregator {
-        background: linear-gradient(180deg, rgba(20,30,50,0.9) 0%, rgba(5,10,20,0.95) 100%);
-        border: 1px solid #4d5cff;
-        border-left: 5px solid #4d5cff;
-        padding: 20px;
-        margin-top: 20px;
-    }
-    .section-label {
-        font-family: 'Orbitron', sans-serif;
-        font-size: 14px;
-        color: #6677aa;
-        letter-spacing: 0.2em;
-        margin-bottom: 10px;
-        display: block;
-    }
+# ======================================================
+# Gemini API 設定
+# ======================================================
+@st.cache_resource
+def configure_gemini(api_key: Optional[str]) -> bool:
+    """API キーの設定はキーごとに1度だけ (再実行・新しいセッションでは設定済みのクライアントを使う)"""
+    return configure_api(api_key)
+
+
+try:
+    api_key = st.secrets.get("GEMINI_API_KEY", os.getenv("GEMINI_API_KEY"))
+except FileNotFoundError:
+    # secrets.toml がない場合は環境変数だけを見る
+    api_key = os.getenv("GEMINI_API_KEY")
+
+# API キーがない場合はローカルモデルのみで動作する (オフラインモード)
+offline_mode = not configure_gemini(api_key)
+if offline_mode:
+    st.warning("⚠️ API KEY NOT FOUND. RUNNING IN OFFLINE MODE (LOCAL CORE ONLY).")
+    st.info("Set GEMINI_API_KEY in Streamlit secrets or environment variables.")
 
-    /* 入力エリア */
-    .stTextArea textarea {
-        background-color: rgba(0,0,0,0.3) !important;
-        border: 1px solid #334455 !important;
-        color: #00ffcc !important;
-        font-family: 'Noto Sans JP', sans-serif;
-    }
-    
-    /* ボタン */
-    .stButton button {
-        background: linear-gradient(45deg, #1a2a4a, #0d1a2f);
-        border: 1px solid #00ccff;
-        color: #00ccff;
-        font-family: 'Orbitron', sans-serif;
-        font-weight: bold;
-        letter-spacing: 0.1em;
-        transition: all 0.2s;
-    }
-    .stButton button:hover {
-        background: #00ccff;
-        color: #000;
-        box-shadow: 0 0 15px #00ccff;
-    }
 
-    /* SWOT Chips */
-    .swot-grid { display: flex; flex-wrap: wrap; gap: 5px; margin-top: 5px; }
-    .swot-tag {
-        font-size: 11px;
-        padding: 2px 8px;
-        border: 1px solid;
-        border-radius: 0;
-        background: rgba(0,0,0,0.4);
-    }
-    .swot-s { color: #81c784; border-color: #81c784; }
-    .swot-w { color: #e57373; border-color: #e57373; }
-    .swot-o { color: #64b5f6; border-color: #64b5f6; }
-    .swot-t { color: #ffb74d; border-color: #ffb74d; }
-
-    /* ユーティリティ */
-    .divider-h {
-        height: 1px;
-        background: linear-gradient(90deg, transparent, #4d5cff, transparent);
-        margin: 20px 0;
-    }
-    </style>
-    """,
-    unsafe_allow_html=True,
-)
+# ワーカースレッドからも st.toast などを表示できるよう、スクリプトコンテキストを引き継ぐ
+def capture_script_run_ctx():
+    ctx = get_script_run_ctx()
 
-# ======================================================
-# ヘッダー表示
-# ======================================================
-st.markdown(
-    """
-    <div class="magi-header">
-        <div>
-            <div class="magi-title">MAGI SYSTEM</div>
-            <div class="magi-subtitle">SUPER COMPUTER SYSTEM 3.0</div>
-        </div>
-        <div class="magi-sys-status">
-            CODE: 771<br>
-            PRIORITY: AAA<br>
-            STATUS: <span style="color:#00ff00; animation: blink 1s infinite;">ONLINE</span>
-        </div>
-    </div>
-    <style>@keyframes blink{0%{opacity:1}50%{opacity:0.3}100%{opacity:1}}</style>
-    """,
-    unsafe_allow_html=True,
-)
+    def apply():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
 
-# ======================================================
-# Gemini API 設定
-# ======================================================
-api_key = st.secrets.get("GEMINI_API_KEY", os.getenv("GEMINI_API_KEY"))
+    return apply
 
-if not api_key:
-    st.error("🚨 CRITICAL ERROR: API KEY NOT FOUND.")
-    st.info("Set GEMINI_API_KEY in Streamlit secrets or environment variables.")
-    st.stop()
 
-genai.configure(api_key=api_key)
+register_context_propagator(capture_script_run_ctx)
+set_notifier(lambda message, icon: st.toast(message, icon=icon))
 
 # ======================================================
 # モデル設定 (セッション管理)
 # ======================================================
 if "gemini_model_name" not in st.session_state:
     # 安定性を優先してデフォルトを 1.5 Flash に変更
-    st.session_state["gemini_model_name"] = "gemini-1.5-flash"
+    st.session_state["gemini_model_name"] = "local" if offline_mode else "gemini-1.5-flash"
 
 # サイドバー設定
 st.sidebar.markdown(
@@ -250,437 +134,780 @@ st.sidebar.markdown(
     unsafe_allow_html=True,
 )
 
-MODEL_CHOICES = {
-    "Gemini 1.5 Flash (Stable)": "gemini-1.5-flash",
-    "Gemini 2.0 Flash (Preview)": "gemini-2.0-flash",
-    "Gemini 1.5 Pro (High-Spec)": "gemini-1.5-pro",
+available_models = {
+    label: spec for label, spec in MODEL_CHOICES.items() if not (offline_mode and spec["backend"] == "gemini")
 }
 
 selected_model_label = st.sidebar.selectbox(
     "PROCESSING CORE",
-    list(MODEL_CHOICES.keys()),
+    list(available_models.keys()),
     index=0
 )
-st.session_state["gemini_model_name"] = MODEL_CHOICES[selected_model_label]
+st.session_state["gemini_model_name"] = available_models[selected_model_label]["name"]
 
 
-def get_gemini_model():
-    return genai.GenerativeModel(st.session_state["gemini_model_name"])
+with st.sidebar.expander("ROUTING"):
+    fallback_labels = st.multiselect(
+        "FAILOVER ORDER",
+        [label for label in available_models if label != selected_model_label],
+        default=[label for label in available_models if label != selected_model_label],
+    )
+    hedge_enabled = st.checkbox("HEDGED REQUESTS", value=False)
+    hedge_percentile = st.select_slider(
+        "HEDGE AFTER LATENCY PERCENTILE", options=[50, 75, 90, 95, 99], value=95, disabled=not hedge_enabled
+    )
+    # 有効にすると、選択した PROCESSING CORE よりプロンプトの大きさを優先する
+    size_routing = st.checkbox(
+        "SIZE-BASED ROUTING (OVERRIDES PROCESSING CORE)", value=False,
+        help="Small prompts go to the cheapest fast model; prompts near the selected model's context window "
+             "go to the longest-context model.",
+    )
+st.session_state["model_fallbacks"] = [available_models[label]["name"] for label in fallback_labels]
+st.session_state["hedge_percentile"] = hedge_percentile if hedge_enabled else None
 
 
-# ======================================================
-# ヘルパー関数 (リトライロジック付き)
-# ======================================================
-def clean_text(text: str) -> str:
-    if not text: return ""
-    return text.replace("*", "").strip()
+def get_route_plan() -> RoutePlan:
+    """現在のセッション設定からルーティング計画を作る (スクリプトスレッドで呼ぶこと)"""
+    primary = st.session_state["gemini_model_name"]
+    fallbacks = [m for m in st.session_state.get("model_fallbacks", []) if m != primary]
+    return RoutePlan((primary, *fallbacks), st.session_state.get("hedge_percentile"))
+
+
+def uploaded_file_id(uploaded_file) -> str:
+    return getattr(uploaded_file, "file_id", None) or f"{uploaded_file.name}:{uploaded_file.size}"
+
 
-def generate_with_retry(model, content, max_retries=3):
+def uploaded_file_hash(uploaded_file) -> str:
+    """内容のハッシュ (同じファイルの再アップロードでも同じ値)。ファイルごとに1度だけ計算する"""
+    file_id = uploaded_file_id(uploaded_file)
+    cached = st.session_state.get("uploaded_file_hash")
+    if not cached or cached[0] != file_id:
+        cached = (file_id, hashlib.sha256(uploaded_file.getbuffer()).hexdigest())
+        st.session_state["uploaded_file_hash"] = cached
+    return cached[1]
+
+
+def get_prepared_image(uploaded_file, max_edge: int, fmt: str) -> PreparedImage:
     """
-    429エラー(ResourceExhausted)が発生した場合、
-    指数バックオフ (Exponential Backoff) で待機して再試行するラッパー関数
+    アップロード画像を前処理し、セッションに1件だけ保持する。
+    同じファイル・同じ設定での再実行時は再エンコードしない。
     """
-    for attempt in range(max_retries):
-        try:
-            return model.generate_content(content)
-        except ResourceExhausted as e:
-            # クォータ制限の場合
-            wait_time = (2 ** attempt) + random.uniform(0, 1) # 1秒, 2秒, 4秒...と待機時間を増やす
-            if attempt < max_retries - 1:
-                st.toast(f"⚠️ SYSTEM BUSY (429). RETRYING IN {wait_time:.1f}s...", icon="⏳")
-                time.sleep(wait_time)
-                continue
-            else:
-                # リトライ上限到達
-                raise e
-        except Exception as e:
-            raise e
-
-def analyze_media(file, mime_type: str, prompt: str) -> str:
-    """画像や音声を解析する汎用関数（リトライ付き）"""
-    model = get_gemini_model()
-    try:
-        if mime_type.startswith("image"):
-            content = [prompt, Image.open(file)]
-        else:
-            content = [prompt, {"mime_type": mime_type, "data": file.getvalue()}]
-        
-        # リトライ付きで実行
-        resp = generate_with_retry(model, content)
-        return clean_text(resp.text)
-    except ResourceExhausted:
-        return "ERROR: 429 Quota Exceeded. (System Overload)"
-    except Exception as e:
-        return f"ERROR: {str(e)}"
+    key = (uploaded_file_id(uploaded_file), max_edge, fmt)
+    cached = st.session_state.get("prepared_image")
+    if cached and cached[0] == key:
+        return cached[1]
 
-# ======================================================
-# MAGI ロジック
-# ======================================================
-def call_magi_core(context: Dict[str, Any], enable_swot: bool) -> str | None:
-    model = get_gemini_model()
-    
-    # 役割定義
-    system_prompt = """
-あなたはスーパーコンピュータシステム「MAGI」です。
-以下の3つの人格（エージェント）と、メディア解析担当、そして統合判断を行うメインプロセッサとして振る舞ってください。
-
-【構成エージェント】
-1. **Magi-Logic (Melchior)**: 
-   - 科学者としての「自分」。冷徹、論理的、効率重視、最新技術への信頼。感情を排し、データと確率で判断する。
-2. **Magi-Human (Balthasar)**: 
-   - 母としての「自分」。倫理的、感情的、保護的。人間性、幸福、リスク回避、子供の将来を優先する。
-3. **Magi-Reality (Casper)**: 
-   - 女としての「自分」。現実的、政治的、直感的。現状維持、コスト、人間関係の機微、個人の欲望を重視する。
-
-【タスク】
-ユーザーの入力（質問・テキスト・メディア情報）に対し、上記3つの視点から議論し、それぞれ「可決(Go)」「否決(No-Go)」「保留(Hold)」を判定せよ。
-あえて意見を対立させること。Logicが推奨してもHumanが倫理で止め、Realityがコストで渋るような構図が望ましい。
-
-【出力フォーマット】
-必ず以下の形式で出力すること。Markdownの装飾は最小限にせよ。
-
-[SECTION:MAGI-LOGIC]
-判定: (可決/否決/保留)
-見解: (論理的視点からの120文字以内のコメント。断定的な口調)
-
-[SECTION:MAGI-HUMAN]
-判定: (可決/否決/保留)
-見解: (人間的・倫理的視点からの120文字以内のコメント。丁寧だが心配性な口調)
-
-[SECTION:MAGI-REALITY]
-判定: (可決/否決/保留)
-見解: (現実的・政治的視点からの120文字以内のコメント。シニカルまたは打算的な口調)
-
-[SECTION:MAGI-MEDIA]
-判定: (可決/否決/保留)
-見解: (デザイン・印象・表現面からの120文字以内のコメント)
-
-[SECTION:INTEGRATION]
-結論: (承認/否決/条件付き承認 など簡潔に)
-詳細: (3者の意見を統合した最終アドバイス。300文字以内)
-"""
+    prepared = prepare_image(uploaded_file.getvalue(), max_edge, fmt)
+    st.session_state["prepared_image"] = (key, prepared)
+    return prepared
 
-    if enable_swot:
-        system_prompt += """
-[SECTION:SWOT]
-Strengths: (強みを5つ、読点で区切って列挙)
-Weaknesses: (弱みを5つ、読点で区切って列挙)
-Opportunities: (機会を5つ、読点で区切って列挙)
-Threats: (脅威を5つ、読点で区切って列挙)
-"""
 
-    user_data = f"""
-    QUERY: {context['user_question']}
-    ADDITIONAL_TEXT: {context['text_input']}
-    VISUAL_DATA: {context['image_description']}
-    AUDIO_DATA: {context['audio_transcript']}
+def get_media_job(
+    key, field: str, fn, *args, track_progress: bool = False, slot: str = "media_job", **kwargs
+) -> Dict[str, Any]:
     """
+    メディア解析をバックグラウンドで開始し、セッションの slot に1件だけ保持する。
+    同じファイル・同じ設定での再実行時は実行中 (または完了済み) の解析をそのまま使う。
+    track_progress=True なら fn に on_progress を渡し、区間ごとの進捗を記録する。
+    文書の要約は画像・音声の解析と同時に走れるよう、slot="text_job" に保持する。
+    戻り値: {"field", "future", "progress": [完了区間数, 全区間数]}
+    """
+    cached = st.session_state.get(slot)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    progress = [0, 0]
 
+    def on_progress(done, total):
+        # ワーカースレッドから呼ばれるため、UI には触れず値だけ更新する
+        progress[:] = [done, total]
+
+    if track_progress:
+        kwargs["on_progress"] = on_progress
+    job = {"field": field, "future": start_media_analysis(field, fn, *args, **kwargs), "progress": progress}
+    st.session_state[slot] = (key, job)
+    return job
+
+
+def media_job_status(
+    job: Dict[str, Any], running: str = "ANALYZING IN BACKGROUND...", unit: str = "SEGMENT",
+    complete: str = "ANALYSIS COMPLETE.",
+) -> str:
+    future: Future = job["future"]
+    if future.done():
+        return complete
+    done, total = job["progress"]
+    if total:
+        return f"{running} {unit} {done}/{total}"
+    return running
+
+
+REPORT_HISTORY_LIMIT = int(os.getenv("MAGI_REPORT_HISTORY", "20"))
+
+
+def remember_report(context: Dict[str, Any], sections: Dict[str, Any], image: Optional[PreparedImage]) -> None:
+    """一括出力用に、このセッションの審議結果を新しい順に上限件数まで保持する"""
+    history = st.session_state.setdefault("report_history", [])
+    name = time.strftime("MAGI_REPORT_%Y%m%d_%H%M%S")
+    history.append((f"{len(history) + 1:03d}_{name}", dict(context), sections, image))
+    del history[:-REPORT_HISTORY_LIMIT]
+
+
+def render_report_archive(slot, fmt: str):
+    """サイドバーの一括出力: セッション中のレポートを ZIP にまとめる (クリックされた時に作成する)"""
+    reports = list(st.session_state.get("report_history", []))
+    if not reports:
+        return
+    report_format = REPORT_FORMATS[fmt]
+
+    def build_zip():
+        buf = io.BytesIO()
+        write_reports_zip(buf, reports, fmt)
+        return buf.getvalue()
+
+    with slot.container():
+        st.download_button(
+            f"📦 EXPORT ALL {len(reports)} REPORTS (.ZIP)", data=build_zip,
+            file_name=f"MAGI_REPORTS_{report_format.label}.zip", mime="application/zip",
+            on_click="ignore", use_container_width=True,
+        )
+
+
+HISTORY_PAGE_SIZE = 8
+
+
+def open_history_entry(entry_id: int) -> None:
+    st.session_state["history_view"] = entry_id
+
+
+def move_history_page(delta: int) -> None:
+    st.session_state["history_page"] = max(0, st.session_state.get("history_page", 0) + delta)
+
+
+def render_history_panel(slot):
+    """サイドバーの審議履歴: 全文検索とページ送り。一覧には要約だけを読み込む"""
+    store = get_history_store()
+    if store is None:
+        return
+    with slot.container():
+        with st.expander("DELIBERATION HISTORY"):
+            query = st.text_input(
+                "SEARCH", key="history_query", placeholder="過去の審議を検索",
+                on_change=lambda: st.session_state.update(history_page=0),
+            )
+            total = store.count(query)
+            pages = max(1, math.ceil(total / HISTORY_PAGE_SIZE))
+            page = min(st.session_state.get("history_page", 0), pages - 1)
+            for entry in store.page(page * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE, query):
+                verdicts = " ".join(get_decision_style(v)[1] for v in entry.verdicts.values())
+                st.button(
+                    f"#{entry.id} {entry.user_question[:24] or '(NO QUERY)'}",
+                    key=f"history_{entry.id}", on_click=open_history_entry, args=(entry.id,),
+                    help=f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(entry.created))} / {entry.conclusion} / {verdicts}",
+                    use_container_width=True,
+                )
+            c1, c2 = st.columns(2)
+            c1.button("◀ NEWER", key="history_prev", on_click=move_history_page, args=(-1,), disabled=page == 0)
+            c2.button("OLDER ▶", key="history_next", on_click=move_history_page, args=(1,), disabled=page >= pages - 1)
+            st.caption(f"PAGE {page + 1}/{pages} ({total} RECORDS)")
+
+
+def render_history_entry(entry_id: int):
+    """履歴から選んだ審議を、モデルを呼ばずに保存済みの出力から再表示する"""
+    entry = get_history_store().get(entry_id)
+    if entry is None:
+        return
+    st.markdown('<div class="divider-h"></div>', unsafe_allow_html=True)
+    st.markdown(f'<span class="section-label">:: ARCHIVED DELIBERATION #{entry_id} ::</span>', unsafe_allow_html=True)
+    st.caption(
+        f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['created']))} / MODEL {entry['model']}"
+        f" / ENGINE {entry['engine']} / {entry['elapsed']:.1f}s"
+    )
+    st.markdown(f"**QUERY:** {entry['user_question'] or '(NO QUERY)'}")
+    sections = parse_magi_output(entry["raw_result"])
+    slots = create_result_slots("SWOT" in sections)
+    for tag, sec in sections.items():
+        render_section(slots, tag, sec)
+    st.button("CLOSE ARCHIVE VIEW", on_click=lambda: st.session_state.pop("history_view", None))
+
+
+def request_deliberation() -> None:
+    """類似の審議を提示した後で、それでも新たに審議する"""
+    st.session_state["run_requested"] = True
+
+
+def reuse_history_entry(entry_id: int) -> None:
+    """入力パネルから過去の審議を開く (結果パネルも描き直すため、次の実行でページ全体を再実行する)"""
+    open_history_entry(entry_id)
+    st.session_state["page_refresh"] = True
+
+
+def find_similar_deliberations(context):
+    """意味的に近い過去の審議。埋め込みモデルが使えない環境では空で返す"""
+    recall = get_semantic_recall()
+    if recall is None or not st.session_state.get("semantic_recall", True):
+        return []
     try:
-        # リトライ付きで実行
-        response = generate_with_retry(model, [system_prompt, user_data])
-        return response.text
-    except ResourceExhausted:
-        return "SYSTEM FAILURE: 429 RESOURCE EXHAUSTED. Please switch models or wait a moment."
-    except Exception as e:
-        return f"SYSTEM FAILURE: {str(e)}"
+        with stage("semantic_recall"):
+            return recall.find_similar(context)
+    except BackendUnavailable as e:
+        st.caption(f"SEMANTIC RECALL OFFLINE: {e}")
+        return []
+
+
+def render_similar_deliberations(matches):
+    """審議の前に、似た過去の審議を再利用するか確認する"""
+    st.markdown('<span class="section-label">:: SIMILAR PAST DELIBERATIONS ::</span>', unsafe_allow_html=True)
+    for match in matches:
+        c1, c2 = st.columns([5, 1])
+        c1.markdown(
+            f"**#{match.id}** {match.user_question or '(NO QUERY)'}  \n"
+            f"<span style='color:#888;'>{time.strftime('%Y-%m-%d %H:%M', time.localtime(match.created))}"
+            f" / SIMILARITY {match.score:.2f} / {match.conclusion}</span>",
+            unsafe_allow_html=True,
+        )
+        c2.button("REUSE", key=f"reuse_{match.id}", on_click=reuse_history_entry, args=(match.id,), use_container_width=True)
+    st.button("DELIBERATE ANYWAY", on_click=request_deliberation, type="primary")
+
+
+def render_diagnostics(slot):
+    """サイドバーの診断パネル: 直近リクエストのステージ別時間・カウンタと、集計値のエクスポート"""
+    metrics = get_metrics()
+    with slot.container():
+        with st.expander("DIAGNOSTICS"):
+            recent = list(metrics.recent)
+            if recent:
+                last = recent[-1]
+                st.caption(f"LAST REQUEST: {last['name']} ({last['elapsed']:.2f}s)")
+                st.dataframe(last["stages"], hide_index=True, use_container_width=True)
+                st.json({k: v for k, v in last["counters"].items() if v}, expanded=False)
+            else:
+                st.caption("NO REQUESTS RECORDED YET.")
 
-# ======================================================
-# 解析ロジック (テキスト処理)
-# ======================================================
-def parse_magi_output(text: str):
-    sections = {}
-    pattern = re.compile(r"\[SECTION:(.*?)\]")
-    parts = pattern.split(text)
-    
-    for i in range(1, len(parts), 2):
-        tag = parts[i].strip()
-        content = parts[i+1].strip()
-        
-        data = {"decision": "保留", "summary": "", "raw": content}
-        
-        for line in content.split('\n'):
-            if line.startswith("判定:"):
-                val = line.split(":", 1)[1].strip()
-                if "可決" in val: data["decision"] = "可決"
-                elif "否決" in val: data["decision"] = "否決"
-                else: data["decision"] = "保留"
-            elif line.startswith("見解:") or line.startswith("詳細:"):
-                data["summary"] = line.split(":", 1)[1].strip()
-        
-        if tag == "SWOT":
-            swot_data = {}
-            for line in content.split('\n'):
-                if ":" in line:
-                    k, v = line.split(":", 1)
-                    swot_data[k.strip()] = v.strip()
-            sections["SWOT"] = swot_data
-        else:
-            sections[tag] = data
+            st.caption("PROCESS TOTALS")
+            st.dataframe(
+                [{"stage": name, **values} for name, values in metrics.summary().items()],
+                hide_index=True, use_container_width=True,
+            )
+            st.download_button(
+                "EXPORT PROMETHEUS", metrics.to_prometheus(), file_name="magi_metrics.prom", mime="text/plain"
+            )
+            st.download_button(
+                "EXPORT TRACES (JSONL)", metrics.recent_jsonl(), file_name="magi_traces.jsonl",
+                mime="application/jsonl",
+            )
 
-    return sections
 
 def get_decision_style(decision):
     if decision == "可決": return "decision-go", "GO"
     if decision == "否決": return "decision-nogo", "NO-GO"
     return "decision-hold", "HOLD"
 
-# ======================================================
-# Word レポート作成
-# ======================================================
-def create_docx(context, sections, image=None):
-    doc = docx.Document()
-    doc.add_heading('MAGI ANALYTICAL REPORT', 0)
-    
-    doc.add_heading('1. INPUT DATA', level=1)
-    doc.add_paragraph(f"Query: {context['user_question']}")
-    if context['text_input']: doc.add_paragraph(f"Text: {context['text_input']}")
-    
-    if image:
-        img_stream = io.BytesIO()
-        image.save(img_stream, format="PNG")
-        img_stream.seek(0)
-        doc.add_picture(img_stream, width=docx.shared.Inches(2.5))
-
-    doc.add_heading('2. MAGI DELIBERATION', level=1)
-    
-    agent_map = {
-        "MAGI-LOGIC": "MELCHIOR-1 (Logic)",
-        "MAGI-HUMAN": "BALTHASAR-2 (Human)",
-        "MAGI-REALITY": "CASPER-3 (Reality)",
-        "MAGI-MEDIA": "MEDIA ANALYZER"
-    }
-    
-    for key, name in agent_map.items():
-        if key in sections:
-            sec = sections[key]
-            p = doc.add_paragraph()
-            p.add_run(f"[{name}] ").bold = True
-            p.add_run(f"Vote: {sec['decision']}\n")
-            p.add_run(sec['summary'])
-
-    doc.add_heading('3. FINAL INTEGRATION', level=1)
-    if "INTEGRATION" in sections:
-        doc.add_paragraph(sections["INTEGRATION"]["raw"])
-
-    if "SWOT" in sections:
-        doc.add_heading('4. SWOT ANALYSIS', level=1)
-        for k, v in sections["SWOT"].items():
-            doc.add_paragraph(f"{k}: {v}")
-            
-    buf = io.BytesIO()
-    doc.save(buf)
-    buf.seek(0)
-    return buf.getvalue()
 
 # ======================================================
-# UI 構築
+# 結果表示 (カード描画)
 # ======================================================
-
-# --- サイドバー入力 ---
-input_mode = st.sidebar.radio("DATA INPUT SOURCE", ["File Upload", "Camera", "None"], index=0)
-uploaded_file = None
-if input_mode == "File Upload":
-    uploaded_file = st.sidebar.file_uploader("ARCHIVE DATA", type=["png", "jpg", "jpeg", "wav", "mp3", "txt"])
-elif input_mode == "Camera":
-    uploaded_file = st.sidebar.camera_input("VISUAL SENSOR")
-
-swot_mode = st.sidebar.checkbox("ACTIVATE SWOT MODULE", value=False)
-
-# --- メインエリア ---
-st.markdown('<span class="section-label">:: USER QUERY ::</span>', unsafe_allow_html=True)
-user_question = st.text_area("ENTER YOUR DILEMMA", height=80, placeholder="例：このプロジェクトを進めるべきか？ 今の状況を分析してほしい。")
-text_input = st.text_area("SUPPLEMENTARY DATA (OPTIONAL)", height=80)
-
-# 解析用コンテキスト
-context = {
-    "user_question": user_question,
-    "text_input": text_input,
-    "image_description": "",
-    "audio_transcript": ""
+AGENT_CARDS = {
+    "MAGI-LOGIC": ("agent-logic", "MELCHIOR-1", "LOGIC", "font-size:13px; line-height:1.4;"),
+    "MAGI-HUMAN": ("agent-human", "BALTHASAR-2", "HUMAN", "font-size:13px; line-height:1.4;"),
+    "MAGI-REALITY": ("agent-reality", "CASPER-3", "REALITY", "font-size:13px; line-height:1.4;"),
+    "MAGI-MEDIA": ("agent-media", "MEDIA.OP", "ARTS", "font-size:12px;"),
 }
-report_image = None
-
-# メディア処理
-if uploaded_file:
-    mime = uploaded_file.type
-    st.markdown('<span class="section-label">:: MEDIA DATA ::</span>', unsafe_allow_html=True)
-    
-    if mime.startswith("image"):
-        image = Image.open(uploaded_file)
-        report_image = image
-        st.image(image, caption="VISUAL DATA ACQUIRED", width=300)
-        with st.spinner("ANALYZING VISUAL PATTERNS..."):
-            context["image_description"] = analyze_media(
-                uploaded_file, mime, 
-                "この画像に写っているものを客観的に、詳細に描写してください。感情的な印象も含めてください。"
-            )
-            
-    elif mime.startswith("audio"):
-        st.audio(uploaded_file)
-        with st.spinner("DECODING AUDIO WAVEFORM..."):
-            context["audio_transcript"] = analyze_media(
-                uploaded_file, mime, 
-                "この音声を日本語に書き起こしてください。"
-            )
-
-# --- 実行ボタン ---
-st.markdown("<div style='margin-top:20px;'></div>", unsafe_allow_html=True)
-if st.button("INITIALIZE MAGI DELIBERATION", type="primary", use_container_width=True):
-    
-    if not user_question and not uploaded_file and not text_input:
-        st.warning("⚠️ DATA INSUFFICIENT. PLEASE INPUT QUERY OR MEDIA.")
-        st.stop()
-        
-    # プログレス演出
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    
-    steps = [
-        "CONNECTING TO MAGI SYSTEM...",
-        "SYNCING WITH MELCHIOR-1...",
-        "SYNCING WITH BALTHASAR-2...",
-        "SYNCING WITH CASPER-3...",
-        "CALCULATING PROBABILITIES...",
-        "DELIBERATION IN PROGRESS..."
-    ]
-    
-    for i, step in enumerate(steps):
-        status_text.markdown(f"<span style='color:#00ffcc; font-family:Orbitron;'>{step}</span>", unsafe_allow_html=True)
-        progress_bar.progress((i + 1) * 15)
-        time.sleep(0.1) 
-
-    # Gemini 実行
-    raw_result = call_magi_core(context, swot_mode)
-    progress_bar.progress(100)
-    status_text.empty()
-    progress_bar.empty()
-    
-    # 失敗時の表示
-    if not raw_result or "SYSTEM FAILURE" in raw_result:
-        st.error(raw_result or "UNKNOWN ERROR")
-        if "RESOURCE EXHAUSTED" in raw_result:
-             st.info("💡 **HINT**: Try switching to 'Gemini 1.5 Flash' in the sidebar or wait a minute before retrying.")
-        st.stop()
 
-    # 結果パース
-    sections = parse_magi_output(raw_result)
 
-    # ==================================================
-    # 結果表示 (3カラムレイアウト)
-    # ==================================================
-    st.markdown('<div class="divider-h"></div>', unsafe_allow_html=True)
-    
-    col1, col2, col3 = st.columns(3)
-    
-    # MELCHIOR (Logic)
-    with col1:
-        sec = sections.get("MAGI-LOGIC", {})
+def agent_card_html(tag: str, sec: Optional[Dict[str, Any]]) -> str:
+    """エージェントカードの HTML。sec が None の場合は受信待ち表示"""
+    css_class, name, role, summary_style = AGENT_CARDS[tag]
+    if sec is None:
+        style, label, summary = "decision-hold", "- - -", "AWAITING RESPONSE..."
+    else:
         style, label = get_decision_style(sec.get("decision"))
-        st.markdown(f"""
-        <div class="magi-card agent-logic">
+        summary = sec.get('summary', 'No Data')
+    return f"""
+        <div class="magi-card {css_class}">
             <div class="agent-title">
-                <span>MELCHIOR-1</span>
-                <span style="font-size:10px;">LOGIC</span>
+                <span>{name}</span>
+                <span style="font-size:10px;">{role}</span>
             </div>
             <div class="decision-box {style}">{label}</div>
-            <div style="font-size:13px; line-height:1.4;">{sec.get('summary', 'No Data')}</div>
+            <div style="{summary_style}">{summary}</div>
         </div>
-        """, unsafe_allow_html=True)
+        """
 
-    # BALTHASAR (Human)
-    with col2:
-        sec = sections.get("MAGI-HUMAN", {})
-        style, label = get_decision_style(sec.get("decision"))
-        st.markdown(f"""
-        <div class="magi-card agent-human">
-            <div class="agent-title">
-                <span>BALTHASAR-2</span>
-                <span style="font-size:10px;">HUMAN</span>
+
+def integration_html(sec: Optional[Dict[str, Any]]) -> str:
+    if sec is None:
+        conclusion, detail = "AWAITING RESPONSE...", ""
+    else:
+        conclusion = sec.get('raw', '').split('詳細:')[0].replace('結論:', '')
+        detail = sec.get('summary', '')
+    return f"""
+        <div class="magi-aggregator">
+            <div class="agent-title" style="border:none; color:#fff;">:: FINAL DECISION ::</div>
+            <div style="font-size:16px; margin-bottom:10px; color:#4d5cff; font-weight:bold;">
+                {conclusion}
+            </div>
+            <div style="font-size:14px; line-height:1.6; color:#d0f0ff;">
+                {detail}
             </div>
-            <div class="decision-box {style}">{label}</div>
-            <div style="font-size:13px; line-height:1.4;">{sec.get('summary', 'No Data')}</div>
         </div>
-        """, unsafe_allow_html=True)
+        """
+
+
+def swot_tags_html(items: str, css_class: str) -> str:
+    return '<div class="swot-grid">' + "".join([f'<span class="swot-tag {css_class}">{x}</span>' for x in items.split('、')]) + '</div>'
+
+
+@st.fragment
+def render_swot_grid(swot: Dict[str, str]):
+    """SWOT グリッド (独立した fragment。結果パネルの再実行とは別に描画される)"""
+    st.markdown('<div class="divider-h"></div>', unsafe_allow_html=True)
+    st.markdown('<span class="section-label">:: SWOT STRATEGIC GRID ::</span>', unsafe_allow_html=True)
 
-    # CASPER (Reality)
+    c1, c2 = st.columns(2)
+    with c1:
+        st.markdown("**STRENGTHS**")
+        st.markdown(swot_tags_html(swot.get('Strengths', ''), "swot-s"), unsafe_allow_html=True)
+
+        st.markdown("<br>**OPPORTUNITIES**", unsafe_allow_html=True)
+        st.markdown(swot_tags_html(swot.get('Opportunities', ''), "swot-o"), unsafe_allow_html=True)
+
+    with c2:
+        st.markdown("**WEAKNESSES**")
+        st.markdown(swot_tags_html(swot.get('Weaknesses', ''), "swot-w"), unsafe_allow_html=True)
+
+        st.markdown("<br>**THREATS**", unsafe_allow_html=True)
+        st.markdown(swot_tags_html(swot.get('Threats', ''), "swot-t"), unsafe_allow_html=True)
+
+
+def create_result_slots(enable_swot: bool) -> Dict[str, Any]:
+    """カードごとの描画枠 (st.empty) を作り、受信待ち表示で埋める"""
+    col1, col2, col3 = st.columns(3)
+    slots = {}
+    with col1:
+        slots["MAGI-LOGIC"] = st.empty()
+    with col2:
+        slots["MAGI-HUMAN"] = st.empty()
     with col3:
-        sec = sections.get("MAGI-REALITY", {})
-        style, label = get_decision_style(sec.get("decision"))
-        st.markdown(f"""
-        <div class="magi-card agent-reality">
-            <div class="agent-title">
-                <span>CASPER-3</span>
-                <span style="font-size:10px;">REALITY</span>
-            </div>
-            <div class="decision-box {style}">{label}</div>
-            <div style="font-size:13px; line-height:1.4;">{sec.get('summary', 'No Data')}</div>
-        </div>
-        """, unsafe_allow_html=True)
+        slots["MAGI-REALITY"] = st.empty()
 
     # Media & Integration (下部)
     c_media, c_integ = st.columns([1, 2])
-    
     with c_media:
-        sec = sections.get("MAGI-MEDIA", {})
-        style, label = get_decision_style(sec.get("decision"))
-        st.markdown(f"""
-        <div class="magi-card agent-media">
-            <div class="agent-title">
-                <span>MEDIA.OP</span>
-                <span style="font-size:10px;">ARTS</span>
-            </div>
-            <div class="decision-box {style}">{label}</div>
-            <div style="font-size:12px;">{sec.get('summary', 'No Data')}</div>
-        </div>
-        """, unsafe_allow_html=True)
-        
+        slots["MAGI-MEDIA"] = st.empty()
     with c_integ:
-        sec = sections.get("INTEGRATION", {})
-        st.markdown(f"""
-        <div class="magi-aggregator">
-            <div class="agent-title" style="border:none; color:#fff;">:: FINAL DECISION ::</div>
-            <div style="font-size:16px; margin-bottom:10px; color:#4d5cff; font-weight:bold;">
-                {sec.get('raw', '').split('詳細:')[0].replace('結論:', '')}
-            </div>
-            <div style="font-size:14px; line-height:1.6; color:#d0f0ff;">
-                {sec.get('summary', '')}
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
+        slots["INTEGRATION"] = st.empty()
 
     # SWOT Module
-    if swot_mode and "SWOT" in sections:
-        swot = sections["SWOT"]
-        st.markdown('<div class="divider-h"></div>', unsafe_allow_html=True)
-        st.markdown('<span class="section-label">:: SWOT STRATEGIC GRID ::</span>', unsafe_allow_html=True)
-        
-        c1, c2 = st.columns(2)
-        with c1:
-            st.markdown("**STRENGTHS**")
-            html = '<div class="swot-grid">' + "".join([f'<span class="swot-tag swot-s">{x}</span>' for x in swot.get('Strengths','').split('、')]) + '</div>'
-            st.markdown(html, unsafe_allow_html=True)
-            
-            st.markdown("<br>**OPPORTUNITIES**", unsafe_allow_html=True)
-            html = '<div class="swot-grid">' + "".join([f'<span class="swot-tag swot-o">{x}</span>' for x in swot.get('Opportunities','').split('、')]) + '</div>'
-            st.markdown(html, unsafe_allow_html=True)
-            
-        with c2:
-            st.markdown("**WEAKNESSES**")
-            html = '<div class="swot-grid">' + "".join([f'<span class="swot-tag swot-w">{x}</span>' for x in swot.get('Weaknesses','').split('、')]) + '</div>'
-            st.markdown(html, unsafe_allow_html=True)
-            
-            st.markdown("<br>**THREATS**", unsafe_allow_html=True)
-            html = '<div class="swot-grid">' + "".join([f'<span class="swot-tag swot-t">{x}</span>' for x in swot.get('Threats','').split('、')]) + '</div>'
-            st.markdown(html, unsafe_allow_html=True)
+    if enable_swot:
+        slots["SWOT"] = st.empty()
+
+    for tag in AGENT_CARDS:
+        slots[tag].markdown(agent_card_html(tag, None), unsafe_allow_html=True)
+    slots["INTEGRATION"].markdown(integration_html(None), unsafe_allow_html=True)
+    return slots
+
+
+def render_section(slots: Dict[str, Any], tag: str, sec: Dict[str, Any]):
+    if tag not in slots:
+        return
+    if tag in AGENT_CARDS:
+        slots[tag].markdown(agent_card_html(tag, sec), unsafe_allow_html=True)
+    elif tag == "INTEGRATION":
+        slots[tag].markdown(integration_html(sec), unsafe_allow_html=True)
+    elif tag == "SWOT":
+        with slots[tag].container():
+            render_swot_grid(sec)
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def estimate_prompt(context, enable_swot: bool, engine: str, plan: RoutePlan, policy: RoundPolicy, pending):
+    """送信前の見積もり (MAGI_COUNT_TOKENS=1 の場合は通信が発生するため、同じ入力では再計算しない)"""
+    return estimate_deliberation(context, enable_swot, engine, plan, policy, pending)
+
+
+def render_estimate(estimate) -> None:
+    st.caption(
+        f"ESTIMATE: ~{estimate.input_tokens:,} INPUT + ~{estimate.output_tokens:,} OUTPUT TOKENS"
+        f" / {estimate.requests} REQUESTS / ≈ ${estimate.cost_usd:.4f} ON {estimate.model.upper()}"
+        + ("" if estimate.exact else " (LOCAL ESTIMATE)")
+    )
+
+
+# ======================================================
+# 審議ジョブ (ワーカーで実行し、画面は状態を読むだけ)
+# ======================================================
+JOB_POLL_SECONDS = float(os.getenv("MAGI_JOB_POLL_SECONDS", "0.5"))
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_job_progress(job_id: str):
+    """実行中のジョブの状態と受信済みのセクションを描画し、完了したらページ全体を再実行する"""
+    queue = get_job_queue()
+    job = queue.get(job_id)
+    if job is None or job.done:
+        st.rerun()
+    position = queue.position(job)
+    label = f"QUEUED... POSITION {position}" if position else f"DELIBERATION IN PROGRESS... {job.elapsed:.0f}s"
+    st.markdown(f"<span style='color:#00ffcc; font-family:Orbitron;'>{label}</span>", unsafe_allow_html=True)
+    st.markdown('<div class="divider-h"></div>', unsafe_allow_html=True)
+    slots = create_result_slots(job.enable_swot)
+    for tag, sec in job.sections.items():
+        render_section(slots, tag, sec)
+
+
+def capture_job(job, state: Dict[str, Any]) -> None:
+    """
+    完了したジョブの結果をセッションに写す。以降はセッションから描画するため、
+    ジョブが登録簿から消えても (MAGI_JOB_TTL 経過後など) 結果を表示できる。
+    """
+    state.update(
+        status=job.status, context=job.context, enable_swot=job.enable_swot, result=job.result, error=job.error,
+    )
+
+
+def finalize_job(state: Dict[str, Any], fmt: str) -> Dict[str, Any]:
+    """
+    完了したジョブの結果を1度だけ解析し、レポート作成と一括出力への登録を行う。
+    レポート形式を切り替えた場合はレポートだけ作り直す。
+    """
+    if state.get("sections") is None:
+        state["sections"] = parse_magi_output(state["result"])
+        remember_report(state["context"], state["sections"], state["image"])
+    if state.get("report_format") != fmt:
+        # レポートはバックグラウンドで作成し、ダウンロード時に受け取る
+        state["report"] = submit_report(fmt, state["context"], state["sections"], state["image"])
+        state["report_format"] = fmt
+    return state["sections"]
+
+
+def render_job_result(state: Dict[str, Any], fmt: str):
+    if state["status"] == "failed":
+        st.error(state["error"])
+        if "RESOURCE EXHAUSTED" in state["error"]:
+             st.info("💡 **HINT**: Try switching to 'Gemini 1.5 Flash' in the sidebar or wait a minute before retrying.")
+        return
+
+    st.markdown('<div class="divider-h"></div>', unsafe_allow_html=True)
+    sections = finalize_job(state, fmt)
+    slots = create_result_slots(state["enable_swot"])
+    with stage("render"):
+        for tag in slots:
+            if tag in sections:
+                render_section(slots, tag, sections[tag])
+            elif tag == "SWOT":
+                slots[tag].empty()
 
     # レポート出力
-    docx_bytes = create_docx(context, sections, report_image)
     st.markdown('<div class="divider-h"></div>', unsafe_allow_html=True)
+    report_format = REPORT_FORMATS[fmt]
     st.download_button(
-        label="💾 EXPORT REPORT (.DOCX)",
-        data=docx_bytes,
-        file_name="MAGI_CONFIDENTIAL_REPORT.docx",
-        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-        type="secondary"
+        label=f"💾 EXPORT REPORT (.{report_format.extension.upper()})",
+        data=state["report"].result,
+        file_name=f"MAGI_CONFIDENTIAL_REPORT.{report_format.extension}",
+        mime=report_format.mime_type,
+        type="secondary",
+        on_click="ignore",
+    )
+
+
+# ======================================================
+# パネル (ウィジェットを操作すると、そのパネルの fragment だけが再実行される)
+# ======================================================
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def poll_media_job(job: Dict[str, Any], running: str, unit: str, complete: str):
+    """解析中の進捗を更新し、完了したらページ全体を再実行する (見積もりに結果を反映するため)"""
+    if job["future"].done():
+        st.rerun()
+    st.caption(media_job_status(job, running, unit, complete))
+
+
+def render_media_job_status(
+    job: Dict[str, Any], running: str = "ANALYZING IN BACKGROUND...", unit: str = "SEGMENT",
+    complete: str = "ANALYSIS COMPLETE.",
+):
+    if job["future"].done():
+        st.caption(media_job_status(job, running, unit, complete))
+    else:
+        poll_media_job(job, running, unit, complete)
+
+
+def clear_media_state() -> None:
+    st.session_state.pop("media_job", None)
+    st.session_state.pop("report_image", None)
+
+
+@st.fragment
+def render_media_panel(
+    uploaded_file, route_plan: RoutePlan, image_max_edge: int, image_format: str,
+    audio_chunked: bool, audio_window_sec: int, audio_overlap_sec: int,
+):
+    """
+    添付データのプレビューと解析 (アップロード直後にバックグラウンドで開始し、審議の開始時に結果を受け取る)。
+    解析ジョブと前処理済みの画像はセッションに置き、入力パネルから参照する。
+    文書は補足テキストと合わせて要約するため、取り込みは入力パネルで行う。
+    """
+    mime = uploaded_file.type
+    st.markdown('<span class="section-label">:: MEDIA DATA ::</span>', unsafe_allow_html=True)
+    job_key = (uploaded_file_id(uploaded_file), route_plan)
+    media_job = None
+    st.session_state.pop("report_image", None)
+
+    if mime.startswith("image"):
+        image = get_prepared_image(uploaded_file, image_max_edge, image_format)
+        st.session_state["report_image"] = image
+        st.image(image.data, caption="VISUAL DATA ACQUIRED", width=300)
+        media_job = get_media_job(
+            (*job_key, image_max_edge, image_format), "image_description", analyze_media,
+            image.data, image.mime_type,
+            "この画像に写っているものを客観的に、詳細に描写してください。感情的な印象も含めてください。",
+            route_plan,
+        )
+
+    elif mime.startswith("audio"):
+        st.audio(uploaded_file)
+        # アップロードの内容 (bytes) をそのまま渡す。ワーカーはファイルの読み位置に触れない
+        if audio_chunked:
+            media_job = get_media_job(
+                (*job_key, audio_window_sec, audio_overlap_sec), "audio_transcript", transcribe_audio_chunked,
+                uploaded_file.getvalue(), mime,
+                "この音声を日本語に書き起こしてください。",
+                window_sec=audio_window_sec,
+                overlap_sec=audio_overlap_sec,
+                plan=route_plan,
+                track_progress=True,
+            )
+        else:
+            media_job = get_media_job(
+                (*job_key, None), "audio_transcript", analyze_media,
+                uploaded_file.getvalue(), mime,
+                "この音声を日本語に書き起こしてください。",
+                route_plan,
+            )
+
+    elif mime in DOCUMENT_MIME_TYPES:
+        st.caption(f"DOCUMENT ACQUIRED: {uploaded_file.name}")
+
+    if media_job:
+        render_media_job_status(media_job)
+    else:
+        st.session_state.pop("media_job", None)
+
+
+def current_media_job() -> Optional[Dict[str, Any]]:
+    """メディアパネルが保持している解析ジョブ (画像・音声がなければ None)"""
+    cached = st.session_state.get("media_job")
+    return cached[1] if cached else None
+
+
+@st.fragment
+def render_input_panel(
+    uploaded_file, route_plan: RoutePlan, swot_mode: bool, deliberation_engine: str,
+    round_policy: RoundPolicy, size_routing: bool, stream_mode: bool,
+):
+    """
+    相談・補足テキスト、見積もり、実行ボタン。入力の編集ではこのパネルだけを再実行する。
+    審議を投入した場合や過去の審議を開いた場合は、結果パネルを描き直すためにページ全体を再実行する。
+    """
+    if st.session_state.pop("page_refresh", False):
+        st.rerun()
+
+    st.markdown('<span class="section-label">:: USER QUERY ::</span>', unsafe_allow_html=True)
+    # 添付の有無でパネルの配置が変わっても入力が消えないよう、key で識別する
+    user_question = st.text_area(
+        "ENTER YOUR DILEMMA", height=80, key="user_question",
+        placeholder="例：このプロジェクトを進めるべきか？ 今の状況を分析してほしい。",
+    )
+    text_input = st.text_area("SUPPLEMENTARY DATA (OPTIONAL)", height=80, key="text_input")
+
+    # 解析用コンテキスト
+    context = {**EMPTY_CONTEXT, "user_question": user_question, "text_input": text_input}
+
+    document_job = None
+    if uploaded_file and uploaded_file.type in DOCUMENT_MIME_TYPES:
+        # 文書は内容のハッシュごとに単独で要約し、補足テキストとは後から合わせる
+        # (補足テキストを書き換えても、文書の要約はやり直さない)
+        document_job = get_media_job(
+            (uploaded_file_hash(uploaded_file), route_plan), "text_input", ingest_document,
+            io.BytesIO(uploaded_file.getvalue()), uploaded_file.type, route_plan,
+            track_progress=True, slot="document_job",
+        )
+        text_job = get_media_job(
+            (id(document_job["future"]), text_input), "text_input", combine_document,
+            text_input, document_job["future"], route_plan, slot="text_job",
+        )
+    elif needs_condensing(text_input):
+        # 長い補足テキストは、そのままプロンプトに入れず要約する
+        text_job = get_media_job(
+            (text_input, route_plan), "text_input", condense_text, text_input, route_plan,
+            track_progress=True, slot="text_job",
+        )
+    else:
+        text_job = None
+    if text_job:
+        # 文書の要約中は区間ごとの進捗を表示する
+        status_job = document_job if document_job and not document_job["future"].done() else text_job
+        render_media_job_status(status_job, "CONDENSING DOCUMENT...", "CHUNK", "DOCUMENT DIGEST READY.")
+
+    # --- 見積もりと送り先 (解析中の欄は上限いっぱいとして数える) ---
+    background_jobs = [job for job in (current_media_job(), text_job) if job]
+    known = {
+        job["field"]: job["future"].result() for job in background_jobs
+        if job["future"].done() and job["future"].exception() is None
+    }
+    estimate = estimate_prompt(
+        {**context, **known}, swot_mode, deliberation_engine, route_plan, round_policy,
+        tuple(job["field"] for job in background_jobs if job["field"] not in known),
+    )
+    deliberation_plan = route_by_size(route_plan, estimate.largest_prompt) if size_routing else route_plan
+    if deliberation_plan.primary != estimate.model:
+        estimate = replace(estimate, model=deliberation_plan.primary)
+
+    # --- 実行ボタン ---
+    st.markdown("<div style='margin-top:20px;'></div>", unsafe_allow_html=True)
+    force_redeliberate = st.checkbox("FORCE RE-DELIBERATE (IGNORE CACHED RESULT)", value=False)
+    render_estimate(estimate)
+    run_requested = st.session_state.pop("run_requested", False)
+    if not st.button("INITIALIZE MAGI DELIBERATION", type="primary", use_container_width=True) and not run_requested:
+        return
+
+    if not user_question and not uploaded_file and not text_input:
+        st.warning("⚠️ DATA INSUFFICIENT. PLEASE INPUT QUERY OR MEDIA.")
+        return
+
+    # 言い換えられた相談でも、似た過去の審議があればモデルを呼ぶ前に再利用を提案する。
+    # 履歴には要約後の補足テキストが入るため、同じ形で検索する (要約が終わるまでは提案しない)
+    condensing = any(job["field"] == "text_input" and job["field"] not in known for job in background_jobs)
+    skip_recall = force_redeliberate or run_requested or condensing
+    similar = [] if skip_recall else find_similar_deliberations({**context, **known})
+    if similar:
+        render_similar_deliberations(similar)
+        return
+
+    # 審議はジョブとして投入し、この実行はすぐに返す。
+    # 再実行・再接続した画面はジョブ ID で同じジョブに戻り、二重クリックは実行中のジョブに合流する
+    job = enqueue_deliberation(
+        context, swot_mode, deliberation_engine, plan=deliberation_plan, force=force_redeliberate,
+        media={pending["field"]: pending["future"] for pending in background_jobs} or None,
+        policy=round_policy, stream=stream_mode,
+    )
+    closed_history = st.session_state.pop("history_view", None) is not None
+    current = st.session_state.get("deliberation_job")
+    if not current or current["id"] != job.id:
+        st.session_state["deliberation_job"] = {"id": job.id, "image": st.session_state.get("report_image")}
+    elif not closed_history:
+        return
+    st.rerun()
+
+
+@st.fragment
+def render_result_panel(fmt: str):
+    """
+    審議結果 (実行中は進捗) と、履歴から開いた審議。ジョブの登録簿を見るのは実行中だけで、完了した結果は
+    解析済みの sections・作成済みのレポートとともにセッションに置き、そこから描画する。
+    ダウンロードやサイドバーの操作で再実行しても審議をやり直さない。
+    """
+    if st.session_state.get("history_view"):
+        render_history_entry(st.session_state["history_view"])
+        return
+    state = st.session_state.get("deliberation_job")
+    if not state:
+        return
+    if "status" not in state:
+        job = get_job_queue().get(state["id"])
+        if job is None:
+            # 完了前に登録簿から消えたジョブ (プロセスの再起動など) は結果を受け取れない
+            st.session_state.pop("deliberation_job", None)
+            return
+        if not job.done:
+            render_job_progress(job.id)
+            return
+        capture_job(job, state)
+    render_job_result(state, fmt)
+
+
+# ======================================================
+# UI 構築
+# ======================================================
+
+# --- サイドバー入力 ---
+input_mode = st.sidebar.radio("DATA INPUT SOURCE", ["File Upload", "Camera", "None"], index=0)
+uploaded_file = None
+if input_mode == "File Upload":
+    uploaded_file = st.sidebar.file_uploader("ARCHIVE DATA", type=["png", "jpg", "jpeg", "wav", "mp3", "txt", "docx"])
+elif input_mode == "Camera":
+    uploaded_file = st.sidebar.camera_input("VISUAL SENSOR")
+
+with st.sidebar.expander("IMAGE PIPELINE"):
+    default_edge = int(os.getenv("MAGI_IMAGE_MAX_EDGE", "1536"))
+    image_max_edge = st.select_slider(
+        "MAX EDGE (PX)", options=sorted({512, 768, 1024, 1536, 2048, default_edge}), value=default_edge
+    )
+    image_format = st.radio("ENCODING", list(IMAGE_FORMATS.keys()), index=0, horizontal=True)
+
+with st.sidebar.expander("AUDIO PIPELINE"):
+    audio_chunked = st.checkbox("CHUNKED TRANSCRIPTION", value=True)
+    audio_window_sec = st.slider("SEGMENT LENGTH (SEC)", 30, 600, 120, step=30, disabled=not audio_chunked)
+    audio_overlap_sec = st.slider("SEGMENT OVERLAP (SEC)", 0, 30, 5, disabled=not audio_chunked)
+
+swot_mode = st.sidebar.checkbox("ACTIVATE SWOT MODULE", value=False)
+engine_label = st.sidebar.radio("DELIBERATION ENGINE", list(DELIBERATION_ENGINES.keys()), index=0)
+deliberation_engine = DELIBERATION_ENGINES[engine_label]
+round_policy = get_round_policy()
+if deliberation_engine == "iterative":
+    with st.sidebar.expander("COUNCIL ROUNDS", expanded=True):
+        majorities = {"SIMPLE MAJORITY": 0.51, "THREE QUARTERS": 0.75, "UNANIMOUS": 1.0}
+        majority_label = st.radio(
+            "STOP AT", list(majorities), horizontal=True,
+            index=list(majorities.values()).index(round_policy.majority) if round_policy.majority in majorities.values() else 2,
+        )
+        round_policy = RoundPolicy(
+            max_rounds=st.slider("MAX ROUNDS", 2, 6, min(6, max(2, round_policy.max_rounds))),
+            majority=majorities[majority_label],
+            token_budget=st.number_input(
+                "REVISION TOKEN BUDGET (0 = UNLIMITED)", min_value=0, value=round_policy.token_budget, step=1000
+            ),
+        )
+stream_mode = st.sidebar.checkbox("PROGRESSIVE OUTPUT (STREAMING)", value=True)
+st.sidebar.caption(
+    f"RATE LIMIT QUEUE: {get_rate_limiter(st.session_state['gemini_model_name']).queue_depth} WAITING"
+)
+job_counts = get_job_queue().counts()
+st.sidebar.caption(
+    f"JOB QUEUE: {job_counts['queued']} QUEUED / {job_counts['running']} RUNNING"
+    f" (MAX {get_job_queue().max_workers})"
+)
+if get_semantic_recall() is not None:
+    st.sidebar.checkbox("SEMANTIC RECALL (SUGGEST SIMILAR PAST DELIBERATIONS)", value=True, key="semantic_recall")
+report_formats = available_report_formats()
+report_format_key = st.sidebar.radio(
+    "REPORT FORMAT", list(report_formats), format_func=lambda key: report_formats[key].label, horizontal=True
+)
+# 一括出力と診断パネルは実行の最後に描画する (今回の審議結果・計測結果を含めるため)
+archive_slot = st.sidebar.empty()
+history_slot = st.sidebar.empty()
+diagnostics_slot = st.sidebar.empty()
+
+# --- メインエリア ---
+route_plan = get_route_plan()
+if uploaded_file:
+    input_col, media_col = st.columns([3, 2])
+    # 入力パネルが解析ジョブを参照するため、メディアパネルを先に実行する
+    with media_col:
+        render_media_panel(
+            uploaded_file, route_plan, image_max_edge, image_format,
+            audio_chunked, audio_window_sec, audio_overlap_sec,
+        )
+else:
+    input_col = st.container()
+    clear_media_state()
+with input_col:
+    render_input_panel(
+        uploaded_file, route_plan, swot_mode, deliberation_engine, round_policy, size_routing, stream_mode,
     )
+
+render_result_panel(report_format_key)
+
+render_report_archive(archive_slot, report_format_key)
+render_history_panel(history_slot)
+render_diagnostics(diagnostics_slot)
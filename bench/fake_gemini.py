@@ -0,0 +1,242 @@
+"""
+ベンチマーク用のローカル Gemini 代替サーバー (REST の generateContent / streamGenerateContent)。
+
+    python -m bench.fake_gemini --port 8089 --latency-ms 800 --tokens-per-sec 200 --error-rate 0.05
+
+応答遅延は対数正規分布 (中央値 latency_ms, 形状 sigma)、ストリーミングは tokens_per_sec の速度で
+チャンクを送り、error_rate の確率で 429 (retry-after つき) を返す。
+リクエスト中の [SECTION:...] マーカーを読み取り、同じ形式の応答を組み立てる。
+generationConfig.responseSchema があれば、そのスキーマに沿った JSON を返す。
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+SECTION_PATTERN = re.compile(r"\[SECTION:([A-Z\-]+)\]")
+
+SECTION_BODIES = {
+    "INTEGRATION": "結論: 条件付き承認\n詳細: 各エージェントの懸念を踏まえ、段階的に進めることを推奨する。",
+    "SWOT": (
+        "Strengths: 技術力、実績、速度、柔軟性、資金\n"
+        "Weaknesses: 人員不足、経験、認知度、コスト、依存\n"
+        "Opportunities: 市場拡大、提携、補助金、需要、規制緩和\n"
+        "Threats: 競合、景気、規制、人材流出、技術変化"
+    ),
+}
+
+
+@dataclass
+class FakeConfig:
+    latency_ms: float = 500.0
+    sigma: float = 0.3
+    tokens_per_sec: float = 200.0
+    chunk_tokens: int = 20
+    error_rate: float = 0.0
+    retry_after: float = 1.0
+    media_tokens: int = 120
+    seed: Optional[int] = None
+
+
+def build_response_text(prompt: str, config: FakeConfig, rng: random.Random) -> str:
+    tags = list(dict.fromkeys(SECTION_PATTERN.findall(prompt)))
+    if not tags:
+        # メディア解析などの自由記述
+        return "観測結果: " + "、".join(f"要素{i}" for i in range(config.media_tokens // 2))
+
+    blocks = []
+    for tag in tags:
+        body = SECTION_BODIES.get(tag)
+        if body is None:
+            decision = rng.choice(["可決", "否決", "保留"])
+            body = f"判定: {decision}\n見解: {tag} の観点から、入力を評価した結果の見解を述べる。"
+        blocks.append(f"[SECTION:{tag}]\n{body}\n")
+    return "\n".join(blocks)
+
+
+# SDK の REST 送信では type が列挙値の番号になる (google.ai.generativelanguage の Type)
+SCHEMA_TYPES = {1: "STRING", 2: "NUMBER", 3: "INTEGER", 4: "BOOLEAN", 5: "ARRAY", 6: "OBJECT"}
+
+
+def build_from_schema(schema: dict, rng: random.Random, name: str = ""):
+    """responseSchema に沿った値を作る (type は列挙名・番号のどちらでもよい)"""
+    kind = schema.get("type", "")
+    kind = SCHEMA_TYPES.get(kind, "") if isinstance(kind, int) else str(kind).upper()
+    if kind == "OBJECT":
+        return {key: build_from_schema(sub, rng, key) for key, sub in schema.get("properties", {}).items()}
+    if kind == "ARRAY":
+        return [build_from_schema(schema.get("items", {}), rng, name) for _ in range(5)]
+    if schema.get("enum"):
+        return rng.choice(schema["enum"])
+    if kind in ("INTEGER", "NUMBER"):
+        return rng.randint(0, 100)
+    if kind == "BOOLEAN":
+        return rng.random() < 0.5
+    return f"{name} の観点から、入力を評価した結果の見解を述べる。"
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 2)
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "FakeGeminiServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", "0"))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        config = self.server.config
+        rng = self.server.rng()
+        self.server.count_request()
+
+        time.sleep(rng.lognormvariate(0, config.sigma) * config.latency_ms / 1000.0)
+
+        if self.path.split("?")[0].endswith("/cachedContents"):
+            # 実サービス同様、固定プロンプトが最小トークン数に満たないキャッシュ作成は拒否する
+            self._send_json(400, {
+                "error": {
+                    "code": 400,
+                    "message": "Cached content is too small. min_total_token_count=32768",
+                    "status": "INVALID_ARGUMENT",
+                }
+            })
+            return
+
+        if rng.random() < config.error_rate:
+            self._send_json(429, {
+                "error": {
+                    "code": 429,
+                    "message": f"Resource has been exhausted (e.g. check quota). Please retry in {config.retry_after}s.",
+                    "status": "RESOURCE_EXHAUSTED",
+                }
+            })
+            return
+
+        contents = [request.get("systemInstruction") or {}, *request.get("contents", [])]
+        prompt = "\n".join(part.get("text", "") for content in contents for part in content.get("parts", []))
+        schema = (request.get("generationConfig") or {}).get("responseSchema")
+        if schema:
+            text = json.dumps(build_from_schema(schema, rng), ensure_ascii=False)
+        else:
+            text = build_response_text(prompt, config, rng)
+        usage = {
+            "promptTokenCount": estimate_tokens(prompt),
+            "candidatesTokenCount": estimate_tokens(text),
+            "totalTokenCount": estimate_tokens(prompt) + estimate_tokens(text),
+        }
+
+        if ":streamGenerateContent" not in self.path:
+            self._send_json(200, make_payload(text, usage))
+            return
+
+        # JSON 配列を少しずつ送る (REST トランスポートのストリーミング形式)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        step = config.chunk_tokens * 2
+        pieces = [text[i:i + step] for i in range(0, len(text), step)] or [""]
+        self._chunk(b"[")
+        for i, piece in enumerate(pieces):
+            if i:
+                time.sleep(config.chunk_tokens / config.tokens_per_sec)
+                self._chunk(b",")
+            last = i == len(pieces) - 1
+            self._chunk(json.dumps(make_payload(piece, usage if last else None), ensure_ascii=False).encode("utf-8"))
+        self._chunk(b"]")
+        self._chunk(b"")
+
+
+def make_payload(text: str, usage: Optional[dict]) -> dict:
+    payload = {
+        "candidates": [{
+            "content": {"parts": [{"text": text}], "role": "model"},
+            "finishReason": 1,
+            "index": 0,
+        }]
+    }
+    if usage:
+        payload["usageMetadata"] = usage
+    return payload
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, config: Optional[FakeConfig] = None):
+        super().__init__(("127.0.0.1", port), FakeGeminiHandler)
+        self.config = config or FakeConfig()
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._seed = random.Random(self.config.seed)
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def rng(self) -> random.Random:
+        with self._lock:
+            return random.Random(self._seed.random())
+
+    def count_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def start(self) -> "FakeGeminiServer":
+        threading.Thread(target=self.serve_forever, name="fake-gemini", daemon=True).start()
+        return self
+
+
+def add_config_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency-ms", type=float, default=500.0, help="median response latency")
+    parser.add_argument("--sigma", type=float, default=0.3, help="lognormal shape of the latency distribution")
+    parser.add_argument("--tokens-per-sec", type=float, default=200.0, help="streaming rate")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of answering 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="retry hint sent with each 429")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def config_from_args(args: argparse.Namespace) -> FakeConfig:
+    return FakeConfig(
+        latency_ms=args.latency_ms,
+        sigma=args.sigma,
+        tokens_per_sec=args.tokens_per_sec,
+        error_rate=args.error_rate,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="local Gemini stand-in for benchmarks")
+    parser.add_argument("--port", type=int, default=8089)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    server = FakeGeminiServer(args.port, config_from_args(args))
+    print(f"fake Gemini listening on {server.endpoint}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+"""
+性能ベンチマーク。ローカルの偽 Gemini サーバーに対して主要な処理を並列に実行し、
+スループット・p50/p95/p99 レイテンシ・ピーク RSS を計測する (実際の API クォータは消費しない)。
+
+    python -m bench.run_bench --concurrency 8 --iterations 40 --save bench/baseline.json
+    python -m bench.run_bench --compare bench/baseline.json --tolerance 0.15
+
+cold_import / app_cold_start は新しいプロセスで import magi / アプリの初回実行までの時間を測る
+(起動時間の計測。--concurrency 1 で実行する):
+
+    python -m bench.run_bench --scenario cold_import --scenario app_cold_start --concurrency 1 --iterations 5
+
+各シナリオは新しいプロセスで実行する (ピーク RSS を先に実行したシナリオと切り離すため)。
+
+--compare を指定すると、ベースラインよりスループットが下がった / p95 が伸びたシナリオを報告し、
+回帰があれば終了コード 1 を返す。
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from typing import Callable, Dict, List, Optional
+
+import google.generativeai as genai
+import numpy as np
+
+from magi import (
+    DEFAULT_MODEL,
+    EMPTY_CONTEXT,
+    MODEL_CHOICES,
+    RoutePlan,
+    VectorIndex,
+    analyze_media,
+    call_magi_core,
+    call_magi_parallel,
+    call_magi_rounds,
+    call_magi_structured,
+    condense_text,
+    create_docx,
+    enqueue_deliberation,
+    parse_magi_output,
+    start_media_analysis,
+)
+
+from .fake_gemini import FakeGeminiServer, add_config_arguments, config_from_args
+
+SAMPLE_OUTPUT = """
+[SECTION:MAGI-LOGIC]
+判定: 可決
+見解: 数値上の根拠は十分であり、合理的な判断である。
+
+[SECTION:MAGI-HUMAN]
+判定: 保留
+見解: 関係者の感情面への配慮が不足しているのではないでしょうか。
+
+[SECTION:MAGI-REALITY]
+判定: 否決
+見解: 予算と政治的な調整コストに見合わない。
+
+[SECTION:MAGI-MEDIA]
+判定: 可決
+見解: 表現としての訴求力は高い。
+
+[SECTION:INTEGRATION]
+結論: 条件付き承認
+詳細: 各エージェントの懸念を踏まえ、段階的に進めることを推奨する。
+[SECTION:SWOT]
+Strengths: 技術力、実績、速度、柔軟性、資金
+Weaknesses: 人員不足、経験、認知度、コスト、依存
+Opportunities: 市場拡大、提携、補助金、需要、規制緩和
+Threats: 競合、景気、規制、人材流出、技術変化
+"""
+
+
+# CPU のみのシナリオ (p95 がサブミリ秒) で揺らぎを回帰と誤判定しないための下限 (秒)
+MIN_LATENCY_DELTA = 0.001
+
+
+def make_context(i: int) -> Dict[str, str]:
+    # 反復ごとに入力を変え、キャッシュに当たらないようにする
+    return {
+        **EMPTY_CONTEXT,
+        "user_question": f"案件 {i}: 新規事業に投資すべきか?",
+        "text_input": "市場規模は拡大傾向にあるが、競合も多い。" * 20,
+    }
+
+
+def media_bytes(i: int) -> bytes:
+    return i.to_bytes(8, "big") + os.urandom(64 * 1024)
+
+
+def make_document(i: int, lines: int = 4000) -> str:
+    # 約 100 ページ分。行ごとに番号を入れ、区間の要約がキャッシュに当たらないようにする
+    return "\n".join(f"{i}-{n}: 市場規模は拡大傾向にあるが、競合も多い。価格競争が続いている。" for n in range(lines))
+
+
+def check(result: str) -> None:
+    if not result or result.startswith(("SYSTEM FAILURE", "ERROR:")):
+        raise RuntimeError((result or "empty response")[:200])
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 新しいプロセスでアプリの初回実行 (新規セッションが操作可能になるまで) を行う
+APP_FIRST_RUN = """
+import sys
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(sys.argv[1], default_timeout=120).run()
+sys.exit(1 if at.exception else 0)
+"""
+
+
+def run_fresh_process(code: str, *args: str) -> None:
+    """起動時間の計測用。API キーを外し、履歴は一時ディレクトリに書く"""
+    env = {key: value for key, value in os.environ.items() if key != "GEMINI_API_KEY"}
+    with tempfile.TemporaryDirectory(prefix="magi-bench-") as tmp:
+        env["MAGI_HISTORY_DB"] = os.path.join(tmp, "history.sqlite3")
+        subprocess.run([sys.executable, "-c", code, *args], cwd=ROOT, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def synthetic_index(directory: str, rows: int, dim: int = 384) -> VectorIndex:
+    """類似検索用に、正規化済みの乱数ベクトル rows 件を directory の索引に書き込む"""
+    index = VectorIndex(directory, dim)
+    rng = np.random.default_rng(0)
+    for start in range(0, rows, 50_000):
+        vectors = rng.standard_normal((min(50_000, rows - start), dim), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        index.add(range(start + 1, start + 1 + len(vectors)), vectors)
+    return index
+
+
+def build_scenarios(
+    plan: RoutePlan, concurrency: int, index: Optional[VectorIndex] = None
+) -> Dict[str, Callable[[int], None]]:
+    sections = parse_magi_output(SAMPLE_OUTPUT)
+
+    def core(i):
+        check(call_magi_core(make_context(i), True, plan=plan))
+
+    def core_duplicates(i):
+        # 同時に走る concurrency 件ずつが同じ入力 (デモで同じ例題が一斉に送られる状況)
+        check(call_magi_core(make_context(i // concurrency), True, plan=plan))
+
+    def core_stream(i):
+        check(call_magi_core(make_context(i), True, on_section=lambda tag, sec: None, plan=plan))
+
+    def parallel(i):
+        check(call_magi_parallel(make_context(i), True, plan=plan))
+
+    def rounds(i):
+        check(call_magi_rounds(make_context(i), True, plan=plan))
+
+    def job(i):
+        # ジョブキュー経由 (同時実行数は MAGI_JOB_WORKERS で頭打ちになる)
+        job = enqueue_deliberation(make_context(i), True, "parallel", plan)
+        job.future.result()
+        check(job.error or job.result)
+
+    def structured(i):
+        check(call_magi_structured(make_context(i), True, plan=plan))
+
+    def ingest(i):
+        check(condense_text(make_document(i), plan))
+
+    def ingest_cached(i):
+        # 同じ文書の再投入 (区間の要約はすべてキャッシュから返る)
+        check(condense_text(make_document(0), plan))
+
+    def media(i):
+        check(analyze_media(media_bytes(i), "image/jpeg", "この画像を描写してください。", plan))
+
+    def media_then_parallel(i):
+        # アップロード → 解析完了 → 審議開始 (直列)
+        context = make_context(i)
+        context["image_description"] = analyze_media(media_bytes(i), "image/jpeg", "この画像を描写してください。", plan)
+        check(call_magi_parallel(context, True, plan=plan))
+
+    def media_pipelined(i):
+        # 解析をバックグラウンドで開始し、テキストのみのエージェントを先に走らせる
+        future = start_media_analysis(
+            "image_description", analyze_media, media_bytes(i), "image/jpeg", "この画像を描写してください。", plan
+        )
+        check(call_magi_parallel(make_context(i), True, plan=plan, media={"image_description": future}))
+
+    def parse(i):
+        parse_magi_output(SAMPLE_OUTPUT)
+
+    def docx(i):
+        create_docx(make_context(i), sections)
+
+    def cold_import(i):
+        run_fresh_process("import magi")
+
+    def app_cold_start(i):
+        run_fresh_process(APP_FIRST_RUN, os.path.join(ROOT, "app.py"))
+
+    def vector_search(i):
+        query = np.random.default_rng(i).standard_normal(index.dim, dtype=np.float32)
+        index.search(query / np.linalg.norm(query), k=3)
+
+    return {
+        "call_magi_core": core,
+        "call_magi_core_duplicates": core_duplicates,
+        "call_magi_core_stream": core_stream,
+        "call_magi_parallel": parallel,
+        "call_magi_rounds": rounds,
+        "call_magi_structured": structured,
+        "enqueue_deliberation": job,
+        "analyze_media": media,
+        "ingest_document": ingest,
+        "ingest_document_cached": ingest_cached,
+        "media_then_parallel": media_then_parallel,
+        "media_pipelined": media_pipelined,
+        "parse_magi_output": parse,
+        "create_docx": docx,
+        "vector_search": vector_search,
+        "cold_import": cold_import,
+        "app_cold_start": app_cold_start,
+    }
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def peak_rss_mb() -> float:
+    # Linux では KB、macOS ではバイト単位
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_scenario(fn: Callable[[int], None], iterations: int, concurrency: int) -> Dict[str, float]:
+    latencies: List[float] = []
+    errors = 0
+
+    def timed(i):
+        start = time.perf_counter()
+        try:
+            fn(i)
+            return time.perf_counter() - start, None
+        except Exception as e:
+            return time.perf_counter() - start, e
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for seconds, error in pool.map(timed, range(iterations)):
+            latencies.append(seconds)
+            errors += error is not None
+    wall = time.perf_counter() - start
+
+    return {
+        "iterations": iterations,
+        "errors": errors,
+        "throughput": round(iterations / wall, 3),
+        "p50": round(percentile(latencies, 50), 4),
+        "p95": round(percentile(latencies, 95), 4),
+        "p99": round(percentile(latencies, 99), 4),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def measure_scenario(name: str, args: argparse.Namespace) -> Dict[str, float]:
+    """
+    1つのシナリオを計測する (measure_isolated から新しいプロセスで呼ばれる)。
+    偽サーバーと類似検索の索引はこのプロセスで作り、履歴・キャッシュを含む一時ディレクトリは終了時に削除する。
+    """
+    server = FakeGeminiServer(0, config_from_args(args)).start()
+    genai.configure(api_key="bench", transport="rest", client_options={"api_endpoint": server.endpoint})
+    if not args.respect_rate_limits:
+        for spec in MODEL_CHOICES.values():
+            spec.update(rpm=1_000_000, tpm=1_000_000_000)
+
+    try:
+        with tempfile.TemporaryDirectory(prefix="magi-bench-") as tmp:
+            # 審議履歴・類似検索の索引・結果キャッシュは、ストアが作られる前に一時ディレクトリへ向ける
+            os.environ["MAGI_HISTORY_DB"] = os.path.join(tmp, "history.sqlite3")
+            os.environ["MAGI_SEMANTIC_INDEX_DIR"] = os.path.join(tmp, "semantic")
+            os.environ["MAGI_RESULT_CACHE_PATH"] = os.path.join(tmp, "results.sqlite3")
+            # 索引の作成は計測に含めない
+            index = synthetic_index(os.path.join(tmp, "vectors"), args.index_rows) if name == "vector_search" else None
+            scenario = build_scenarios(RoutePlan((args.model,)), args.concurrency, index)[name]
+            result = run_scenario(scenario, args.iterations, args.concurrency)
+    finally:
+        server.shutdown()
+    result["server_requests"] = server.requests
+    return result
+
+
+def measure_isolated(name: str, args: argparse.Namespace) -> Dict[str, float]:
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+        return pool.submit(measure_scenario, name, args).result()
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float) -> List[str]:
+    regressions = []
+    for name, current in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if current["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {base['throughput']} -> {current['throughput']} /s")
+        if current["p95"] > base["p95"] * (1 + tolerance) + MIN_LATENCY_DELTA:
+            regressions.append(f"{name}: p95 {base['p95']} -> {current['p95']} s")
+        if current["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{name}: peak RSS {base['peak_rss_mb']} -> {current['peak_rss_mb']} MB")
+    return regressions
+
+
+def print_table(results: Dict[str, Dict]) -> None:
+    header = f"{'scenario':<24}{'ok/err':>10}{'req/s':>10}{'p50':>9}{'p95':>9}{'p99':>9}{'RSS MB':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        ok = f"{r['iterations'] - r['errors']}/{r['errors']}"
+        print(f"{name:<24}{ok:>10}{r['throughput']:>10.2f}{r['p50']:>9.3f}{r['p95']:>9.3f}{r['p99']:>9.3f}"
+              f"{r['peak_rss_mb']:>9.1f}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bench.run_bench", description="MAGI benchmark harness")
+    parser.add_argument("--scenario", action="append", help="run only these scenarios (repeatable)")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--respect-rate-limits", action="store_true",
+                        help="keep the per-model rpm/tpm limits (off by default so the fake server is the bottleneck)")
+    parser.add_argument("--save", help="write the results as a baseline JSON")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative regression")
+    parser.add_argument("--index-rows", type=int, default=100_000, help="synthetic vectors for vector_search")
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+
+    scenarios = build_scenarios(RoutePlan((args.model,)), args.concurrency)
+    names = args.scenario or list(scenarios)
+    unknown = set(names) - set(scenarios)
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(sorted(unknown))} (choose from {', '.join(scenarios)})")
+
+    results = {}
+    requests = 0
+    for name in names:
+        results[name] = measure_isolated(name, args)
+        requests += results[name].pop("server_requests")
+
+    print_table(results)
+    print(f"\nfake server requests: {requests}")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
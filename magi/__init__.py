@@ -0,0 +1,168 @@
+"""
+MAGI SYSTEM のコアロジック。Streamlit UI (app.py) と CLI (python -m magi) の両方から使う。
+"""
+from .budget import PromptBudget, PromptEstimate, fit_context, get_prompt_budget, route_by_size
+from .cache import MediaCache, MemoryResultStore, ResultCache, SQLiteResultStore, get_media_cache, get_result_cache
+from .core import (
+    DELIBERATION_ENGINES,
+    EMPTY_CONTEXT,
+    DeliberationError,
+    MagiStreamParser,
+    RoundPolicy,
+    build_user_data,
+    call_magi_core,
+    call_magi_parallel,
+    call_magi_rounds,
+    call_magi_structured,
+    deliberate,
+    estimate_deliberation,
+    get_round_policy,
+    parse_magi_output,
+    parse_section,
+    run_deliberation,
+)
+from .documents import (
+    DOCUMENT_MIME_TYPES,
+    DocumentPolicy,
+    combine_document,
+    combine_text,
+    condense_text,
+    get_document_policy,
+    ingest_document,
+    needs_condensing,
+)
+from .executors import (
+    get_agent_executor,
+    get_media_executor,
+    get_report_executor,
+    notify,
+    register_context_propagator,
+    set_notifier,
+    submit_with_context,
+)
+from .history import HistoryEntry, HistoryStore, get_history_store
+from .jobs import DeliberationJob, JobQueue, enqueue_deliberation, get_job_queue
+from .media import (
+    IMAGE_FORMATS,
+    PreparedImage,
+    analyze_media,
+    prepare_image,
+    start_media_analysis,
+    transcribe_audio_chunked,
+)
+from .metrics import MetricsRegistry, get_metrics, record, stage, start_trace
+from .models import DEFAULT_MODEL, MODEL_CHOICES, BackendUnavailable, configure_api, get_gemini_model, get_model_spec
+from .ratelimit import RateLimiter, generate_with_retry, get_rate_limiter
+from .report import (
+    REPORT_FORMATS,
+    ReportFormat,
+    ReportFormatUnavailable,
+    available_report_formats,
+    create_docx,
+    create_markdown,
+    create_pdf,
+    render_report,
+    submit_report,
+    write_reports_zip,
+)
+from .routing import ModelRouter, RoutePlan, generate_routed, get_model_router
+from .schema import RESPONSE_SCHEMAS, SchemaError, parse_magi_json
+from .semantic import LocalEmbedder, SemanticRecall, SimilarDeliberation, VectorIndex, get_semantic_recall
+from .singleflight import SingleFlight, get_single_flight, request_key
+
+__all__ = [
+    "PromptBudget",
+    "PromptEstimate",
+    "fit_context",
+    "get_prompt_budget",
+    "route_by_size",
+    "MediaCache",
+    "MemoryResultStore",
+    "ResultCache",
+    "SQLiteResultStore",
+    "get_media_cache",
+    "get_result_cache",
+    "DELIBERATION_ENGINES",
+    "EMPTY_CONTEXT",
+    "DeliberationError",
+    "MagiStreamParser",
+    "RoundPolicy",
+    "build_user_data",
+    "call_magi_core",
+    "call_magi_parallel",
+    "call_magi_rounds",
+    "call_magi_structured",
+    "deliberate",
+    "estimate_deliberation",
+    "get_round_policy",
+    "parse_magi_output",
+    "parse_section",
+    "run_deliberation",
+    "DOCUMENT_MIME_TYPES",
+    "DocumentPolicy",
+    "combine_document",
+    "combine_text",
+    "condense_text",
+    "get_document_policy",
+    "ingest_document",
+    "needs_condensing",
+    "get_agent_executor",
+    "get_media_executor",
+    "get_report_executor",
+    "notify",
+    "register_context_propagator",
+    "set_notifier",
+    "submit_with_context",
+    "HistoryEntry",
+    "HistoryStore",
+    "get_history_store",
+    "DeliberationJob",
+    "JobQueue",
+    "enqueue_deliberation",
+    "get_job_queue",
+    "IMAGE_FORMATS",
+    "PreparedImage",
+    "analyze_media",
+    "prepare_image",
+    "start_media_analysis",
+    "transcribe_audio_chunked",
+    "MetricsRegistry",
+    "get_metrics",
+    "record",
+    "stage",
+    "start_trace",
+    "DEFAULT_MODEL",
+    "MODEL_CHOICES",
+    "BackendUnavailable",
+    "configure_api",
+    "get_gemini_model",
+    "get_model_spec",
+    "RateLimiter",
+    "generate_with_retry",
+    "get_rate_limiter",
+    "REPORT_FORMATS",
+    "ReportFormat",
+    "ReportFormatUnavailable",
+    "available_report_formats",
+    "create_docx",
+    "create_markdown",
+    "create_pdf",
+    "render_report",
+    "submit_report",
+    "write_reports_zip",
+    "ModelRouter",
+    "RoutePlan",
+    "generate_routed",
+    "get_model_router",
+    "RESPONSE_SCHEMAS",
+    "SchemaError",
+    "parse_magi_json",
+    "LocalEmbedder",
+    "SemanticRecall",
+    "SimilarDeliberation",
+    "VectorIndex",
+    "get_semantic_recall",
+    "SingleFlight",
+    "get_single_flight",
+    "request_key",
+]
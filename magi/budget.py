@@ -0,0 +1,147 @@
+"""
+プロンプトの予算: 送信前にトークン数をローカルで見積もり、入力欄ごとの上限に収め、
+プロンプトの大きさで送り先のモデルを選び、概算の料金を出す。
+"""
+import logging
+import os
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional
+
+from .documents import condense_text, get_document_policy, truncate_tokens
+from .metrics import record
+from .models import MODEL_CHOICES, get_model_spec
+from .ratelimit import estimate_content_tokens
+from .routing import RoutePlan
+
+logger = logging.getLogger("magi")
+
+# 要約して上限に収める欄 (それ以外は切り詰める)
+COMPRESSIBLE_FIELDS = ("text_input", "audio_transcript")
+
+
+@dataclass(frozen=True)
+class PromptBudget:
+    """
+    *_tokens: context の欄ごとの上限 (ADDITIONAL_TEXT などに入る量)
+    context_headroom: 1リクエストが選択中のモデルの文脈長のこの割合を超えたら、文脈長の最も長いモデルに送る
+    """
+    question_tokens: int = 1000
+    text_tokens: int = 4000
+    image_tokens: int = 1500
+    audio_tokens: int = 4000
+    context_headroom: float = 0.8
+
+    def field_limits(self) -> Dict[str, int]:
+        return {
+            "user_question": self.question_tokens,
+            "text_input": self.text_tokens,
+            "image_description": self.image_tokens,
+            "audio_transcript": self.audio_tokens,
+        }
+
+
+@lru_cache(maxsize=None)
+def get_prompt_budget() -> PromptBudget:
+    return PromptBudget(
+        question_tokens=int(os.getenv("MAGI_BUDGET_QUESTION_TOKENS", "1000")),
+        text_tokens=int(os.getenv("MAGI_BUDGET_TEXT_TOKENS", str(get_document_policy().digest_tokens))),
+        image_tokens=int(os.getenv("MAGI_BUDGET_IMAGE_TOKENS", "1500")),
+        audio_tokens=int(os.getenv("MAGI_BUDGET_AUDIO_TOKENS", "4000")),
+        context_headroom=float(os.getenv("MAGI_CONTEXT_HEADROOM", "0.8")),
+    )
+
+
+# ======================================================
+# 入力欄の上限
+# ======================================================
+def trim_context(context: Dict[str, Any], budget: Optional[PromptBudget] = None) -> Dict[str, Any]:
+    """各欄を上限で切り詰めた写し (モデルは呼ばない)"""
+    limits = (budget or get_prompt_budget()).field_limits()
+    return {key: truncate_tokens(value, limits[key]) if key in limits and isinstance(value, str) else value
+            for key, value in context.items()}
+
+
+def fit_context(
+    context: Dict[str, Any],
+    plan: Optional[RoutePlan] = None,
+    budget: Optional[PromptBudget] = None,
+    fields: Optional[Iterable[str]] = None,
+) -> List[str]:
+    """
+    上限を超えた欄を context 上で収める。補足テキスト・書き起こしは要約し、それ以外は切り詰める。
+    fields で対象の欄を絞れる (解析中のメディアを除くため)。収めた欄の名前を返す。
+    """
+    budget = budget or get_prompt_budget()
+    limits = budget.field_limits()
+    changed = []
+    for field in fields if fields is not None else limits:
+        text = context.get(field) or ""
+        limit = limits.get(field)
+        if limit is None or estimate_content_tokens(text) <= limit:
+            continue
+        if field in COMPRESSIBLE_FIELDS and not text.startswith("ERROR:"):
+            text = condense_text(text, plan, replace(get_document_policy(), digest_tokens=limit))
+        context[field] = truncate_tokens(text, limit)
+        changed.append(field)
+    record(fields_fitted=len(changed))
+    return changed
+
+
+# ======================================================
+# 見積もり
+# ======================================================
+@dataclass(frozen=True)
+class PromptEstimate:
+    """1回の審議の見積もり (反復審議は最大ラウンド数まで進んだ場合)"""
+    model: str
+    requests: int
+    input_tokens: int
+    output_tokens: int
+    largest_prompt: int
+    exact: bool = False
+
+    @property
+    def cost_usd(self) -> float:
+        price_in, price_out = get_model_spec(self.model).get("price", (0.0, 0.0))
+        return (self.input_tokens * price_in + self.output_tokens * price_out) / 1_000_000
+
+
+def count_tokens(model_name: str, content, system_instruction: Optional[str] = None) -> Optional[int]:
+    """
+    Gemini の count_tokens で正確なトークン数を数える (MAGI_COUNT_TOKENS=1 の場合だけ。1リクエスト分の通信が発生する)。
+    数えられない場合は None。
+    """
+    if os.getenv("MAGI_COUNT_TOKENS", "0") != "1" or get_model_spec(model_name)["backend"] != "gemini":
+        return None
+    from .models import gemini_client
+
+    try:
+        return gemini_client(model_name, system_instruction).count_tokens(content).total_tokens
+    except Exception as e:
+        logger.info("count_tokens failed for %s: %s", model_name, e)
+        return None
+
+
+def route_by_size(plan: RoutePlan, prompt_tokens: int, budget: Optional[PromptBudget] = None) -> RoutePlan:
+    """
+    プロンプトの大きさで送り先を選ぶ (利用者が明示的に有効にした場合だけ使う)。
+    選択中のモデルの文脈長の context_headroom を超える場合は同じバックエンドで文脈長の最も長いモデル、
+    それ以外は高速なモデル (選択中のものが高速ならそのまま) にする。元の送り先はフェイルオーバー先として残す。
+    """
+    budget = budget or get_prompt_budget()
+    primary = get_model_spec(plan.primary)
+    candidates = [spec for spec in MODEL_CHOICES.values() if spec["backend"] == primary["backend"]]
+    if prompt_tokens > primary["context"] * budget.context_headroom:
+        chosen = max(candidates, key=lambda spec: spec["context"])
+    elif primary["tier"] == "fast":
+        chosen = primary
+    else:
+        fast = [
+            spec for spec in candidates
+            if spec["tier"] == "fast" and prompt_tokens <= spec["context"] * budget.context_headroom
+        ]
+        chosen = min(fast, key=lambda spec: spec["price"][0]) if fast else primary
+    if chosen["name"] == plan.primary:
+        return plan
+    return RoutePlan((chosen["name"], *[m for m in plan.models if m != chosen["name"]]), plan.hedge_percentile)
@@ -0,0 +1,284 @@
+"""
+キャッシュ層: メディア解析結果 (内容ハッシュ) と審議結果 (正規化コンテキストのハッシュ)。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
+
+
+# ======================================================
+# メディア解析キャッシュ (メモリ LRU + 任意のディスク層)
+# ======================================================
+class MediaCache:
+    """
+    メディア解析結果のキャッシュ。
+    キーはファイル内容・MIME・プロンプト・モデル名のハッシュ。
+    メモリ上の LRU 層と、TTL / 容量上限つきのディスク層の2段構成。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 128,
+        disk_dir: Optional[str] = None,
+        ttl_seconds: float = 7 * 24 * 3600,
+        max_disk_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(data: bytes, mime_type: str, prompt: str, model_name: str) -> str:
+        h = hashlib.sha256()
+        for part in (model_name, mime_type, prompt):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        h.update(data)
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+
+        value = self._disk_get(key)
+        if value is not None:
+            self._memory_put(key, value)
+        return value
+
+    def put(self, key: str, value: str) -> None:
+        self._memory_put(key, value)
+        self._disk_put(key, value)
+
+    def _memory_put(self, key: str, value: str) -> None:
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    # --- ディスク層 ---
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _disk_get(self, key: str) -> Optional[str]:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - entry.get("created", 0) > self.ttl_seconds:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        # 読み出し時に mtime を更新し、容量超過時の削除順を LRU に近づける
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry.get("value")
+
+    def _disk_put(self, key: str, value: str) -> None:
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created": time.time(), "value": value}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        entries = []
+        total = 0
+        now = time.time()
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                # 最終アクセスから TTL 以上経過したものは確実に期限切れなので先に掃除する
+                if now - stat.st_mtime > self.ttl_seconds:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        if total <= self.max_disk_bytes:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            if total <= self.max_disk_bytes:
+                break
+
+
+@lru_cache(maxsize=None)
+def get_media_cache() -> MediaCache:
+    """プロセス全体 (全セッション共通) で共有するメディア解析キャッシュ"""
+    return MediaCache(
+        max_entries=int(os.getenv("MAGI_MEDIA_CACHE_ENTRIES", "128")),
+        disk_dir=os.getenv("MAGI_MEDIA_CACHE_DIR") or None,
+        ttl_seconds=float(os.getenv("MAGI_MEDIA_CACHE_TTL", str(7 * 24 * 3600))),
+        max_disk_bytes=int(os.getenv("MAGI_MEDIA_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    )
+
+
+# ======================================================
+# 審議結果キャッシュ (正規化したコンテキストのハッシュで検索)
+# ======================================================
+def normalize_text(text: str) -> str:
+    """全角/半角・前後の空白・連続する空白の違いを吸収する"""
+    return " ".join(unicodedata.normalize("NFKC", text or "").split())
+
+
+class MemoryResultStore:
+    """プロセス内メモリに保持する LRU ストア"""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[float, str]]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SQLiteResultStore:
+    """ローカルディスク上の SQLite に保持するストア (最終アクセス順で件数上限を超えた分を削除)"""
+
+    def __init__(self, path: str, max_entries: int = 10_000):
+        self.max_entries = max_entries
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+
+    def get(self, key: str) -> Optional[Tuple[float, str]]:
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT created, value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+        return row
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self._conn.execute(
+                "DELETE FROM results WHERE key IN ("
+                " SELECT key FROM results ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def delete(self, key: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+
+
+class ResultCache:
+    """call_magi_core の生テキストを、コンテキスト・モデル・SWOT 指定ごとにキャッシュする"""
+
+    def __init__(self, store, ttl_seconds: float = 24 * 3600):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+
+    @staticmethod
+    def make_key(context: Dict[str, Any], model_name: str, enable_swot: bool, variant: Optional[str] = None) -> str:
+        """variant には結果が異なるエンジン設定 (反復審議の打ち切り条件など) を渡す"""
+        canonical = {
+            "context": {k: normalize_text(str(v)) for k, v in context.items()},
+            "model": model_name,
+            "swot": bool(enable_swot),
+        }
+        if variant:
+            canonical["variant"] = variant
+        payload = json.dumps(canonical, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self.store.get(key)
+        if entry is None:
+            return None
+        created, value = entry
+        if time.time() - created > self.ttl_seconds:
+            self.store.delete(key)
+            return None
+        return value
+
+    def put(self, key: str, value: str) -> None:
+        self.store.put(key, value)
+
+
+RESULT_STORES = {
+    "memory": lambda: MemoryResultStore(int(os.getenv("MAGI_RESULT_CACHE_ENTRIES", "256"))),
+    "sqlite": lambda: SQLiteResultStore(
+        os.getenv("MAGI_RESULT_CACHE_PATH", os.path.join(".magi_cache", "results.sqlite3")),
+        int(os.getenv("MAGI_RESULT_CACHE_ENTRIES", "10000")),
+    ),
+}
+
+
+@lru_cache(maxsize=None)
+def get_result_cache() -> ResultCache:
+    store = RESULT_STORES[os.getenv("MAGI_RESULT_CACHE", "memory")]()
+    return ResultCache(store, ttl_seconds=float(os.getenv("MAGI_RESULT_CACHE_TTL", str(24 * 3600))))
@@ -0,0 +1,294 @@
+"""
+ヘッドレスの一括審議 CLI。
+
+    python -m magi dilemmas.jsonl -o results.jsonl --concurrency 8 --reports-dir reports/
+    python -m magi dilemmas.jsonl -o results.jsonl --reports-zip reports.zip --report-format pdf
+
+入力は JSONL または CSV。各行のフィールド:
+    id (省略時は行番号), question, text, image (画像パス), audio (音声パス), document (.txt / .docx のパス), swot (真偽値)
+長い text や document は区間ごとに要約し、上限内の要約を ADDITIONAL_TEXT として使う。
+出力 JSONL は1件ごとに追記され、--resume で成功済みの id を飛ばして再開できる。
+計測結果は MAGI_METRICS_JSONL (トレースの JSONL) と --metrics-prom (Prometheus テキスト) で書き出せる。
+"""
+import argparse
+import contextlib
+import csv
+import json
+import logging
+import mimetypes
+import os
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterator, Optional, Set
+
+from .budget import route_by_size
+from .core import (
+    DELIBERATION_ENGINES,
+    EMPTY_CONTEXT,
+    DeliberationError,
+    RoundPolicy,
+    deliberate,
+    estimate_deliberation,
+    get_round_policy,
+)
+from .documents import condense_text, ingest_document, needs_condensing
+from .media import analyze_media, prepare_image, start_media_analysis, transcribe_audio_chunked
+from .metrics import get_metrics, start_trace
+from .models import DEFAULT_MODEL, MODEL_CHOICES, configure_api
+from .report import REPORT_FORMATS, render_report
+from .routing import RoutePlan
+
+logger = logging.getLogger("magi.cli")
+
+IMAGE_PROMPT = "この画像に写っているものを客観的に、詳細に描写してください。感情的な印象も含めてください。"
+AUDIO_PROMPT = "この音声を日本語に書き起こしてください。"
+
+
+def read_items(path: str) -> Iterator[Dict[str, Any]]:
+    """JSONL / CSV から審議対象を1件ずつ読み出す (全件をメモリに載せない)"""
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = parse_jsonl(f)
+        for index, row in enumerate(rows, start=1):
+            item = dict(row)
+            item["id"] = str(item.get("id") or index)
+            yield item
+
+
+def parse_jsonl(f) -> Iterator[Dict[str, Any]]:
+    """JSONL を1行ずつ解釈する。壊れた行は行番号付きのエラー項目として返し、バッチ全体は止めない"""
+    for lineno, line in enumerate(f, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError("expected a JSON object")
+        except ValueError as e:
+            yield {"_error": f"line {lineno}: invalid JSON ({e})"}
+            continue
+        yield row
+
+
+def read_checkpoint(path: str) -> Set[str]:
+    """既存の出力から成功済みの id を集める"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 中断時に書きかけになった最終行は無視する
+                continue
+            if record.get("status") == "ok":
+                done.add(str(record["id"]))
+    return done
+
+
+def parse_bool(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    return str(value or "").strip().lower() in ("1", "true", "yes", "y", "on")
+
+
+def resolve_path(path: str, base_dir: str) -> str:
+    return path if os.path.isabs(path) else os.path.join(base_dir, path)
+
+
+def ingest_document_file(path: str, mime_type: str, plan: RoutePlan, text: str) -> str:
+    """文書をディスクから逐次読みながら要約する"""
+    with open(path, "rb") as f:
+        return ingest_document(f, mime_type, plan, text)
+
+
+def process_item(item: Dict[str, Any], args: argparse.Namespace, plan: RoutePlan) -> Dict[str, Any]:
+    with start_trace("batch_item", id=item["id"], model=plan.primary):
+        return _process_item(item, args, plan)
+
+
+def error_record(item: Dict[str, Any], start: float, error: str) -> Dict[str, Any]:
+    return {
+        "id": item["id"],
+        "status": "error",
+        "error": error,
+        "elapsed": round(time.monotonic() - start, 3),
+    }
+
+
+def _process_item(item: Dict[str, Any], args: argparse.Namespace, plan: RoutePlan) -> Dict[str, Any]:
+    start = time.monotonic()
+    image = None
+
+    try:
+        context = {
+            **EMPTY_CONTEXT,
+            "user_question": item.get("question") or "",
+            "text_input": item.get("text") or "",
+        }
+        enable_swot = parse_bool(item["swot"]) if item.get("swot") not in (None, "") else args.swot
+
+        # 画像・音声の解析と文書の要約を並行して開始し、審議側で結果を待つ
+        media = {}
+        if item.get("image"):
+            with open(resolve_path(item["image"], args.media_dir), "rb") as f:
+                image = prepare_image(f.read(), args.image_max_edge)
+            media["image_description"] = start_media_analysis(
+                "image_description", analyze_media, image.data, image.mime_type, IMAGE_PROMPT, plan
+            )
+
+        if item.get("audio"):
+            audio_path = resolve_path(item["audio"], args.media_dir)
+            mime_type = mimetypes.guess_type(audio_path)[0] or "audio/mpeg"
+            with open(audio_path, "rb") as f:
+                audio = f.read()
+            media["audio_transcript"] = start_media_analysis(
+                "audio_transcript", transcribe_audio_chunked, audio, mime_type, AUDIO_PROMPT, plan=plan
+            )
+
+        if item.get("document"):
+            document_path = resolve_path(item["document"], args.media_dir)
+            mime_type = mimetypes.guess_type(document_path)[0] or "text/plain"
+            media["text_input"] = start_media_analysis(
+                "text_input", ingest_document_file, document_path, mime_type, plan, context["text_input"]
+            )
+        elif needs_condensing(context["text_input"]):
+            media["text_input"] = start_media_analysis("text_input", condense_text, context["text_input"], plan)
+
+        estimate = estimate_deliberation(context, enable_swot, args.engine, plan, args.policy, pending=media)
+        if args.auto_route:
+            plan = route_by_size(plan, estimate.largest_prompt)
+        sections = deliberate(context, enable_swot, args.engine, plan, force=args.force, media=media, policy=args.policy)
+        record = {
+            "id": item["id"],
+            "status": "ok",
+            "model": plan.primary,
+            "estimated_tokens": estimate.input_tokens + estimate.output_tokens,
+            "context": context,
+            "sections": sections,
+            "elapsed": round(time.monotonic() - start, 3),
+        }
+        if args.reports_dir or args.reports_zip:
+            report = render_report(args.report_format, context, sections, image)
+            if args.reports_dir:
+                extension = REPORT_FORMATS[args.report_format].extension
+                report_path = os.path.join(args.reports_dir, f"{item['id']}.{extension}")
+                with open(report_path, "wb") as f:
+                    f.write(report)
+                record["report"] = report_path
+            if args.reports_zip:
+                # ZIP への書き込みはメインスレッドでまとめて行う (出力 JSONL には含めない)
+                record["_report_bytes"] = report
+    except (DeliberationError, OSError, ValueError) as e:
+        return error_record(item, start, str(e))
+    except Exception as e:
+        # 入力の不備・フェイルオーバー後の API エラー・レポート作成の失敗なども1件の失敗として記録し、
+        # 残りの項目の処理を続ける
+        logger.exception("item %s failed", item["id"])
+        return error_record(item, start, f"{type(e).__name__}: {e}")
+    return record
+
+
+def build_parser() -> argparse.ArgumentParser:
+    model_names = [spec["name"] for spec in MODEL_CHOICES.values()]
+    parser = argparse.ArgumentParser(prog="python -m magi", description="MAGI batch deliberation")
+    parser.add_argument("input", help="dilemmas (.jsonl or .csv)")
+    parser.add_argument("-o", "--output", required=True, help="results JSONL (appended; also the resume checkpoint)")
+    parser.add_argument("--model", default=DEFAULT_MODEL, choices=model_names)
+    parser.add_argument("--fallback", action="append", default=[], choices=model_names,
+                        help="failover model, in order (repeatable)")
+    parser.add_argument("--engine", default="single", choices=sorted(set(DELIBERATION_ENGINES.values())))
+    parser.add_argument("--swot", action="store_true", help="enable SWOT for items that do not set it")
+    parser.add_argument("--auto-route", action="store_true",
+                        help="send small prompts to a fast model and prompts near the context window to the longest-context model")
+    policy = get_round_policy()
+    parser.add_argument("--max-rounds", type=int, default=policy.max_rounds,
+                        help="iterative engine: maximum rounds including the first vote")
+    parser.add_argument("--majority", type=float, default=policy.majority,
+                        help="iterative engine: stop once this share of agents agree (1.0 = unanimous)")
+    parser.add_argument("--round-token-budget", type=int, default=policy.token_budget,
+                        help="iterative engine: token budget for revision rounds (0 = unlimited)")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--reports-dir", help="write one report per item into this directory")
+    parser.add_argument("--reports-zip", help="append one report per item to this ZIP archive as items finish")
+    parser.add_argument("--report-format", default="docx", choices=sorted(REPORT_FORMATS))
+    parser.add_argument("--media-dir", default=None, help="base directory for relative media paths")
+    parser.add_argument("--image-max-edge", type=int, default=1536)
+    parser.add_argument("--resume", action="store_true", help="skip ids already recorded as ok in the output")
+    parser.add_argument("--force", action="store_true", help="ignore cached deliberation results")
+    parser.add_argument("--metrics-prom", help="write Prometheus text metrics to this file when done")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    return parser
+
+
+def main(argv: Optional[list] = None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(asctime)s %(message)s")
+
+    if not configure_api(os.getenv("GEMINI_API_KEY")) and args.model != "local":
+        logger.error("GEMINI_API_KEY is not set. Use --model local for offline runs.")
+        return 2
+
+    args.media_dir = args.media_dir or os.path.dirname(os.path.abspath(args.input))
+    args.policy = RoundPolicy(args.max_rounds, args.majority, args.round_token_budget)
+    if args.reports_dir:
+        os.makedirs(args.reports_dir, exist_ok=True)
+
+    plan = RoutePlan((args.model, *[m for m in args.fallback if m != args.model]))
+    done = read_checkpoint(args.output) if args.resume else set()
+    counts = {"ok": 0, "error": 0, "skipped": 0}
+    write_lock = threading.Lock()
+
+    if not REPORT_FORMATS[args.report_format].available:
+        logger.error("report format %s needs %s installed.", args.report_format, REPORT_FORMATS[args.report_format].requires)
+        return 2
+
+    archive = contextlib.nullcontext()
+    if args.reports_zip:
+        compression = zipfile.ZIP_DEFLATED if REPORT_FORMATS[args.report_format].compress else zipfile.ZIP_STORED
+        mode = "a" if args.resume and os.path.exists(args.reports_zip) else "w"
+        archive = zipfile.ZipFile(args.reports_zip, mode, compression=compression)
+
+    with archive as zf, open(args.output, "a", encoding="utf-8") as out, \
+            ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+
+        def write(record):
+            report = record.pop("_report_bytes", None)
+            with write_lock:
+                if report is not None:
+                    zf.writestr(f"{record['id']}.{REPORT_FORMATS[args.report_format].extension}", report)
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+            counts[record["status"]] += 1
+            logger.info("%s %s (%.1fs)", record["id"], record["status"], record["elapsed"])
+
+        # 投入数を並列数の2倍までに抑え、数千件の入力でも Future を溜め込まない
+        pending = set()
+        for item in read_items(args.input):
+            if item["id"] in done:
+                counts["skipped"] += 1
+                continue
+            if "_error" in item:
+                write(error_record(item, time.monotonic(), item["_error"]))
+                continue
+            if len(pending) >= args.concurrency * 2:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    write(future.result())
+            pending.add(pool.submit(process_item, item, args, plan))
+
+        for future in wait(pending).done:
+            write(future.result())
+
+    if args.metrics_prom:
+        with open(args.metrics_prom, "w", encoding="utf-8") as f:
+            f.write(get_metrics().to_prometheus())
+
+    print(json.dumps(counts), file=sys.stderr)
+    return 1 if counts["error"] else 0
@@ -0,0 +1,853 @@
+"""
+MAGI の審議ロジック: プロンプト、単一プロンプト / 並列エンジン、結果キャッシュつきの実行、出力の解析。
+"""
+import logging
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, as_completed, wait
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from google.api_core.exceptions import TooManyRequests
+
+from .budget import PromptEstimate, count_tokens, fit_context, get_prompt_budget, trim_context
+from .cache import ResultCache, get_result_cache
+from .executors import get_agent_executor, notify, submit_with_context
+from .history import get_history_store
+from .metrics import record, record_usage, stage
+from .ratelimit import estimate_content_tokens
+from .routing import RoutePlan, generate_routed
+from .schema import SchemaError, parse_magi_json, response_schema_name
+from .semantic import get_semantic_recall
+from .singleflight import get_single_flight
+
+logger = logging.getLogger("magi")
+
+
+# ======================================================
+# MAGI ロジック
+# ======================================================
+# 役割定義
+MAGI_SYSTEM_PROMPT = """
+あなたはスーパーコンピュータシステム「MAGI」です。
+以下の3つの人格（エージェント）と、メディア解析担当、そして統合判断を行うメインプロセッサとして振る舞ってください。
+
+【構成エージェント】
+1. **Magi-Logic (Melchior)**: 
+   - 科学者としての「自分」。冷徹、論理的、効率重視、最新技術への信頼。感情を排し、データと確率で判断する。
+2. **Magi-Human (Balthasar)**: 
+   - 母としての「自分」。倫理的、感情的、保護的。人間性、幸福、リスク回避、子供の将来を優先する。
+3. **Magi-Reality (Casper)**: 
+   - 女としての「自分」。現実的、政治的、直感的。現状維持、コスト、人間関係の機微、個人の欲望を重視する。
+
+【タスク】
+ユーザーの入力（質問・テキスト・メディア情報）に対し、上記3つの視点から議論し、それぞれ「可決(Go)」「否決(No-Go)」「保留(Hold)」を判定せよ。
+あえて意見を対立させること。Logicが推奨してもHumanが倫理で止め、Realityがコストで渋るような構図が望ましい。
+
+【出力フォーマット】
+必ず以下の形式で出力すること。Markdownの装飾は最小限にせよ。
+
+[SECTION:MAGI-LOGIC]
+判定: (可決/否決/保留)
+見解: (論理的視点からの120文字以内のコメント。断定的な口調)
+
+[SECTION:MAGI-HUMAN]
+判定: (可決/否決/保留)
+見解: (人間的・倫理的視点からの120文字以内のコメント。丁寧だが心配性な口調)
+
+[SECTION:MAGI-REALITY]
+判定: (可決/否決/保留)
+見解: (現実的・政治的視点からの120文字以内のコメント。シニカルまたは打算的な口調)
+
+[SECTION:MAGI-MEDIA]
+判定: (可決/否決/保留)
+見解: (デザイン・印象・表現面からの120文字以内のコメント)
+
+[SECTION:INTEGRATION]
+結論: (承認/否決/条件付き承認 など簡潔に)
+詳細: (3者の意見を統合した最終アドバイス。300文字以内)
+"""
+
+MAGI_SWOT_PROMPT = """
+[SECTION:SWOT]
+Strengths: (強みを5つ、読点で区切って列挙)
+Weaknesses: (弱みを5つ、読点で区切って列挙)
+Opportunities: (機会を5つ、読点で区切って列挙)
+Threats: (脅威を5つ、読点で区切って列挙)
+"""
+
+# 並列エンジン用: エージェントごとの人格とセクション書式
+MAGI_AGENTS = {
+    "MAGI-LOGIC": {
+        "persona": "Magi-Logic (Melchior)。科学者としての「自分」。冷徹、論理的、効率重視、最新技術への信頼。感情を排し、データと確率で判断する。",
+        "format": "判定: (可決/否決/保留)\n見解: (論理的視点からの120文字以内のコメント。断定的な口調)",
+    },
+    "MAGI-HUMAN": {
+        "persona": "Magi-Human (Balthasar)。母としての「自分」。倫理的、感情的、保護的。人間性、幸福、リスク回避、子供の将来を優先する。",
+        "format": "判定: (可決/否決/保留)\n見解: (人間的・倫理的視点からの120文字以内のコメント。丁寧だが心配性な口調)",
+    },
+    "MAGI-REALITY": {
+        "persona": "Magi-Reality (Casper)。女としての「自分」。現実的、政治的、直感的。現状維持、コスト、人間関係の機微、個人の欲望を重視する。",
+        "format": "判定: (可決/否決/保留)\n見解: (現実的・政治的視点からの120文字以内のコメント。シニカルまたは打算的な口調)",
+    },
+    "MAGI-MEDIA": {
+        "persona": "MAGI のメディア解析担当。デザイン・印象・表現面から判断する。",
+        "format": "判定: (可決/否決/保留)\n見解: (デザイン・印象・表現面からの120文字以内のコメント)",
+    },
+    "SWOT": {
+        "persona": "MAGI の戦略分析担当。状況を SWOT の枠組みで整理する。",
+        "format": (
+            "Strengths: (強みを5つ、読点で区切って列挙)\n"
+            "Weaknesses: (弱みを5つ、読点で区切って列挙)\n"
+            "Opportunities: (機会を5つ、読点で区切って列挙)\n"
+            "Threats: (脅威を5つ、読点で区切って列挙)"
+        ),
+    },
+}
+
+MAGI_INTEGRATION_FORMAT = "結論: (承認/否決/条件付き承認 など簡潔に)\n詳細: (3者の意見を統合した最終アドバイス。300文字以内)"
+
+DELIBERATION_ENGINES = {
+    "SINGLE PROMPT": "single",
+    "PARALLEL AGENTS": "parallel",
+    "ITERATIVE COUNCIL": "iterative",
+    "STRUCTURED JSON": "structured",
+}
+
+
+# 解析用コンテキストの初期値
+EMPTY_CONTEXT = {
+    "user_question": "",
+    "text_input": "",
+    "image_description": "",
+    "audio_transcript": "",
+}
+
+
+# ======================================================
+# 固定プロンプト (system_instruction として送り、モデル・SWOT の組み合わせごとに使い回す)
+# ======================================================
+@lru_cache(maxsize=None)
+def core_instruction(enable_swot: bool) -> str:
+    return MAGI_SYSTEM_PROMPT + (MAGI_SWOT_PROMPT if enable_swot else "")
+
+
+@lru_cache(maxsize=None)
+def agent_instruction(tag: str) -> str:
+    agent = MAGI_AGENTS[tag]
+    return f"""
+あなたはスーパーコンピュータシステム「MAGI」の構成エージェントの1つ、{agent['persona']}
+ユーザーの入力（質問・テキスト・メディア情報）に対し、あなたの視点のみから判断せよ。
+
+【出力フォーマット】
+必ず以下の形式で出力すること。Markdownの装飾は最小限にせよ。他のセクションは出力しないこと。
+
+[SECTION:{tag}]
+{agent['format']}
+"""
+
+
+@lru_cache(maxsize=None)
+def revision_instruction(tag: str) -> str:
+    agent = MAGI_AGENTS[tag]
+    return f"""
+あなたはスーパーコンピュータシステム「MAGI」の構成エージェントの1つ、{agent['persona']}
+入力の【他のエージェントの前回の判定】と【あなたの前回の判定】を読み、あなたの視点から判定を見直せ。
+他者の論点に説得力があれば判定を改めてよいが、同調のためだけに変えてはならない。
+
+【出力フォーマット】
+必ず以下の形式で出力すること。Markdownの装飾は最小限にせよ。他のセクションは出力しないこと。
+
+[SECTION:{tag}]
+{agent['format']}
+"""
+
+
+MAGI_INTEGRATION_INSTRUCTION = f"""
+あなたはスーパーコンピュータシステム「MAGI」の統合判断を行うメインプロセッサです。
+入力の【エージェントの判定】を踏まえ、最終判断を下せ。
+
+【出力フォーマット】
+必ず以下の形式で出力すること。Markdownの装飾は最小限にせよ。他のセクションは出力しないこと。
+
+[SECTION:INTEGRATION]
+{MAGI_INTEGRATION_FORMAT}
+"""
+
+
+MAGI_STRUCTURED_FORMAT = """
+【出力フォーマット】
+指定されたスキーマの JSON だけを出力すること。
+- logic / human / reality / media: decision は「可決」「否決」「保留」のいずれか。summary は各視点からの120文字以内の見解 (人格の口調で)
+- integration: conclusion は承認/否決/条件付き承認 など簡潔に。detail は3者の意見を統合した最終アドバイス (300文字以内)
+"""
+
+MAGI_STRUCTURED_SWOT_FORMAT = """- swot: strengths / weaknesses / opportunities / threats にそれぞれ5つずつ列挙
+"""
+
+
+@lru_cache(maxsize=None)
+def structured_instruction(enable_swot: bool) -> str:
+    """構造化出力用: 人格とタスクは共通で、書式だけを JSON の説明に置き換える"""
+    persona = MAGI_SYSTEM_PROMPT.split("【出力フォーマット】")[0]
+    return persona + MAGI_STRUCTURED_FORMAT + (MAGI_STRUCTURED_SWOT_FORMAT if enable_swot else "")
+
+
+def build_user_data(context: Dict[str, Any]) -> str:
+    # 各欄は上限で切り詰める (上限の調整は budget.get_prompt_budget を参照)
+    context = trim_context(context)
+    return f"""
+    QUERY: {context['user_question']}
+    ADDITIONAL_TEXT: {context['text_input']}
+    VISUAL_DATA: {context['image_description']}
+    AUDIO_DATA: {context['audio_transcript']}
+    """
+
+
+def call_magi_core(
+    context: Dict[str, Any],
+    enable_swot: bool,
+    on_section: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+    plan: Optional[RoutePlan] = None,
+) -> str | None:
+    """
+    1つのプロンプトで全セクションを生成する。
+    on_section を渡すとストリーミングで受信し、セクションが完成するたびに呼び出す。
+    """
+    plan = plan or RoutePlan()
+    system_prompt = core_instruction(enable_swot)
+    user_data = build_user_data(context)
+
+    try:
+        # リトライ付きで実行
+        if on_section is None:
+            response = generate_routed(plan, [user_data], system_instruction=system_prompt)
+            return response.text
+
+        response = generate_routed(plan, [user_data], stream=True, system_instruction=system_prompt)
+        parser = MagiStreamParser()
+        chunks = []
+        chunk = None
+        for chunk in response:
+            chunks.append(chunk.text)
+            for tag, sec in parser.feed(chunk.text):
+                on_section(tag, sec)
+        for tag, sec in parser.close():
+            on_section(tag, sec)
+        # ストリーミング時の使用量は最後のチャンクに載る
+        record_usage(chunk)
+        return "".join(chunks)
+    except TooManyRequests:
+        return "SYSTEM FAILURE: 429 RESOURCE EXHAUSTED. Please switch models or wait a moment."
+    except Exception as e:
+        return f"SYSTEM FAILURE: {str(e)}"
+
+
+def call_magi_structured(
+    context: Dict[str, Any],
+    enable_swot: bool,
+    on_section: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+    plan: Optional[RoutePlan] = None,
+) -> str | None:
+    """
+    1つのプロンプトで全セクションを JSON (response_schema で形式を固定) として生成する。
+    戻り値は JSON テキストで、parse_magi_output でそのまま sections にできる。
+    スキーマに合わない応答はキャッシュ・履歴に残さないよう SYSTEM FAILURE として返す
+    ([SECTION:...] 形式のテキストで返ってきた場合だけ、正規表現の解析で受け入れる)。
+    on_section は全体の受信後にまとめて呼び出す。
+    """
+    plan = plan or RoutePlan()
+    try:
+        response = generate_routed(
+            plan, [build_user_data(context)],
+            system_instruction=structured_instruction(enable_swot),
+            response_schema=response_schema_name(enable_swot),
+        )
+        text = response.text
+        try:
+            sections = parse_magi_json(text)
+        except SchemaError as e:
+            record(schema_failures=1)
+            sections = parse_section_text(text)
+            if not all(tag in sections for tag in ("MAGI-LOGIC", "MAGI-HUMAN", "MAGI-REALITY", "INTEGRATION")):
+                return f"SYSTEM FAILURE: MALFORMED STRUCTURED OUTPUT ({e})"
+    except TooManyRequests:
+        return "SYSTEM FAILURE: 429 RESOURCE EXHAUSTED. Please switch models or wait a moment."
+    except Exception as e:
+        return f"SYSTEM FAILURE: {str(e)}"
+
+    if on_section:
+        for tag, sec in sections.items():
+            on_section(tag, sec)
+    return text
+
+
+# ======================================================
+# MAGI ロジック (並列エンジン)
+# ======================================================
+def ensure_section(tag: str, text: str) -> str:
+    """応答からセクション本文を取り出し、[SECTION:TAG] 付きで返す"""
+    text = text.strip()
+    marker = f"[SECTION:{tag}]"
+    if marker in text:
+        text = text.split(marker, 1)[1]
+    # 指示外のセクションが続いた場合は切り捨てる
+    text = re.split(r"\[SECTION:.*?\]", text, maxsplit=1)[0]
+    return f"{marker}\n{text.strip()}\n"
+
+
+def call_magi_agent(plan: RoutePlan, tag: str, user_data: str) -> str:
+    """単一エージェントの判定だけを生成する (map ステップ)"""
+    response = generate_routed(plan, [user_data], system_instruction=agent_instruction(tag))
+    return ensure_section(tag, response.text)
+
+
+def call_magi_integration(plan: RoutePlan, user_data: str, agent_outputs: str) -> str:
+    """各エージェントの判定を統合する (reduce ステップ)"""
+    content = [f"【エージェントの判定】\n{agent_outputs}", user_data]
+    response = generate_routed(plan, content, system_instruction=MAGI_INTEGRATION_INSTRUCTION)
+    return ensure_section("INTEGRATION", response.text)
+
+
+# バックグラウンドで作る context のうち、メディア系エージェントだけでなく全員が参照するもの
+DOCUMENT_FIELDS = ("text_input",)
+
+
+def media_result(future: Future) -> str:
+    """バックグラウンドのメディア解析の結果。例外は analyze_media と同じ ERROR: 形式の文字列にする"""
+    try:
+        return future.result()
+    except Exception as e:
+        return f"ERROR: {str(e)}"
+
+
+def run_agents(
+    context: Dict[str, Any],
+    enable_swot: bool,
+    on_section: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+    plan: Optional[RoutePlan] = None,
+    media: Optional[Mapping[str, Future]] = None,
+) -> Dict[str, str]:
+    """
+    各エージェントを個別リクエストとして並列実行し、タグ → [SECTION:...] 付きの出力を返す (map ステップ)。
+    media を渡した場合の依存関係は call_magi_parallel を参照。
+    """
+    plan = plan or RoutePlan()
+    executor = get_agent_executor()
+    waiting = {future: key for key, future in (media or {}).items()}
+
+    text_tags = ["MAGI-LOGIC", "MAGI-HUMAN", "MAGI-REALITY"]
+    media_tags = ["MAGI-MEDIA"]
+    if enable_swot:
+        media_tags.append("SWOT")
+    if not waiting:
+        text_tags, media_tags = text_tags + media_tags, []
+
+    def submit(tags, user_data):
+        return {submit_with_context(executor, call_magi_agent, plan, tag, user_data): tag for tag in tags}
+
+    # 解析中のメディアは空欄としてテキストのみで判断させる
+    agents = submit(text_tags, build_user_data({**context, **{key: "" for key in waiting.values()}}))
+    pending = set(agents) | set(waiting)
+    outputs = {}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future in waiting:
+                context[waiting.pop(future)] = media_result(future)
+                if not waiting:
+                    # すべての解析が揃ったら、メディアに依存するエージェントを開始する
+                    dependents = submit(media_tags, build_user_data(context))
+                    agents.update(dependents)
+                    pending |= set(dependents)
+                continue
+            tag = agents[future]
+            outputs[tag] = future.result()
+            if on_section:
+                for sec_tag, sec in parse_magi_output(outputs[tag]).items():
+                    on_section(sec_tag, sec)
+    # 出力順はエージェントの定義順にそろえる
+    return {tag: outputs[tag] for tag in MAGI_AGENTS if tag in outputs}
+
+
+def call_magi_parallel(
+    context: Dict[str, Any],
+    enable_swot: bool,
+    on_section: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+    plan: Optional[RoutePlan] = None,
+    media: Optional[Mapping[str, Future]] = None,
+) -> str | None:
+    """
+    各エージェントを個別リクエストとして並列実行し、最後に INTEGRATION で統合する。
+    戻り値は call_magi_core と同じ [SECTION:...] 形式のテキスト。
+    on_section を渡すと、エージェントが完了した順に呼び出す。
+
+    media (context のキー → 解析中の Future) を渡すと依存グラフとして実行する:
+    テキストで判断できる LOGIC / HUMAN / REALITY は解析の完了を待たずに開始し、
+    MEDIA・SWOT・INTEGRATION だけが解析結果を待つ。解析結果は context に書き込む。
+    """
+    plan = plan or RoutePlan()
+    try:
+        outputs = run_agents(context, enable_swot, on_section, plan, media)
+        votes = "".join(output for tag, output in outputs.items() if tag != "SWOT")
+        integration = call_magi_integration(plan, build_user_data(context), votes)
+        if on_section:
+            for sec_tag, sec in parse_magi_output(integration).items():
+                on_section(sec_tag, sec)
+    except TooManyRequests:
+        return "SYSTEM FAILURE: 429 RESOURCE EXHAUSTED. Please switch models or wait a moment."
+    except Exception as e:
+        return f"SYSTEM FAILURE: {str(e)}"
+
+    return votes + integration + outputs.get("SWOT", "")
+
+
+# ======================================================
+# MAGI ロジック (反復審議: 他者の判定を見て投票を見直す)
+# ======================================================
+@dataclass(frozen=True)
+class RoundPolicy:
+    """反復審議の打ち切り条件"""
+    # 1回目 (並列エンジンと同じ) を含む最大ラウンド数
+    max_rounds: int = 3
+    # 最多の判定がこの割合以上になったら打ち切る (1.0 は全会一致)
+    majority: float = 1.0
+    # 見直しラウンドで使うトークンの上限 (0 は無制限)。超える見込みなら次のラウンドを始めない
+    token_budget: int = 0
+
+    def cache_variant(self) -> str:
+        return f"iterative:{self.max_rounds}:{self.majority:g}:{self.token_budget}"
+
+
+@lru_cache(maxsize=None)
+def get_round_policy() -> RoundPolicy:
+    return RoundPolicy(
+        max_rounds=int(os.getenv("MAGI_MAX_ROUNDS", "3")),
+        majority=float(os.getenv("MAGI_ROUND_MAJORITY", "1.0")),
+        token_budget=int(os.getenv("MAGI_ROUND_TOKEN_BUDGET", "0")),
+    )
+
+
+# 出力トークン数の目安 (見積もり用)
+OUTPUT_TOKENS = {"agent": 200, "swot": 400, "integration": 350}
+
+# MAGI-MEDIA は表現面を描写する補助エージェントのため、多数決には数えない
+NON_VOTING_TAGS = ("MAGI-MEDIA",)
+
+
+def usage_tokens(response, *texts: str) -> int:
+    """応答の総トークン数。usage_metadata がない (ローカルモデルなど) 場合は文字数から見積もる"""
+    usage = getattr(response, "usage_metadata", None)
+    total = getattr(usage, "total_token_count", 0) or 0
+    return total or sum(len(text) for text in texts) // 2
+
+
+def revision_content(user_data: str, own: str, peers: str) -> List[str]:
+    return [f"【他のエージェントの前回の判定】\n{peers}", f"【あなたの前回の判定】\n{own}", user_data]
+
+
+def estimate_revision_tokens(tag: str, user_data: str, own: str, peers: str) -> int:
+    """見直し1回の使用トークン数の概算 (入力はローカルでの見積もり、出力は目安)"""
+    return estimate_content_tokens([revision_instruction(tag), *revision_content(user_data, own, peers)]) + OUTPUT_TOKENS["agent"]
+
+
+def call_magi_revision(plan: RoutePlan, tag: str, user_data: str, own: str, peers: str) -> Tuple[str, int]:
+    """他のエージェントの前回の判定を踏まえて、1エージェントの判定を見直す。(出力, 使用トークン数) を返す"""
+    content = revision_content(user_data, own, peers)
+    response = generate_routed(plan, content, system_instruction=revision_instruction(tag))
+    text = ensure_section(tag, response.text)
+    return text, usage_tokens(response, revision_instruction(tag), *content, text)
+
+
+def vote_converged(decisions: Mapping[str, str], majority: float) -> bool:
+    """最多の判定が majority 以上か (NON_VOTING_TAGS は数えない)"""
+    votes = [decision for tag, decision in decisions.items() if tag not in NON_VOTING_TAGS]
+    counts = [votes.count(decision) for decision in set(votes)]
+    return bool(counts) and max(counts) / len(votes) >= majority
+
+
+def call_magi_rounds(
+    context: Dict[str, Any],
+    enable_swot: bool,
+    on_section: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+    plan: Optional[RoutePlan] = None,
+    media: Optional[Mapping[str, Future]] = None,
+    policy: Optional[RoundPolicy] = None,
+) -> str | None:
+    """
+    反復審議。1回目は並列エンジンと同じく各エージェントが独立に判定し、
+    以降のラウンドでは他のエージェントの前回の判定・見解を読んで判定を見直す。
+
+    - 見直しはエージェントごとに並列に実行する。
+    - 前のラウンドで他者の判定が1つも変わらなかったエージェントは、新しい材料がないため実行しない。
+    - 判定が変わらなくなった (収束した)、最多の判定が policy.majority に達した、
+      ラウンド数またはトークンの上限に達した、のいずれかで打ち切り、INTEGRATION で統合する。
+      多数決には MAGI-MEDIA を数えない (見直しは他のエージェントと同じく行う)。
+    """
+    plan = plan or RoutePlan()
+    policy = policy or get_round_policy()
+    executor = get_agent_executor()
+    try:
+        outputs = run_agents(context, enable_swot, on_section, plan, media)
+        voters = [tag for tag in outputs if tag != "SWOT"]
+        decisions = {tag: parse_magi_output(outputs[tag])[tag]["decision"] for tag in voters}
+        history = [dict(decisions)]
+        changed = set(voters)
+        tokens = calls = 0
+        user_data = build_user_data(context)
+
+        for round_no in range(2, policy.max_rounds + 1):
+            if not changed or vote_converged(decisions, policy.majority):
+                break
+            # 前のラウンドで他者の判定が変わったエージェントだけを見直す
+            revising = [tag for tag in voters if changed - {tag}]
+            peers = {tag: "".join(outputs[peer] for peer in voters if peer != tag) for tag in revising}
+            # 次のラウンドの使用量を見積もり、上限を超えるなら始めない。見直しの実績があれば1回あたりの平均から、
+            # まだない (最も大きい最初の見直しラウンド) ならプロンプトからの概算で見積もる
+            if policy.token_budget:
+                if calls:
+                    expected = tokens / calls * len(revising)
+                else:
+                    expected = sum(
+                        estimate_revision_tokens(tag, user_data, outputs[tag], peers[tag]) for tag in revising
+                    )
+                if tokens + expected > policy.token_budget:
+                    break
+            record(rounds=1, agents_skipped=len(voters) - len(revising))
+            futures = {
+                submit_with_context(executor, call_magi_revision, plan, tag, user_data, outputs[tag], peers[tag]): tag
+                for tag in revising
+            }
+            changed = set()
+            with stage("deliberation_round"):
+                for future in as_completed(futures):
+                    tag = futures[future]
+                    outputs[tag], used = future.result()
+                    tokens += used
+                    calls += 1
+                    sec = parse_magi_output(outputs[tag])[tag]
+                    if sec["decision"] != decisions[tag]:
+                        changed.add(tag)
+                        decisions[tag] = sec["decision"]
+                    if on_section:
+                        on_section(tag, sec)
+            history.append(dict(decisions))
+            notify(f"🔁 ROUND {round_no}: {len(changed)} VOTE(S) REVISED.", icon="🔁")
+
+        votes = "".join(outputs[tag] for tag in voters)
+        trail = "\n".join(
+            f"第{n}回: " + " / ".join(f"{tag} {decision}" for tag, decision in round_decisions.items())
+            for n, round_decisions in enumerate(history, 1)
+        )
+        integration = call_magi_integration(plan, user_data, f"{votes}\n【審議の経過】\n{trail}\n")
+        if on_section:
+            for sec_tag, sec in parse_magi_output(integration).items():
+                on_section(sec_tag, sec)
+    except TooManyRequests:
+        return "SYSTEM FAILURE: 429 RESOURCE EXHAUSTED. Please switch models or wait a moment."
+    except Exception as e:
+        return f"SYSTEM FAILURE: {str(e)}"
+
+    return votes + integration + outputs.get("SWOT", "")
+
+
+# ======================================================
+# 審議の実行 (結果キャッシュつき)
+# ======================================================
+def run_deliberation(
+    context: Dict[str, Any],
+    enable_swot: bool,
+    engine: str,
+    on_section: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+    force: bool = False,
+    plan: Optional[RoutePlan] = None,
+    media: Optional[Mapping[str, Future]] = None,
+    policy: Optional[RoundPolicy] = None,
+) -> str | None:
+    """
+    審議を実行する。同じ入力の結果がキャッシュにあれば、モデルを呼ばずにそれを返す。
+    force=True の場合はキャッシュを無視して再審議し、結果で上書きする。
+    media にはバックグラウンドで解析中のメディア (context のキー → Future) を渡す。
+    並列エンジン・反復審議では解析の完了を待たずにテキストのみのエージェントを開始し、
+    それ以外のエンジンでは解析結果が揃ってから開始する。いずれも解析結果は context に書き込む。
+    文書の要約 (text_input) は全エージェントが使うため、どのエンジンでも先に待つ。
+    policy は反復審議の打ち切り条件 (省略時は get_round_policy())。
+    成功した審議は (キャッシュから返した場合も含めて) 履歴に記録する。
+    """
+    plan = plan or RoutePlan()
+    policy = policy or get_round_policy()
+    start = time.monotonic()
+    raw_result, source = _deliberate(context, enable_swot, engine, on_section, force, plan, media, policy)
+    if raw_result and "SYSTEM FAILURE" not in raw_result:
+        record_history(
+            context, raw_result, plan.primary, engine, enable_swot, source, time.monotonic() - start,
+            deliberation_key(context, plan.primary, enable_swot, engine, policy),
+        )
+    return raw_result
+
+
+def deliberation_key(context, model_name, enable_swot, engine, policy: RoundPolicy) -> str:
+    """結果キャッシュのキー。単一プロンプトと並列エンジンは同じ審議として結果を共有する"""
+    variant = policy.cache_variant() if engine == "iterative" else None
+    return ResultCache.make_key(context, model_name, enable_swot, variant)
+
+
+def call_engine(engine, context, enable_swot, on_section, plan, media=None, policy=None) -> str | None:
+    if engine == "iterative":
+        with stage("call_magi_rounds"):
+            return call_magi_rounds(context, enable_swot, on_section, plan, media, policy)
+    if engine == "parallel":
+        with stage("call_magi_parallel"):
+            return call_magi_parallel(context, enable_swot, on_section, plan, media)
+    if engine == "structured":
+        with stage("call_magi_structured"):
+            return call_magi_structured(context, enable_swot, on_section, plan)
+    with stage("call_magi_core"):
+        return call_magi_core(context, enable_swot, on_section, plan)
+
+
+def estimate_deliberation(
+    context: Dict[str, Any],
+    enable_swot: bool,
+    engine: str,
+    plan: Optional[RoutePlan] = None,
+    policy: Optional[RoundPolicy] = None,
+    pending: Iterable[str] = (),
+) -> PromptEstimate:
+    """
+    送信前の見積もり (ローカルでの概算)。各欄は上限で切り詰めた後の大きさで数え、
+    解析中の欄 (pending) は上限いっぱいになるとみなす。反復審議は最大ラウンド数まで進んだ場合。
+    MAGI_COUNT_TOKENS=1 なら最も大きいリクエストを count_tokens で数え直し、入力全体をその比率で補正する。
+    """
+    plan = plan or RoutePlan()
+    policy = policy or get_round_policy()
+    limits = get_prompt_budget().field_limits()
+    user_data = build_user_data({**context, **{key: "。" * (limits[key] * 2) for key in pending if key in limits}})
+    voters = ["MAGI-LOGIC", "MAGI-HUMAN", "MAGI-REALITY", "MAGI-MEDIA"]
+    swot_output = OUTPUT_TOKENS["swot"] if enable_swot else 0
+    vote_text = "。" * (OUTPUT_TOKENS["agent"] * 2)
+
+    # (system_instruction, content) のリスト
+    if engine in ("single", "structured"):
+        instruction = core_instruction(enable_swot) if engine == "single" else structured_instruction(enable_swot)
+        prompts = [(instruction, [user_data])]
+        output = OUTPUT_TOKENS["agent"] * len(voters) + OUTPUT_TOKENS["integration"] + swot_output
+    else:
+        agents = voters + (["SWOT"] if enable_swot else [])
+        prompts = [(agent_instruction(tag), [user_data]) for tag in agents]
+        rounds = policy.max_rounds - 1 if engine == "iterative" else 0
+        for tag in voters * rounds:
+            prompts.append((revision_instruction(tag), revision_content(user_data, vote_text, vote_text * (len(voters) - 1))))
+        prompts.append((MAGI_INTEGRATION_INSTRUCTION, [vote_text * len(voters), user_data]))
+        output = OUTPUT_TOKENS["agent"] * len(voters) * (rounds + 1) + OUTPUT_TOKENS["integration"] + swot_output
+
+    sizes = [estimate_content_tokens([instruction, *content]) for instruction, content in prompts]
+    largest = max(range(len(sizes)), key=sizes.__getitem__)
+    exact = count_tokens(plan.primary, prompts[largest][1], prompts[largest][0])
+    scale = exact / sizes[largest] if exact else 1.0
+    return PromptEstimate(
+        model=plan.primary,
+        requests=len(prompts),
+        input_tokens=round(sum(sizes) * scale),
+        output_tokens=output,
+        largest_prompt=round(sizes[largest] * scale),
+        exact=exact is not None,
+    )
+
+
+def _deliberate(context, enable_swot, engine, on_section, force, plan, media, policy) -> Tuple[str | None, str]:
+    """(生の出力, 取得元 "model" / "cache" / "shared") を返す"""
+    cache = get_result_cache()
+    pending = {}
+    for key, future in (media or {}).items():
+        if future.done():
+            context[key] = media_result(future)
+        elif key in DOCUMENT_FIELDS:
+            # 文書の要約は全エージェントが使うため、先に待つ
+            with stage("await_document"):
+                context[key] = media_result(future)
+        else:
+            pending[key] = future
+    # 上限を超えた欄は送信前に要約・切り詰めで収める (解析中の欄は build_user_data で切り詰める)
+    with stage("fit_context"):
+        fit_context(context, plan, fields=[key for key in get_prompt_budget().field_limits() if key not in pending])
+
+    if pending and engine in ("parallel", "iterative"):
+        # キャッシュキーは解析結果が揃うまで決まらないため、検索せずに開始して完了後に保存する
+        record(cache_misses=1)
+        raw_result = call_engine(engine, context, enable_swot, on_section, plan, pending, policy)
+        if raw_result and "SYSTEM FAILURE" not in raw_result:
+            cache.put(deliberation_key(context, plan.primary, enable_swot, engine, policy), raw_result)
+        return raw_result, "model"
+
+    if pending:
+        with stage("await_media"):
+            for key, future in pending.items():
+                context[key] = media_result(future)
+        with stage("fit_context"):
+            fit_context(context, plan, fields=pending)
+
+    cache_key = deliberation_key(context, plan.primary, enable_swot, engine, policy)
+    if not force:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            record(cache_hits=1)
+            notify("♻️ CACHED DELIBERATION RESTORED.", icon="💾")
+            if on_section:
+                for tag, sec in parse_magi_output(cached).items():
+                    on_section(tag, sec)
+            return cached, "cache"
+
+    record(cache_misses=1)
+    # 同じ審議が他のセッションで実行中なら、完了を待って結果を共有する
+    raw_result, shared = get_single_flight().do(
+        f"deliberation:{cache_key}", _run_engine, context, enable_swot, engine, on_section, plan, policy, cache_key
+    )
+    if shared:
+        record(coalesced=1)
+        notify("🔗 JOINED AN IDENTICAL DELIBERATION IN PROGRESS.", icon="🔗")
+        if on_section and raw_result:
+            for tag, sec in parse_magi_output(raw_result).items():
+                on_section(tag, sec)
+    return raw_result, "shared" if shared else "model"
+
+
+def record_history(context, raw_result, model_name, engine, enable_swot, source, elapsed, cache_key) -> None:
+    """審議履歴に追記する。記録に失敗しても審議結果は返す"""
+    try:
+        store = get_history_store()
+        if store is None:
+            return
+        store.record(
+            context, parse_magi_output(raw_result), raw_result, model_name, engine, enable_swot, source, elapsed,
+            cache_key,
+        )
+    except sqlite3.Error as e:
+        logger.warning("failed to record deliberation history: %s", e)
+        return
+    recall = get_semantic_recall()
+    if recall is not None:
+        recall.sync_in_background()
+
+
+def _run_engine(context, enable_swot, engine, on_section, plan, policy, cache_key) -> str | None:
+    raw_result = call_engine(engine, context, enable_swot, on_section, plan, policy=policy)
+    if raw_result and "SYSTEM FAILURE" not in raw_result:
+        get_result_cache().put(cache_key, raw_result)
+    return raw_result
+
+
+class DeliberationError(RuntimeError):
+    """審議が SYSTEM FAILURE で終わった場合に deliberate() が送出する"""
+
+
+def deliberate(
+    context: Dict[str, Any],
+    enable_swot: bool = False,
+    engine: str = "single",
+    plan: Optional[RoutePlan] = None,
+    force: bool = False,
+    media: Optional[Mapping[str, Future]] = None,
+    policy: Optional[RoundPolicy] = None,
+) -> Dict[str, Any]:
+    """
+    ライブラリ用の入口。審議して parse_magi_output 形式の sections を返す。
+    media を渡した場合、解析結果は呼び出し側の context にも書き込む。
+    """
+    for key, value in EMPTY_CONTEXT.items():
+        context.setdefault(key, value)
+    raw_result = run_deliberation(context, enable_swot, engine, force=force, plan=plan, media=media, policy=policy)
+    if not raw_result or "SYSTEM FAILURE" in raw_result:
+        raise DeliberationError(raw_result or "UNKNOWN ERROR")
+    return parse_magi_output(raw_result)
+
+
+# ======================================================
+# 解析ロジック (テキスト処理)
+# ======================================================
+SECTION_PATTERN = re.compile(r"\[SECTION:(.*?)\]")
+
+
+def parse_section(tag: str, content: str):
+    """1セクション分の本文を解析し、(tag, data) を返す"""
+    tag = tag.strip()
+    content = content.strip()
+
+    if tag == "SWOT":
+        swot_data = {}
+        for line in content.split('\n'):
+            if ":" in line:
+                k, v = line.split(":", 1)
+                swot_data[k.strip()] = v.strip()
+        return tag, swot_data
+
+    data = {"decision": "保留", "summary": "", "raw": content}
+
+    for line in content.split('\n'):
+        if line.startswith("判定:"):
+            val = line.split(":", 1)[1].strip()
+            if "可決" in val: data["decision"] = "可決"
+            elif "否決" in val: data["decision"] = "否決"
+            else: data["decision"] = "保留"
+        elif line.startswith("見解:") or line.startswith("詳細:"):
+            data["summary"] = line.split(":", 1)[1].strip()
+
+    return tag, data
+
+
+def parse_section_text(text: str):
+    """[SECTION:...] 形式のテキストを正規表現で解析する"""
+    sections = {}
+    parts = SECTION_PATTERN.split(text)
+
+    for i in range(1, len(parts), 2):
+        tag, data = parse_section(parts[i], parts[i+1])
+        sections[tag] = data
+
+    return sections
+
+
+def parse_magi_output(text: str):
+    """審議結果を sections にする。構造化出力 (JSON) は検証して変換し、それ以外は正規表現で解析する"""
+    with stage("parse_magi_output"):
+        if text.lstrip().startswith("{"):
+            try:
+                return parse_magi_json(text)
+            except SchemaError:
+                record(schema_failures=1)
+        return parse_section_text(text)
+
+
+class MagiStreamParser:
+    """
+    ストリーミング応答から [SECTION:...] を逐次切り出すパーサー。
+    次のマーカーが届いた時点で直前のセクションを完成とみなす。
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._tag: Optional[str] = None
+
+    def feed(self, chunk: str):
+        self._buffer += chunk
+        completed = []
+        while True:
+            m = SECTION_PATTERN.search(self._buffer)
+            if not m:
+                break
+            if self._tag is not None:
+                completed.append(parse_section(self._tag, self._buffer[:m.start()]))
+            self._tag = m.group(1)
+            self._buffer = self._buffer[m.end():]
+        return completed
+
+    def close(self):
+        if self._tag is None:
+            return []
+        completed = [parse_section(self._tag, self._buffer)]
+        self._tag = None
+        self._buffer = ""
+        return completed
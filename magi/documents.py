@@ -0,0 +1,272 @@
+"""
+文書の取り込み: 大きなテキスト (.txt / .docx / 長い補足テキスト) をトークン数で区切り、
+区間ごとの要約を並列に作って (map)、上限に収まるまで要約を重ねる (reduce)。
+結果は context の text_input (プロンプトの ADDITIONAL_TEXT) に入れる。
+
+区間の要約は内容のハッシュでメディア解析キャッシュに保存するため、同じ文書の再投入ではモデルを呼ばない。
+文書は単独で要約し、補足テキストとは後から合わせる (補足テキストを書き換えても区間の境界が変わらない)。
+"""
+import codecs
+import io
+import os
+from concurrent.futures import Future, as_completed
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from google.api_core.exceptions import TooManyRequests
+
+from .cache import MediaCache, get_media_cache
+from .executors import get_agent_executor, submit_with_context
+from .media import clean_text
+from .metrics import record, stage
+from .ratelimit import estimate_content_tokens
+from .routing import RoutePlan, generate_routed
+
+DOCX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+DOCUMENT_MIME_TYPES = {"text/plain", DOCX_MIME_TYPE}
+
+CONDENSE_PROMPT = (
+    "以下は意思決定の判断材料となる文書の一部です。"
+    "事実・数値・日付・固有名詞・リスク・論点を落とさずに、日本語で簡潔に要約してください。"
+    "要約本文のみを出力してください。"
+)
+REDUCE_PROMPT = (
+    "以下は長い文書を区間ごとに要約したものです。"
+    "重複をまとめ、事実・数値・リスク・論点を落とさずに、1つの要約に統合してください。"
+    "要約本文のみを出力してください。"
+)
+TRUNCATED_MARK = "\n…(以下省略)"
+
+
+@dataclass(frozen=True)
+class DocumentPolicy:
+    """
+    chunk_tokens: map ステップで1リクエストに入れる区間の大きさ
+    digest_tokens: ADDITIONAL_TEXT に入れる要約の上限 (これ以下の文書は要約せずそのまま使う)
+    max_levels: reduce を重ねる回数の上限 (超えた分は切り詰める)
+    """
+    chunk_tokens: int = 8000
+    digest_tokens: int = 4000
+    max_levels: int = 3
+
+
+def get_document_policy() -> DocumentPolicy:
+    return DocumentPolicy(
+        chunk_tokens=int(os.getenv("MAGI_DOCUMENT_CHUNK_TOKENS", "8000")),
+        digest_tokens=int(os.getenv("MAGI_DOCUMENT_DIGEST_TOKENS", "4000")),
+        max_levels=int(os.getenv("MAGI_DOCUMENT_MAX_LEVELS", "3")),
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    return estimate_content_tokens(text)
+
+
+def needs_condensing(text: str, policy: Optional[DocumentPolicy] = None) -> bool:
+    return estimate_tokens(text or "") > (policy or get_document_policy()).digest_tokens
+
+
+# ======================================================
+# 読み込み (行・段落単位で逐次取り出す)
+# ======================================================
+def detect_encoding(file, sample_bytes: int = 64 * 1024) -> str:
+    """先頭部分で UTF-8 (BOM 付きを含む) かどうかを判定し、違えば Shift_JIS 系 (cp932) とみなす"""
+    file.seek(0)
+    sample = file.read(sample_bytes)
+    file.seek(0)
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    try:
+        # 末尾で切れた多バイト文字は誤りとしない
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp932"
+
+
+def iter_text_lines(file) -> Iterator[str]:
+    """テキストファイルを1行ずつ読む (全体を1つの文字列にしない)"""
+    reader = io.TextIOWrapper(file, encoding=detect_encoding(file), errors="replace", newline=None)
+    try:
+        for line in reader:
+            yield line.rstrip("\n")
+    finally:
+        # 呼び出し側のファイルを閉じないよう切り離す
+        reader.detach()
+
+
+def iter_docx_paragraphs(file) -> Iterator[str]:
+    """DOCX の段落と表 (1行を " | " 区切り) を文書順に取り出す"""
+    from docx import Document
+    from docx.table import Table
+    from docx.text.paragraph import Paragraph
+
+    document = Document(file)
+    for block in document.element.body.iterchildren():
+        tag = block.tag.rsplit("}", 1)[-1]
+        if tag == "p":
+            yield Paragraph(block, document).text
+        elif tag == "tbl":
+            for row in Table(block, document).rows:
+                yield " | ".join(cell.text.strip() for cell in row.cells)
+
+
+def iter_document_blocks(file, mime_type: str) -> Iterator[str]:
+    if mime_type == DOCX_MIME_TYPE:
+        return iter_docx_paragraphs(file)
+    if mime_type == "text/plain":
+        return iter_text_lines(file)
+    raise ValueError(f"unsupported document type: {mime_type}")
+
+
+def split_chunks(blocks: Iterable[str], max_tokens: int) -> Iterator[str]:
+    """行・段落をまとめて max_tokens 以下の区間にする (1行が長すぎる場合は文字数で分ける)"""
+    max_chars = max(max_tokens * 2, 1)
+    lines: List[str] = []
+    size = 0
+    for block in blocks:
+        while estimate_tokens(block) > max_tokens:
+            head, block = block[:max_chars], block[max_chars:]
+            if lines:
+                yield "\n".join(lines)
+                lines, size = [], 0
+            yield head
+        tokens = estimate_tokens(block)
+        if lines and size + tokens > max_tokens:
+            yield "\n".join(lines)
+            lines, size = [], 0
+        lines.append(block)
+        size += tokens
+    if lines:
+        yield "\n".join(lines)
+
+
+# ======================================================
+# 要約 (map-reduce)
+# ======================================================
+def condense_chunk(text: str, prompt: str, plan: Optional[RoutePlan] = None) -> str:
+    """1区間を要約する (内容のハッシュでキャッシュ)"""
+    with stage("condense_chunk"):
+        cache = get_media_cache()
+        plan = plan or RoutePlan()
+        cache_key = MediaCache.make_key(text.encode("utf-8"), "text/plain", prompt, plan.primary)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            record(cache_hits=1)
+            return cached
+        record(cache_misses=1)
+
+        try:
+            resp = generate_routed(plan, [prompt, text])
+            result = clean_text(resp.text)
+            cache.put(cache_key, result)
+            return result
+        except TooManyRequests:
+            return "ERROR: 429 Quota Exceeded. (System Overload)"
+        except Exception as e:
+            return f"ERROR: {str(e)}"
+
+
+def _collect(futures: Dict[Future, int], on_progress, done_offset: int, total: int) -> List[str]:
+    digests: Dict[int, str] = {}
+    for done, future in enumerate(as_completed(futures), start=done_offset + 1):
+        digests[futures[future]] = future.result()
+        if on_progress:
+            on_progress(done, total)
+    result = []
+    for index in range(len(digests)):
+        text = digests[index]
+        result.append(f"[CHUNK {index + 1} {text}]" if text.startswith("ERROR:") else text)
+    return result
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    return text[:max(max_tokens * 2 - len(TRUNCATED_MARK), 0)] + TRUNCATED_MARK
+
+
+def condense_blocks(
+    blocks: Iterable[str],
+    plan: Optional[RoutePlan] = None,
+    policy: Optional[DocumentPolicy] = None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> str:
+    """
+    行・段落の列を ADDITIONAL_TEXT 用のテキストにする。
+    全体が digest_tokens 以下ならそのまま連結して返す。超える場合は、上限を超えた時点から
+    区間を読みながら要約を投入し (読み込みと要約を重ねる)、要約の連結がまだ大きければ要約どうしを
+    さらに要約する。max_levels 回で収まらない分は切り詰める。
+    """
+    policy = policy or get_document_policy()
+    plan = plan or RoutePlan()
+    executor = get_agent_executor()
+
+    with stage("ingest_document"):
+        chunks: List[str] = []
+        futures: Dict[Future, int] = {}
+        size = 0
+        for chunk in split_chunks(blocks, policy.chunk_tokens):
+            chunks.append(chunk)
+            size += estimate_tokens(chunk)
+            if size > policy.digest_tokens:
+                for index in range(len(futures), len(chunks)):
+                    futures[submit_with_context(executor, condense_chunk, chunks[index], CONDENSE_PROMPT, plan)] = index
+        if not futures:
+            return "\n".join(chunks)
+
+        record(document_chunks=len(chunks))
+        digests = _collect(futures, on_progress, 0, len(chunks))
+        done = len(chunks)
+        for _ in range(policy.max_levels - 1):
+            text = "\n".join(digests)
+            if estimate_tokens(text) <= policy.digest_tokens or len(digests) <= 1:
+                break
+            groups = list(split_chunks(digests, policy.chunk_tokens))
+            futures = {
+                submit_with_context(executor, condense_chunk, group, REDUCE_PROMPT, plan): index
+                for index, group in enumerate(groups)
+            }
+            digests = _collect(futures, on_progress, done, done + len(groups))
+            done += len(groups)
+        return truncate_tokens("\n".join(digests), policy.digest_tokens)
+
+
+def condense_text(
+    text: str,
+    plan: Optional[RoutePlan] = None,
+    policy: Optional[DocumentPolicy] = None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> str:
+    """長い補足テキストを上限内に要約する (上限以下ならそのまま返す)"""
+    return condense_blocks(text.splitlines(), plan, policy, on_progress)
+
+
+def ingest_document(
+    file,
+    mime_type: str,
+    plan: Optional[RoutePlan] = None,
+    text: str = "",
+    policy: Optional[DocumentPolicy] = None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> str:
+    """
+    .txt / .docx を読み込み、ADDITIONAL_TEXT 用のテキストにする。
+    text (入力欄の補足テキスト) を渡すと、文書の要約の前に置いて combine_text で上限内に収める。
+    """
+    digest = condense_blocks(iter_document_blocks(file, mime_type), plan, policy, on_progress)
+    return combine_text(text, digest, plan, policy)
+
+
+def combine_text(
+    text: str, digest: str, plan: Optional[RoutePlan] = None, policy: Optional[DocumentPolicy] = None
+) -> str:
+    """補足テキストと文書の要約を合わせる。上限を超える場合だけ、合わせたものをさらに要約する"""
+    return condense_text("\n".join(part for part in (text, digest) if part), plan, policy)
+
+
+def combine_document(
+    text: str, document: Future, plan: Optional[RoutePlan] = None, policy: Optional[DocumentPolicy] = None
+) -> str:
+    """要約中の文書 (ingest_document の Future) を待ち、補足テキストと合わせる"""
+    return combine_text(text, document.result(), plan, policy)
@@ -0,0 +1,78 @@
+"""
+共有スレッドプールと、ワーカースレッドへの実行コンテキスト引き継ぎ・通知フック。
+UI (Streamlit) に依存しないよう、フックは呼び出し側 (app.py など) が登録する。
+"""
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, List
+
+logger = logging.getLogger("magi")
+
+# capture() をスクリプトスレッドで呼び、戻り値の関数をワーカースレッドで呼ぶ
+_context_propagators: List[Callable[[], Callable[[], None]]] = []
+_notifier: Callable[[str, str], None] = lambda message, icon: logger.info(message)
+
+
+def register_context_propagator(capture: Callable[[], Callable[[], None]]) -> None:
+    if capture not in _context_propagators:
+        _context_propagators.append(capture)
+
+
+def set_notifier(notifier: Callable[[str, str], None]) -> None:
+    """リトライ・フェイルオーバーなどの通知先を差し替える (例: st.toast)"""
+    global _notifier
+    _notifier = notifier
+
+
+def notify(message: str, icon: str = "ℹ️") -> None:
+    try:
+        _notifier(message, icon)
+    except Exception:
+        logger.info(message)
+
+
+@lru_cache(maxsize=None)
+def get_agent_executor() -> ThreadPoolExecutor:
+    """全セッションで共有する、上限つきのエージェント実行スレッドプール"""
+    return ThreadPoolExecutor(
+        max_workers=int(os.getenv("MAGI_AGENT_WORKERS", "8")),
+        thread_name_prefix="magi-agent",
+    )
+
+
+@lru_cache(maxsize=None)
+def get_media_executor() -> ThreadPoolExecutor:
+    """
+    バックグラウンドのメディア解析用スレッドプール。
+    解析処理は内部でエージェント用プールに区間ごとの書き起こしを投入して待つため、同じプールには載せない。
+    """
+    return ThreadPoolExecutor(
+        max_workers=int(os.getenv("MAGI_MEDIA_WORKERS", "4")),
+        thread_name_prefix="magi-media",
+    )
+
+
+@lru_cache(maxsize=None)
+def get_report_executor() -> ThreadPoolExecutor:
+    """レポート作成用のスレッドプール (審議結果の表示をレポート作成で待たせない)"""
+    return ThreadPoolExecutor(
+        max_workers=int(os.getenv("MAGI_REPORT_WORKERS", "2")),
+        thread_name_prefix="magi-report",
+    )
+
+
+def submit_with_context(executor: ThreadPoolExecutor, fn, *args) -> Future:
+    """
+    登録済みの実行コンテキスト (Streamlit のスクリプトコンテキストなど) を引き継いで投入する。
+    (generate_with_retry 内の通知などがワーカーからも表示されるように)
+    """
+    appliers = [capture() for capture in _context_propagators]
+
+    def run():
+        for apply in appliers:
+            apply()
+        return fn(*args)
+
+    return executor.submit(run)
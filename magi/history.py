@@ -0,0 +1,164 @@
+"""
+審議履歴: すべての審議を追記のみで SQLite に記録し、FTS5 で全文検索する。
+一覧は要約列だけを返し、生の出力 (raw_result) は個別に開いた時にだけ読み込む。
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("magi")
+
+# 全文検索の対象列 (日本語は分かち書きしないため trigram で部分一致させる)
+SEARCH_COLUMNS = ("user_question", "text_input", "image_description", "audio_transcript", "integration")
+
+
+@dataclass(frozen=True)
+class HistoryEntry:
+    """一覧表示用の要約 (raw_result は含まない)"""
+    id: int
+    created: float
+    model: str
+    engine: str
+    source: str
+    elapsed: float
+    user_question: str
+    verdicts: Dict[str, str]
+    conclusion: str
+
+
+class HistoryStore:
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS deliberations ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL NOT NULL,"
+                " model TEXT NOT NULL, engine TEXT NOT NULL, swot INTEGER NOT NULL,"
+                " source TEXT NOT NULL, elapsed REAL NOT NULL, cache_key TEXT,"
+                " user_question TEXT, text_input TEXT, image_description TEXT, audio_transcript TEXT,"
+                " verdicts TEXT NOT NULL, conclusion TEXT, integration TEXT, raw_result TEXT NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS deliberations_created ON deliberations (created)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS deliberations_cache_key ON deliberations (cache_key)")
+            self._conn.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS deliberations_fts USING fts5("
+                f" {', '.join(SEARCH_COLUMNS)}, content='deliberations', content_rowid='id', tokenize='trigram')"
+            )
+
+    def record(
+        self,
+        context: Dict[str, Any],
+        sections: Dict[str, Any],
+        raw_result: str,
+        model: str,
+        engine: str,
+        enable_swot: bool,
+        source: str,
+        elapsed: float,
+        cache_key: Optional[str] = None,
+    ) -> int:
+        verdicts = {tag: sec["decision"] for tag, sec in sections.items() if "decision" in sec and tag != "INTEGRATION"}
+        integration = sections.get("INTEGRATION", {})
+        conclusion = integration.get("raw", "").split("詳細:")[0].replace("結論:", "").strip()
+        row = {
+            "created": time.time(), "model": model, "engine": engine, "swot": int(bool(enable_swot)),
+            "source": source, "elapsed": round(elapsed, 3), "cache_key": cache_key,
+            "user_question": context.get("user_question", ""), "text_input": context.get("text_input", ""),
+            "image_description": context.get("image_description", ""),
+            "audio_transcript": context.get("audio_transcript", ""),
+            "verdicts": json.dumps(verdicts, ensure_ascii=False), "conclusion": conclusion,
+            "integration": integration.get("raw", ""), "raw_result": raw_result,
+        }
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                f"INSERT INTO deliberations ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                tuple(row.values()),
+            )
+            self._conn.execute(
+                f"INSERT INTO deliberations_fts (rowid, {', '.join(SEARCH_COLUMNS)})"
+                f" VALUES (?, {', '.join('?' * len(SEARCH_COLUMNS))})",
+                (cursor.lastrowid, *(row[column] for column in SEARCH_COLUMNS)),
+            )
+            return cursor.lastrowid
+
+    def _where(self, query: Optional[str]):
+        """検索条件。trigram は3文字未満を扱えないため、短い語は LIKE で探す"""
+        query = (query or "").strip()
+        if not query:
+            return "", ()
+        if len(query) >= 3:
+            phrase = '"' + query.replace('"', '""') + '"'
+            return "WHERE id IN (SELECT rowid FROM deliberations_fts WHERE deliberations_fts MATCH ?)", (phrase,)
+        pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        clause = " OR ".join(f"{column} LIKE ? ESCAPE '\\'" for column in SEARCH_COLUMNS)
+        return f"WHERE ({clause})", (pattern,) * len(SEARCH_COLUMNS)
+
+    def count(self, query: Optional[str] = None) -> int:
+        where, params = self._where(query)
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM deliberations {where}", params).fetchone()[0]
+
+    def page(self, offset: int = 0, limit: int = 10, query: Optional[str] = None) -> List[HistoryEntry]:
+        """新しい順の一覧 (query を指定すると全文検索の結果に絞る)"""
+        where, params = self._where(query)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, created, model, engine, source, elapsed, user_question, verdicts, conclusion"
+                f" FROM deliberations {where} ORDER BY id DESC LIMIT ? OFFSET ?",
+                (*params, limit, offset),
+            ).fetchall()
+        return [HistoryEntry(**{**dict(row), "verdicts": json.loads(row["verdicts"])}) for row in rows]
+
+    def get_summary(self, entry_id: int) -> Optional[HistoryEntry]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, created, model, engine, source, elapsed, user_question, verdicts, conclusion"
+                " FROM deliberations WHERE id = ?",
+                (entry_id,),
+            ).fetchone()
+        return None if row is None else HistoryEntry(**{**dict(row), "verdicts": json.loads(row["verdicts"])})
+
+    def texts_after(self, entry_id: int, limit: int = 256) -> List[Tuple[int, Dict[str, str]]]:
+        """id が entry_id より大きい履歴の (id, 質問と補足テキスト) を古い順に返す (類似検索の索引用)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, user_question, text_input FROM deliberations WHERE id > ? ORDER BY id LIMIT ?",
+                (entry_id, limit),
+            ).fetchall()
+        return [(row["id"], {"user_question": row["user_question"] or "", "text_input": row["text_input"] or ""})
+                for row in rows]
+
+    def get(self, entry_id: int) -> Optional[Dict[str, Any]]:
+        """1件分の全列 (raw_result を含む)"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM deliberations WHERE id = ?", (entry_id,)).fetchone()
+        if row is None:
+            return None
+        return {**dict(row), "verdicts": json.loads(row["verdicts"])}
+
+
+@lru_cache(maxsize=None)
+def get_history_store() -> Optional[HistoryStore]:
+    """
+    MAGI_HISTORY_DB を空にすると履歴を記録しない。
+    開けない場合 (FTS5 / trigram 非対応、書き込み不可、ロック中) は1度だけ警告して None を返し、失敗ごとキャッシュする
+    """
+    path = os.getenv("MAGI_HISTORY_DB", os.path.join(".magi_cache", "history.sqlite3"))
+    if not path:
+        return None
+    try:
+        return HistoryStore(path)
+    except (sqlite3.Error, OSError) as e:
+        logger.warning("deliberation history disabled: cannot open %s: %s", path, e)
+        return None
@@ -0,0 +1,207 @@
+"""
+審議ジョブ: 審議をプロセス共通のワーカープールで実行し、ジョブ ID で状態を引けるようにする。
+UI のスクリプト実行 (再実行・切断・二重クリック) と審議の実行を切り離し、
+同じ要求が実行中なら新しく始めずにそのジョブに合流する。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Dict, Mapping, Optional
+
+from .core import RoundPolicy, get_round_policy, run_deliberation
+from .executors import submit_with_context
+from .metrics import get_metrics, record, start_trace
+from .routing import RoutePlan
+
+JOB_STATES = ("queued", "running", "done", "failed")
+
+
+class DeliberationJob:
+    """
+    1件の審議。ワーカーが書き込み、UI はスナップショットを読む。
+    sections には受信済みのセクションが入る (ストリーミング表示用)。
+    """
+
+    def __init__(self, key: str, context: Dict[str, Any], enable_swot: bool, engine: str, model: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.key = key
+        self.context = context
+        self.enable_swot = enable_swot
+        self.engine = engine
+        self.model = model
+        self.status = "queued"
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.result: Optional[str] = None
+        self.error: Optional[str] = None
+        self.future: Optional[Future] = None
+        self._sections: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def on_section(self, tag: str, sec: Dict[str, Any]) -> None:
+        with self._lock:
+            self._sections[tag] = sec
+
+    @property
+    def sections(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return dict(self._sections)
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "failed")
+
+    @property
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+
+def request_key(
+    context: Dict[str, Any],
+    enable_swot: bool,
+    engine: str,
+    plan: RoutePlan,
+    policy: RoundPolicy,
+    media: Optional[Mapping[str, Future]] = None,
+) -> str:
+    """
+    同じ要求かどうかの判定に使うキー。解析中のメディアは結果が未定のため、Future そのもので区別する
+    (同じセッションでの二重クリックは同じ Future を渡すので合流する)。
+    """
+    pending = {key: id(future) for key, future in (media or {}).items()}
+    payload = json.dumps({
+        "context": {k: str(v) for k, v in context.items() if k not in pending},
+        "media": pending,
+        "swot": bool(enable_swot),
+        "engine": engine,
+        "models": list(plan.models),
+        "hedge": plan.hedge_percentile,
+        "policy": policy.cache_variant(),
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class JobQueue:
+    """
+    上限つきのワーカープールと、ジョブ ID → ジョブの登録簿。
+    完了したジョブは ttl_seconds の間だけ保持する (再接続・再実行した画面から結果を受け取れるように)。
+    """
+
+    def __init__(self, max_workers: int = 4, ttl_seconds: float = 1800):
+        self.max_workers = max_workers
+        self.ttl_seconds = ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="magi-job")
+        self._jobs: Dict[str, DeliberationJob] = {}
+        self._active: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, job: DeliberationJob, fn: Callable[[DeliberationJob], Optional[str]]) -> DeliberationJob:
+        """
+        fn(job) をワーカーで実行する。同じ key のジョブが待機中・実行中なら、投入せずにそれを返す。
+        fn の戻り値が SYSTEM FAILURE の場合や例外の場合は failed になる。
+        """
+        with self._lock:
+            self._prune()
+            active = self._jobs.get(self._active.get(job.key, ""))
+            if active is not None and not active.done:
+                record(jobs_joined=1)
+                return active
+            self._jobs[job.id] = job
+            self._active[job.key] = job.id
+            job.future = submit_with_context(self._executor, self._run, job, fn)
+        self._update_gauges()
+        return job
+
+    def _run(self, job: DeliberationJob, fn: Callable[[DeliberationJob], Optional[str]]) -> None:
+        job.status, job.started = "running", time.time()
+        self._update_gauges()
+        try:
+            with start_trace("deliberation", model=job.model, engine=job.engine, swot=job.enable_swot, job=job.id):
+                job.result = fn(job)
+            failed = not job.result or "SYSTEM FAILURE" in job.result
+            job.error = (job.result or "UNKNOWN ERROR") if failed else None
+        except Exception as e:
+            failed = True
+            job.error = f"SYSTEM FAILURE: {str(e)}"
+        finally:
+            job.finished = time.time()
+            with self._lock:
+                job.status = "failed" if failed else "done"
+                if self._active.get(job.key) == job.id:
+                    del self._active[job.key]
+            self._update_gauges()
+
+    def get(self, job_id: Optional[str]) -> Optional[DeliberationJob]:
+        with self._lock:
+            return self._jobs.get(job_id or "")
+
+    def position(self, job: DeliberationJob) -> int:
+        """待機中のジョブが何番目に開始されるか (1 始まり。待機中でなければ 0)"""
+        if job.status != "queued":
+            return 0
+        with self._lock:
+            return sum(1 for other in self._jobs.values() if other.status == "queued" and other.created <= job.created)
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            counts = {state: 0 for state in JOB_STATES}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+        return counts
+
+    def _prune(self) -> None:
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items() if job.done and now - job.finished > self.ttl_seconds]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _update_gauges(self) -> None:
+        counts = self.counts()
+        metrics = get_metrics()
+        metrics.set_gauge("job_queue_depth", counts["queued"])
+        metrics.set_gauge("jobs_running", counts["running"])
+
+
+@lru_cache(maxsize=None)
+def get_job_queue() -> JobQueue:
+    """全セッションで共有する審議ジョブのキュー (同時に実行する審議数は MAGI_JOB_WORKERS まで)"""
+    return JobQueue(
+        max_workers=int(os.getenv("MAGI_JOB_WORKERS", "4")),
+        ttl_seconds=float(os.getenv("MAGI_JOB_TTL", "1800")),
+    )
+
+
+def enqueue_deliberation(
+    context: Dict[str, Any],
+    enable_swot: bool = False,
+    engine: str = "single",
+    plan: Optional[RoutePlan] = None,
+    force: bool = False,
+    media: Optional[Mapping[str, Future]] = None,
+    policy: Optional[RoundPolicy] = None,
+    stream: bool = True,
+) -> DeliberationJob:
+    """
+    run_deliberation をジョブとして投入し、すぐに返る。同じ要求が実行中ならそのジョブを返す。
+    stream=True なら受信したセクションを job.sections に順次反映する。
+    """
+    plan = plan or RoutePlan()
+    policy = policy or get_round_policy()
+    key = request_key(context, enable_swot, engine, plan, policy, media)
+    job = DeliberationJob(key, context, enable_swot, engine, plan.primary)
+
+    def run(job: DeliberationJob) -> Optional[str]:
+        return run_deliberation(
+            job.context, enable_swot, engine, job.on_section if stream else None,
+            force=force, plan=plan, media=media, policy=policy,
+        )
+
+    return get_job_queue().submit(job, run)
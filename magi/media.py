@@ -0,0 +1,300 @@
+"""
+メディア処理: 画像の前処理、画像・音声の解析、長時間音声の分割書き起こし。
+"""
+import bisect
+import io
+import os
+import wave
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from google.api_core.exceptions import TooManyRequests
+
+from .cache import MediaCache, get_media_cache
+from .executors import get_agent_executor, get_media_executor, submit_with_context
+from .metrics import record, stage, start_trace
+from .routing import RoutePlan, generate_routed
+
+
+def clean_text(text: str) -> str:
+    if not text: return ""
+    return text.replace("*", "").strip()
+
+
+# ======================================================
+# 画像前処理 (向き補正 → 縮小 → 1回だけ再エンコード)
+# ======================================================
+IMAGE_FORMATS = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+@dataclass(frozen=True)
+class PreparedImage:
+    """モデル送信・プレビュー・レポートで共用する前処理済み画像"""
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+
+
+def prepare_image(raw: bytes, max_edge: int = 1536, fmt: str = "JPEG", quality: int = 85) -> PreparedImage:
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(raw)) as src:
+        img = ImageOps.exif_transpose(src)
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        if img.mode not in ("RGB", "L"):
+            # JPEG は透過を扱えないため、白背景に合成する
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            rgba = img.convert("RGBA")
+            background.paste(rgba, mask=rgba.getchannel("A"))
+            img = background
+
+        buf = io.BytesIO()
+        img.save(buf, format=fmt, quality=quality, optimize=True)
+        return PreparedImage(buf.getvalue(), IMAGE_FORMATS[fmt], img.width, img.height)
+
+
+def analyze_media(data: bytes, mime_type: str, prompt: str, plan: Optional[RoutePlan] = None) -> str:
+    """画像や音声を解析する汎用関数（リトライ・キャッシュ付き）"""
+    with stage("analyze_media"):
+        cache = get_media_cache()
+        plan = plan or RoutePlan()
+        cache_key = MediaCache.make_key(data, mime_type, prompt, plan.primary)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            record(cache_hits=1)
+            return cached
+        record(cache_misses=1)
+
+        try:
+            content = [prompt, {"mime_type": mime_type, "data": data}]
+
+            # リトライ付きで実行
+            resp = generate_routed(plan, content)
+            result = clean_text(resp.text)
+            cache.put(cache_key, result)
+            return result
+        except TooManyRequests:
+            return "ERROR: 429 Quota Exceeded. (System Overload)"
+        except Exception as e:
+            return f"ERROR: {str(e)}"
+
+
+# ======================================================
+# 音声の分割書き起こし (長時間録音向け)
+# ======================================================
+WAV_MIME_TYPES = {"audio/wav", "audio/x-wav", "audio/wave", "audio/vnd.wave"}
+MP3_MIME_TYPES = {"audio/mpeg", "audio/mp3", "audio/mpeg3", "audio/x-mpeg-3"}
+
+# MPEG Audio ビットレート表 (kbps)。キーは (MPEG1 かどうか, レイヤー)
+MP3_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+@dataclass(frozen=True)
+class AudioChunk:
+    index: int
+    start: float
+    end: float
+    data: bytes
+    mime_type: str
+
+
+def window_starts(duration: float, window_sec: float, overlap_sec: float):
+    """duration 秒の録音を、overlap_sec 秒ずつ重なる window_sec 秒の区間に分ける"""
+    step = max(window_sec - overlap_sec, 1.0)
+    start = 0.0
+    while True:
+        yield start, min(start + window_sec, duration)
+        if start + window_sec >= duration:
+            break
+        start += step
+
+
+def count_windows(duration: float, window_sec: float, overlap_sec: float) -> int:
+    return sum(1 for _ in window_starts(duration, window_sec, overlap_sec))
+
+
+def split_wav(file, window_sec: float, overlap_sec: float):
+    """WAV を区間ごとに読み出し、それぞれ単独の WAV として返す (全体のコピーは作らない)"""
+    file.seek(0)
+    with wave.open(file, "rb") as src:
+        params = src.getparams()
+        rate = src.getframerate()
+        duration = src.getnframes() / rate
+        for index, (start, end) in enumerate(window_starts(duration, window_sec, overlap_sec)):
+            src.setpos(int(start * rate))
+            frames = src.readframes(int((end - start) * rate))
+            buf = io.BytesIO()
+            with wave.open(buf, "wb") as dst:
+                dst.setparams(params)
+                dst.writeframes(frames)
+            yield AudioChunk(index, start, end, buf.getvalue(), "audio/wav")
+
+
+def scan_mp3_frames(data: memoryview):
+    """MP3 のフレーム境界を走査し、(バイト位置, 開始秒) のリストと総再生時間を返す"""
+    pos = 0
+    # ID3v2 タグはスキップする
+    if bytes(data[:3]) == b"ID3" and len(data) >= 10:
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        pos = 10 + size
+
+    frames = []
+    elapsed = 0.0
+    length = len(data)
+    while pos + 4 <= length:
+        b1, b2 = data[pos + 1], data[pos + 2]
+        if data[pos] != 0xFF or (b1 & 0xE0) != 0xE0:
+            pos += 1
+            continue
+        version = (b1 >> 3) & 0x03
+        layer = 4 - ((b1 >> 1) & 0x03)
+        bitrate_index = b2 >> 4
+        rate_index = (b2 >> 2) & 0x03
+        if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+            pos += 1
+            continue
+
+        mpeg1 = version == 3
+        bitrate = MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+        sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+        padding = (b2 >> 1) & 0x01
+        if layer == 1:
+            frame_len = (12 * bitrate // sample_rate + padding) * 4
+            samples = 384
+        elif layer == 2 or mpeg1:
+            frame_len = 144 * bitrate // sample_rate + padding
+            samples = 1152
+        else:
+            frame_len = 72 * bitrate // sample_rate + padding
+            samples = 576
+
+        frames.append((pos, elapsed))
+        elapsed += samples / sample_rate
+        pos += frame_len
+
+    return frames, elapsed
+
+
+def split_mp3(data: memoryview, window_sec: float, overlap_sec: float, scanned=None):
+    """
+    MP3 をフレーム境界で区間に分ける (デコードせず、取り出した区間だけをコピーする)。
+    scanned に scan_mp3_frames の結果を渡すと、走査をやり直さない。
+    """
+    frames, duration = scanned or scan_mp3_frames(data)
+    if not frames:
+        return
+    offsets = [offset for offset, _ in frames]
+    times = [t for _, t in frames]
+    for index, (start, end) in enumerate(window_starts(duration, window_sec, overlap_sec)):
+        first = bisect.bisect_left(times, start)
+        last = bisect.bisect_left(times, end)
+        stop = offsets[last] if last < len(offsets) else len(data)
+        yield AudioChunk(index, start, end, bytes(data[offsets[first]:stop]), "audio/mpeg")
+
+
+def split_audio(data: bytes, mime_type: str, window_sec: float, overlap_sec: float) -> Tuple[int, Iterator[AudioChunk]]:
+    """
+    区間の数と、区間を1つずつ作るイテレータを返す (全区間を同時にメモリに置かない)。
+    分割に対応しない形式は区間数 0 を返す。
+    """
+    if mime_type in WAV_MIME_TYPES:
+        # bytes から作る BytesIO は元のバッファを共有する (コピーしない)
+        file = io.BytesIO(data)
+        with wave.open(file, "rb") as src:
+            duration = src.getnframes() / src.getframerate()
+        return count_windows(duration, window_sec, overlap_sec), split_wav(file, window_sec, overlap_sec)
+    if mime_type in MP3_MIME_TYPES:
+        view = memoryview(data)
+        frames, duration = scan_mp3_frames(view)
+        if frames:
+            return count_windows(duration, window_sec, overlap_sec), split_mp3(
+                view, window_sec, overlap_sec, (frames, duration)
+            )
+    return 0, iter(())
+
+
+def merge_transcripts(previous: str, current: str, max_overlap: int = 200, min_overlap: int = 8) -> str:
+    """区間の重なりで二重に書き起こされた部分を取り除いて連結する"""
+    limit = min(max_overlap, len(previous), len(current))
+    for size in range(limit, min_overlap - 1, -1):
+        if previous.endswith(current[:size]):
+            return previous + current[size:]
+    return f"{previous}\n{current}" if previous else current
+
+
+def transcribe_audio_chunked(
+    audio: bytes,
+    mime_type: str,
+    prompt: str,
+    window_sec: float = 120,
+    overlap_sec: float = 5,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+    plan: Optional[RoutePlan] = None,
+    max_in_flight: Optional[int] = None,
+) -> str:
+    """
+    録音を重なりつきの区間に分けて並列に書き起こし、順番どおりに連結する。
+    区間は1つずつ切り出して投入し、同時に送信中の区間は max_in_flight
+    (既定は MAGI_AUDIO_IN_FLIGHT、4) までにする。録音の bytes はコピーせずに読む。
+    区間が1つしかない場合や形式が分割に対応しない場合は、そのまま1回で書き起こす。
+    """
+    total, chunks = split_audio(audio, mime_type, window_sec, overlap_sec)
+    if total <= 1:
+        return analyze_media(audio, mime_type, prompt, plan)
+
+    max_in_flight = max(1, max_in_flight or int(os.getenv("MAGI_AUDIO_IN_FLIGHT", "4")))
+    executor = get_agent_executor()
+    pending: Dict[Future, int] = {}
+    transcripts: Dict[int, str] = {}
+
+    def collect(futures) -> None:
+        for future in futures:
+            transcripts[pending.pop(future)] = future.result()
+            if on_progress:
+                on_progress(len(transcripts), total)
+
+    for chunk in chunks:
+        if len(pending) >= max_in_flight:
+            collect(wait(pending, return_when=FIRST_COMPLETED).done)
+        chunk_prompt = (
+            f"{prompt}\n"
+            f"(これは長い録音の {chunk.index + 1}/{total} 番目の区間 "
+            f"{chunk.start:.0f}秒〜{chunk.end:.0f}秒 です。前後の区間と {overlap_sec:.0f} 秒重なっています。"
+            "書き起こし本文のみを出力してください。)"
+        )
+        pending[submit_with_context(executor, analyze_media, chunk.data, chunk.mime_type, chunk_prompt, plan)] = chunk.index
+    while pending:
+        collect(wait(pending, return_when=FIRST_COMPLETED).done)
+
+    result = ""
+    for index in range(total):
+        text = transcripts[index]
+        if text.startswith("ERROR:"):
+            text = f"[CHUNK {index + 1} {text}]"
+        result = merge_transcripts(result, text)
+    return result
+
+
+# ======================================================
+# バックグラウンド解析 (アップロード直後に開始し、審議側で結果を待つ)
+# ======================================================
+def start_media_analysis(field: str, fn: Callable[..., str], *args, **kwargs) -> Future:
+    """
+    analyze_media / transcribe_audio_chunked をメディア用プールで開始し、結果の Future を返す。
+    field は結果を入れる context のキー (image_description / audio_transcript)。
+    """
+    def job():
+        with start_trace("media_analysis", field=field):
+            return fn(*args, **kwargs)
+
+    return submit_with_context(get_media_executor(), job)
@@ -0,0 +1,225 @@
+"""
+軽量トレーシング: リクエストごとのステージ所要時間・リトライ・トークン数・キャッシュヒットを記録し、
+Prometheus テキスト形式や JSONL で書き出す。
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import groupby
+from typing import Any, Dict, List, Optional
+
+from .executors import register_context_propagator
+
+# ステージ所要時間のヒストグラム境界 (秒)
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+COUNTER_NAMES = (
+    "retries",
+    "backoff_seconds",
+    "rate_limit_wait_seconds",
+    "prompt_tokens",
+    "response_tokens",
+    "cache_hits",
+    "cache_misses",
+    "coalesced",
+    "rounds",
+    "agents_skipped",
+    "schema_failures",
+    "document_chunks",
+    "jobs_joined",
+    "fields_fitted",
+)
+
+
+class Trace:
+    """1リクエスト分の計測結果。ワーカースレッドからも書き込まれる"""
+
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.started = time.time()
+        self.elapsed: Optional[float] = None
+        self.stages: List[Dict[str, Any]] = []
+        self.counters: Dict[str, float] = {key: 0 for key in COUNTER_NAMES}
+        self.attributes: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.stages.append({"stage": name, "seconds": round(seconds, 4)})
+
+    def add(self, key: str, value: float) -> None:
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "id": self.id,
+                "name": self.name,
+                "started": self.started,
+                "elapsed": self.elapsed,
+                "stages": list(self.stages),
+                "counters": dict(self.counters),
+                "attributes": dict(self.attributes),
+            }
+
+
+class MetricsRegistry:
+    """プロセス全体の集計値 (ステージ別ヒストグラムとカウンタ) と直近のトレース"""
+
+    def __init__(self, jsonl_path: Optional[str] = None, history: int = 100):
+        self.jsonl_path = jsonl_path
+        self._lock = threading.Lock()
+        self._stage_buckets: Dict[str, List[int]] = {}
+        self._stage_sum: Dict[str, float] = {}
+        self._stage_count: Dict[str, int] = {}
+        self._counters: Dict[str, float] = {key: 0 for key in COUNTER_NAMES}
+        self._gauges: Dict[str, Any] = {}
+        self.recent: deque = deque(maxlen=history)
+
+    def observe_stage(self, name: str, seconds: float) -> None:
+        with self._lock:
+            buckets = self._stage_buckets.setdefault(name, [0] * len(LATENCY_BUCKETS))
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+            self._stage_sum[name] = self._stage_sum.get(name, 0.0) + seconds
+            self._stage_count[name] = self._stage_count.get(name, 0) + 1
+
+    def add(self, key: str, value: float) -> None:
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, labels: Optional[Dict[str, str]] = None) -> None:
+        label_key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            self._gauges[(name, label_key)] = value
+
+    def finish(self, trace: Trace) -> None:
+        record = trace.to_dict()
+        self.recent.append(record)
+        if self.jsonl_path:
+            with self._lock, open(self.jsonl_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                name: {
+                    "count": self._stage_count[name],
+                    "mean_seconds": self._stage_sum[name] / self._stage_count[name],
+                }
+                for name in self._stage_count
+            }
+
+    def counters(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._counters)
+
+    def to_prometheus(self) -> str:
+        lines = [
+            "# HELP magi_stage_seconds Wall time per pipeline stage.",
+            "# TYPE magi_stage_seconds histogram",
+        ]
+        with self._lock:
+            for name, buckets in sorted(self._stage_buckets.items()):
+                for bound, count in zip(LATENCY_BUCKETS, buckets):
+                    lines.append(f'magi_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+                lines.append(f'magi_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {self._stage_count[name]}')
+                lines.append(f'magi_stage_seconds_sum{{stage="{name}"}} {self._stage_sum[name]:.6f}')
+                lines.append(f'magi_stage_seconds_count{{stage="{name}"}} {self._stage_count[name]}')
+            for key, value in sorted(self._counters.items()):
+                lines.append(f"# HELP magi_{key}_total Cumulative {key.replace('_', ' ')}.")
+                lines.append(f"# TYPE magi_{key}_total counter")
+                lines.append(f"magi_{key}_total {value:g}")
+            # HELP/TYPE はメトリクス名ごとに1回だけ出し、ラベル違いの系列はその下にまとめる
+            for name, series in groupby(sorted(self._gauges.items()), key=lambda item: item[0][0]):
+                lines.append(f"# HELP magi_{name} Current value of {name.replace('_', ' ')}.")
+                lines.append(f"# TYPE magi_{name} gauge")
+                for (_, labels), value in series:
+                    label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                    selector = f"{{{label_text}}}" if label_text else ""
+                    lines.append(f"magi_{name}{selector} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def recent_jsonl(self) -> str:
+        return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in list(self.recent))
+
+
+@lru_cache(maxsize=None)
+def get_metrics() -> MetricsRegistry:
+    return MetricsRegistry(jsonl_path=os.getenv("MAGI_METRICS_JSONL") or None)
+
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("magi_trace", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def _capture_trace():
+    trace = _current_trace.get()
+    return lambda: _current_trace.set(trace)
+
+
+# 並列エンジンなどのワーカースレッドにも同じトレースを引き継ぐ
+register_context_propagator(_capture_trace)
+
+
+@contextmanager
+def start_trace(name: str, **attributes):
+    """リクエスト単位の計測を開始する。ブロックを抜けると集計・書き出しを行う"""
+    trace = Trace(name)
+    trace.attributes.update(attributes)
+    token = _current_trace.set(trace)
+    start = time.monotonic()
+    try:
+        yield trace
+    finally:
+        trace.elapsed = round(time.monotonic() - start, 4)
+        _current_trace.reset(token)
+        get_metrics().finish(trace)
+
+
+@contextmanager
+def stage(name: str):
+    """ステージの所要時間を、現在のトレースとプロセス全体の集計の両方に記録する"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        seconds = time.monotonic() - start
+        get_metrics().observe_stage(name, seconds)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_stage(name, seconds)
+
+
+def record(**counters: float) -> None:
+    metrics = get_metrics()
+    trace = _current_trace.get()
+    for key, value in counters.items():
+        if not value:
+            continue
+        metrics.add(key, value)
+        if trace is not None:
+            trace.add(key, value)
+
+
+def record_usage(response) -> None:
+    """Gemini の usage_metadata からトークン数を記録する (ローカルモデルなど情報がない場合は何もしない)"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    record(
+        prompt_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+        response_tokens=getattr(usage, "candidates_token_count", 0) or 0,
+    )
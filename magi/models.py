@@ -0,0 +1,369 @@
+"""
+モデル定義とバックエンド (Gemini / ローカル CPU モデル)。
+"""
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Any, Dict, Optional, Set, Tuple
+
+from google.api_core.exceptions import GoogleAPIError, NotFound
+
+from .schema import RESPONSE_SCHEMAS
+from .singleflight import SingleFlight, request_key
+
+logger = logging.getLogger("magi")
+
+DEFAULT_MODEL = "gemini-1.5-flash"
+
+# backend: MODEL_BACKENDS のキー / rpm・tpm: レート制限 (全セッションで共有)
+# tier: "fast" は小さいプロンプトの既定の送り先 / context: 入力の上限トークン数
+# price: 100万トークンあたりの料金 (USD, 入力・出力)。概算表示にだけ使う
+MODEL_CHOICES = {
+    "Gemini 1.5 Flash (Stable)": {
+        "name": "gemini-1.5-flash", "backend": "gemini", "rpm": 15, "tpm": 1_000_000,
+        "tier": "fast", "context": 1_048_576, "price": (0.075, 0.30),
+    },
+    "Gemini 2.0 Flash (Preview)": {
+        "name": "gemini-2.0-flash", "backend": "gemini", "rpm": 15, "tpm": 1_000_000,
+        "tier": "fast", "context": 1_048_576, "price": (0.10, 0.40),
+    },
+    "Gemini 1.5 Pro (High-Spec)": {
+        "name": "gemini-1.5-pro", "backend": "gemini", "rpm": 2, "tpm": 32_000,
+        "tier": "pro", "context": 2_097_152, "price": (1.25, 5.00),
+    },
+    "Local CPU (Offline)": {
+        "name": "local", "backend": "local", "rpm": 600, "tpm": 10_000_000,
+        "tier": "local", "context": 32_768, "price": (0.0, 0.0),
+    },
+}
+
+
+# google.generativeai は読み込みに時間がかかるため (起動時間の大半)、Gemini を使う時まで import しない
+_configured_key: Optional[str] = None
+_configure_lock = threading.Lock()
+
+
+def configure_api(api_key: Optional[str]) -> bool:
+    """Gemini の API キーを設定する。キーがなければ False (ローカルモデルのみで動作)。同じキーなら何もしない"""
+    global _configured_key
+    if not api_key:
+        return False
+    with _configure_lock:
+        if api_key != _configured_key:
+            import google.generativeai as genai
+
+            genai.configure(api_key=api_key)
+            # 作成済みのクライアントは古いキーを保持しているため作り直す
+            gemini_client.cache_clear()
+            _configured_key = api_key
+    return True
+
+
+def generation_config(response_schema: Optional[str]) -> Optional[Dict[str, Any]]:
+    """構造化出力の指定 (response_schema は RESPONSE_SCHEMAS の名前)"""
+    if response_schema is None:
+        return None
+    return {"response_mime_type": "application/json", "response_schema": RESPONSE_SCHEMAS[response_schema]}
+
+
+@lru_cache(maxsize=64)
+def gemini_client(model_name: str, system_instruction: Optional[str] = None, response_schema: Optional[str] = None):
+    """設定済みの GenerativeModel をモデル名 × システム指示 × 出力スキーマごとに1つだけ作り、全スレッドで共有する"""
+    import google.generativeai as genai
+
+    return genai.GenerativeModel(
+        model_name, system_instruction=system_instruction, generation_config=generation_config(response_schema)
+    )
+
+
+def get_model_spec(model_name: str) -> Dict[str, Any]:
+    for spec in MODEL_CHOICES.values():
+        if spec["name"] == model_name:
+            return spec
+    raise KeyError(model_name)
+
+
+def get_gemini_model(
+    model_name: str = DEFAULT_MODEL, system_instruction: Optional[str] = None, response_schema: Optional[str] = None
+):
+    """
+    モデル名に対応するバックエンド (generate_content を持つオブジェクト) を返す。
+    system_instruction には固定のペルソナ・書式プロンプトを渡し、リクエストごとの内容とは分けて送る。
+    response_schema (RESPONSE_SCHEMAS の名前) を渡すと、その形式の JSON で返させる。
+    """
+    return MODEL_BACKENDS[get_model_spec(model_name)["backend"]](model_name, system_instruction, response_schema)
+
+
+# ======================================================
+# 固定プロンプトのサーバー側キャッシュ (Gemini CachedContent)
+# ======================================================
+class PromptCache:
+    """
+    モデル × 固定プロンプトごとに CachedContent を1つ作り、全セッションで使い回す。
+    期限が refresh_margin 秒以内に迫ったら TTL を延長し、失効していれば作り直す。
+    作成できない組み合わせ (キャッシュ非対応のモデル・最小トークン数未満など) は記録し、
+    以後は system_instruction での送信にフォールバックする。
+    """
+
+    def __init__(self, ttl_seconds: float = 3600, refresh_margin: float = 300):
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self._handles: Dict[Tuple[str, str], Any] = {}
+        self._unsupported: Set[Tuple[str, str]] = set()
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+
+    def get(self, model_name: str, instruction: str):
+        key = (model_name, instruction)
+        with self._lock:
+            if key in self._unsupported:
+                return None
+            handle = self._handles.get(key)
+        if handle is not None and handle.expire_time - datetime.now(timezone.utc) >= self.refresh_margin:
+            return handle
+        # 作成・延長の通信はロックの外で行い、同じキーの同時要求は1回の通信に相乗りさせる
+        handle, _ = self._flights.do(request_key(model_name, "", instruction), self._refresh, key, handle)
+        return handle
+
+    def _refresh(self, key: Tuple[str, str], handle):
+        model_name, instruction = key
+        try:
+            if handle is None:
+                handle = self._create(model_name, instruction)
+            else:
+                try:
+                    handle.update(ttl=self.ttl)
+                except NotFound:
+                    handle = self._create(model_name, instruction)
+        except GoogleAPIError as e:
+            logger.info("prompt cache disabled for %s: %s", model_name, e)
+            with self._lock:
+                self._unsupported.add(key)
+                self._handles.pop(key, None)
+            return None
+        with self._lock:
+            self._handles[key] = handle
+        return handle
+
+    def invalidate(self, model_name: str, instruction: str) -> None:
+        with self._lock:
+            self._handles.pop((model_name, instruction), None)
+
+    def _create(self, model_name: str, instruction: str):
+        from google.generativeai import caching
+
+        return caching.CachedContent.create(
+            model=f"models/{model_name}",
+            display_name="magi-system-prompt",
+            system_instruction=instruction,
+            ttl=self.ttl,
+        )
+
+
+@lru_cache(maxsize=None)
+def get_prompt_cache() -> PromptCache:
+    return PromptCache(
+        ttl_seconds=float(os.getenv("MAGI_PROMPT_CACHE_TTL", "3600")),
+        refresh_margin=float(os.getenv("MAGI_PROMPT_CACHE_REFRESH", "300")),
+    )
+
+
+class CachedPromptModel:
+    """CachedContent を参照して生成するモデル。model_name はレート制限用に元のモデル名を保つ"""
+
+    def __init__(self, model_name: str, handle, system_instruction: str, response_schema: Optional[str] = None):
+        import google.generativeai as genai
+
+        self.model_name = model_name
+        self._system_instruction = system_instruction
+        self._response_schema = response_schema
+        self._model = genai.GenerativeModel.from_cached_content(
+            handle, generation_config=generation_config(response_schema)
+        )
+
+    def generate_content(self, content, stream=False):
+        try:
+            return self._model.generate_content(content, stream=stream)
+        except NotFound:
+            # 期限切れなどでキャッシュが消えていた場合は、今回は通常の送信で処理する
+            get_prompt_cache().invalidate(self.model_name, self._system_instruction)
+            model = gemini_client(self.model_name, self._system_instruction, self._response_schema)
+            return model.generate_content(content, stream=stream)
+
+
+def gemini_backend(model_name: str, system_instruction: Optional[str] = None, response_schema: Optional[str] = None):
+    # MAGI_PROMPT_CACHE=1 のときだけ CachedContent を試す (作成・保持にコストがかかるため)
+    if system_instruction and os.getenv("MAGI_PROMPT_CACHE") == "1":
+        handle = get_prompt_cache().get(model_name, system_instruction)
+        if handle is not None:
+            return CachedPromptModel(model_name, handle, system_instruction, response_schema)
+    return gemini_client(model_name, system_instruction, response_schema)
+
+
+# ======================================================
+# ローカルモデル バックエンド (CPU / オフライン)
+# ======================================================
+class BackendUnavailable(Exception):
+    """バックエンドが要求を処理できない (未対応の入力・モデル未ロードなど)。ルーターは次のモデルへ回す"""
+
+
+class LocalResponse:
+    """genai の GenerateContentResponse と同じ使い方ができる最小限の応答"""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.usage_metadata = None
+
+    def __iter__(self):
+        # ストリーミング指定時は全文を1チャンクとして返す
+        yield self
+
+
+class LocalModelServer:
+    """
+    小型の指示追従モデルをプロセスで1度だけ読み込み、CPU で生成する。
+    同時に届いたリクエストは max_wait 秒だけ待ってまとめ、1回の generate でバッチ処理する。
+    """
+
+    def __init__(self, model_id: str, max_batch: int = 4, max_wait: float = 0.05, max_new_tokens: int = 768):
+        self.model_id = model_id
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_new_tokens = max_new_tokens
+        self._queue: "queue.Queue" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._load_error: Optional[Exception] = None
+
+    def submit(self, messages) -> Future:
+        if self._load_error is not None:
+            raise BackendUnavailable(f"local model unavailable: {self._load_error}")
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="magi-local-model", daemon=True)
+                self._worker.start()
+        future: Future = Future()
+        self._queue.put((messages, future))
+        return future
+
+    def _load(self):
+        # transformers / torch は重いため、ローカルモデルを使う時まで読み込まない
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(self.model_id, padding_side="left")
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        model = AutoModelForCausalLM.from_pretrained(self.model_id, torch_dtype=torch.float32)
+        model.eval()
+        return torch, tokenizer, model
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        try:
+            torch, tokenizer, model = self._load()
+        except Exception as e:
+            self._load_error = e
+            while True:
+                _, future = self._queue.get()
+                future.set_exception(BackendUnavailable(f"local model unavailable: {e}"))
+
+        while True:
+            batch = self._next_batch()
+            try:
+                prompts = [
+                    tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+                    for messages, _ in batch
+                ]
+                inputs = tokenizer(prompts, return_tensors="pt", padding=True)
+                with torch.no_grad():
+                    output = model.generate(
+                        **inputs,
+                        max_new_tokens=self.max_new_tokens,
+                        do_sample=False,
+                        pad_token_id=tokenizer.pad_token_id,
+                    )
+                texts = tokenizer.batch_decode(output[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+                for (_, future), text in zip(batch, texts):
+                    future.set_result(text)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+
+def normalize_section_markers(text: str) -> str:
+    """小型モデルが崩しがちなセクションマーカー (【SECTION: magi-logic】 など) を正規形に直す"""
+    return re.sub(
+        r"[\[【]\s*SECTION\s*[:：]\s*([A-Za-z\-]+)\s*[\]】]",
+        lambda m: f"[SECTION:{m.group(1).upper()}]",
+        text,
+        flags=re.IGNORECASE,
+    )
+
+
+class LocalBackend:
+    """genai.GenerativeModel と同じ generate_content インターフェースを持つローカルバックエンド"""
+
+    def __init__(self, model_name: str, server: LocalModelServer, system_instruction: Optional[str] = None):
+        self.model_name = model_name
+        self._server = server
+        self._system_instruction = system_instruction
+
+    def generate_content(self, content, stream=False):
+        parts = content if isinstance(content, list) else [content]
+        if not all(isinstance(part, str) for part in parts):
+            raise BackendUnavailable("local model accepts text only")
+
+        # system_instruction がなければ、先頭をシステムプロンプト、残りをユーザー入力として渡す
+        if self._system_instruction:
+            messages = [
+                {"role": "system", "content": self._system_instruction},
+                {"role": "user", "content": "\n".join(parts)},
+            ]
+        elif len(parts) > 1:
+            messages = [
+                {"role": "system", "content": parts[0]},
+                {"role": "user", "content": "\n".join(parts[1:])},
+            ]
+        else:
+            messages = [{"role": "user", "content": parts[0]}]
+
+        text = self._server.submit(messages).result()
+        return LocalResponse(normalize_section_markers(text))
+
+
+@lru_cache(maxsize=None)
+def get_local_model_server() -> LocalModelServer:
+    return LocalModelServer(
+        os.getenv("MAGI_LOCAL_MODEL", "Qwen/Qwen2.5-0.5B-Instruct"),
+        max_batch=int(os.getenv("MAGI_LOCAL_MAX_BATCH", "4")),
+        max_new_tokens=int(os.getenv("MAGI_LOCAL_MAX_NEW_TOKENS", "768")),
+    )
+
+
+# モデル生成関数 (バックエンド種別ごと)
+MODEL_BACKENDS = {
+    "gemini": gemini_backend,
+    # ローカルモデルは response_schema を強制できないため、システム指示の書式指定だけで JSON を求める
+    "local": lambda name, system_instruction=None, response_schema=None: LocalBackend(
+        name, get_local_model_server(), system_instruction
+    ),
+}
@@ -0,0 +1,163 @@
+"""
+プロセス共有のレート制限 (トークンバケット) と、429 リトライつきの生成呼び出し。
+"""
+import random
+import re
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+from typing import Optional
+
+from google.api_core.exceptions import TooManyRequests
+
+from .executors import notify
+from .metrics import get_metrics, record, record_usage
+from .models import get_model_spec
+
+
+class TokenBucket:
+    def __init__(self, rate_per_sec: float, capacity: float):
+        self.rate = rate_per_sec
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """amount 分のトークンが貯まるまでの秒数 (容量を超える要求は容量で打ち切る)"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        self.tokens -= amount
+
+
+class RateLimiter:
+    """
+    モデル単位のレート制限 (リクエスト数/分 と トークン数/分)。
+    待機は到着順 (FIFO) で、先頭の呼び出し元だけがトークンを取得できる。
+    429 の retry-after ヒントを受け取ると、その時刻まで全員を待たせる。
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        self._requests = TokenBucket(rpm / 60.0, rpm)
+        self._tokens = TokenBucket(tpm / 60.0, tpm)
+        self._cond = threading.Condition()
+        self._queue: deque = deque()
+        self._blocked_until = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        with self._cond:
+            return len(self._queue)
+
+    def acquire(self, tokens: int, timeout: Optional[float] = None) -> float:
+        """順番が来てトークンを確保できるまで待ち、待機した秒数を返す"""
+        ticket = object()
+        start = time.monotonic()
+        with self._cond:
+            self._queue.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = None
+                    if self._queue[0] is ticket:
+                        wait = max(
+                            self._blocked_until - now,
+                            self._requests.wait_time(1, now),
+                            self._tokens.wait_time(tokens, now),
+                        )
+                        if wait <= 0:
+                            self._requests.consume(1)
+                            self._tokens.consume(tokens)
+                            return now - start
+                    if timeout is not None:
+                        remaining = start + timeout - now
+                        if remaining <= 0:
+                            raise TimeoutError("rate limiter queue timeout")
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._cond.wait(wait)
+            finally:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+
+    def penalize(self, retry_after: float) -> None:
+        """サーバーから 429 を受けた場合、retry_after 秒間は新規リクエストを止める"""
+        with self._cond:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+            self._cond.notify_all()
+
+    def record_usage(self, estimated: int, actual: int) -> None:
+        """実際のトークン使用量との差分をバケットに反映する"""
+        with self._cond:
+            self._tokens.consume(actual - estimated)
+            self._cond.notify_all()
+
+
+@lru_cache(maxsize=None)
+def get_rate_limiter(model_name: str) -> RateLimiter:
+    spec = get_model_spec(model_name)
+    return RateLimiter(spec["rpm"], spec["tpm"])
+
+
+def estimate_content_tokens(content) -> int:
+    """送信前の大まかなトークン数 (テキストは 2 文字 ≒ 1 トークン、画像等は 1 パート 258 トークン)"""
+    parts = content if isinstance(content, list) else [content]
+    total = 0
+    for part in parts:
+        if isinstance(part, str):
+            total += len(part) // 2 + 1
+        else:
+            total += 258
+    return total
+
+
+def parse_retry_after(error: Exception) -> Optional[float]:
+    """429 のエラーメッセージから retry_delay / "retry in Ns" のヒントを取り出す"""
+    m = re.search(r"retry_delay\s*{\s*seconds:\s*(\d+)", str(error)) or re.search(
+        r"retry in ([\d.]+)\s*s", str(error), re.IGNORECASE
+    )
+    return float(m.group(1)) if m else None
+
+
+def generate_with_retry(model, content, max_retries=3, stream=False):
+    """
+    429エラー(gRPC の ResourceExhausted / REST の TooManyRequests)が発生した場合、
+    共有レートリミッタに retry-after (なければ指数バックオフ) を通知して再試行するラッパー関数。
+    待機はスリープではなくリミッタの待ち行列で行うため、全セッションが同じ制限を共有する。
+    """
+    model_name = model.model_name.removeprefix("models/")
+    limiter = get_rate_limiter(model_name)
+    estimated = estimate_content_tokens(content)
+
+    for attempt in range(max_retries):
+        get_metrics().set_gauge("rate_limiter_queue_depth", limiter.queue_depth + 1, {"model": model_name})
+        waited = limiter.acquire(estimated)
+        get_metrics().set_gauge("rate_limiter_queue_depth", limiter.queue_depth, {"model": model_name})
+        record(rate_limit_wait_seconds=waited)
+        try:
+            response = model.generate_content(content, stream=stream)
+        except TooManyRequests as e:
+            # クォータ制限の場合
+            wait_time = parse_retry_after(e) or (2 ** attempt) + random.uniform(0, 1) # 1秒, 2秒, 4秒...と待機時間を増やす
+            limiter.penalize(wait_time)
+            if attempt < max_retries - 1:
+                record(retries=1, backoff_seconds=wait_time)
+                notify(f"⚠️ SYSTEM BUSY (429). RETRYING IN {wait_time:.1f}s...", icon="⏳")
+                continue
+            else:
+                # リトライ上限到達
+                raise e
+
+        usage = getattr(response, "usage_metadata", None) if not stream else None
+        if usage is not None and usage.prompt_token_count:
+            limiter.record_usage(estimated, usage.prompt_token_count)
+            record_usage(response)
+        return response
@@ -0,0 +1,236 @@
+"""
+レポート作成 (Word / PDF / Markdown) と、バックグラウンド作成・ZIP 一括出力。
+"""
+import base64
+import copy
+import importlib.util
+import io
+import os
+import threading
+import zipfile
+from concurrent.futures import Future
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from .executors import get_report_executor, submit_with_context
+from .media import PreparedImage, prepare_image
+from .metrics import stage
+
+AGENT_NAMES = {
+    "MAGI-LOGIC": "MELCHIOR-1 (Logic)",
+    "MAGI-HUMAN": "BALTHASAR-2 (Human)",
+    "MAGI-REALITY": "CASPER-3 (Reality)",
+    "MAGI-MEDIA": "MEDIA ANALYZER",
+}
+
+
+class ReportFormatUnavailable(RuntimeError):
+    """出力形式に必要な任意依存パッケージ (reportlab など) が入っていない"""
+
+
+@lru_cache(maxsize=8)
+def report_image_bytes(image: PreparedImage) -> Tuple[bytes, str]:
+    """レポートに埋め込む画像。python-docx / reportlab は WebP を扱えないため、その場合だけ JPEG に変換する"""
+    if image.mime_type == "image/webp":
+        return prepare_image(image.data, max(image.width, image.height), "JPEG").data, "image/jpeg"
+    return image.data, image.mime_type
+
+
+# ======================================================
+# Word (テンプレートを1度だけ読み込み、複製して使う)
+# ======================================================
+_template_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_docx_template():
+    """MAGI_REPORT_TEMPLATE (.docx) があればそれを、なければ python-docx の既定テンプレートを読み込む"""
+    import docx
+
+    return docx.Document(os.getenv("MAGI_REPORT_TEMPLATE") or None)
+
+
+def new_document():
+    with _template_lock:
+        return copy.deepcopy(get_docx_template())
+
+
+def create_docx(context, sections, image: Optional[PreparedImage] = None):
+    from docx.shared import Inches
+
+    with stage("create_docx"):
+        doc = new_document()
+        doc.add_heading('MAGI ANALYTICAL REPORT', 0)
+
+        doc.add_heading('1. INPUT DATA', level=1)
+        doc.add_paragraph(f"Query: {context['user_question']}")
+        if context['text_input']: doc.add_paragraph(f"Text: {context['text_input']}")
+
+        if image:
+            img_data, _ = report_image_bytes(image)
+            doc.add_picture(io.BytesIO(img_data), width=Inches(2.5))
+
+        doc.add_heading('2. MAGI DELIBERATION', level=1)
+
+        for key, name in AGENT_NAMES.items():
+            if key in sections:
+                sec = sections[key]
+                p = doc.add_paragraph()
+                p.add_run(f"[{name}] ").bold = True
+                p.add_run(f"Vote: {sec['decision']}\n")
+                p.add_run(sec['summary'])
+
+        doc.add_heading('3. FINAL INTEGRATION', level=1)
+        if "INTEGRATION" in sections:
+            doc.add_paragraph(sections["INTEGRATION"]["raw"])
+
+        if "SWOT" in sections:
+            doc.add_heading('4. SWOT ANALYSIS', level=1)
+            for k, v in sections["SWOT"].items():
+                doc.add_paragraph(f"{k}: {v}")
+
+        buf = io.BytesIO()
+        doc.save(buf)
+        buf.seek(0)
+        return buf.getvalue()
+
+
+# ======================================================
+# Markdown
+# ======================================================
+def create_markdown(context, sections, image: Optional[PreparedImage] = None) -> bytes:
+    with stage("create_markdown"):
+        lines = ["# MAGI ANALYTICAL REPORT", "", "## 1. INPUT DATA", "", f"Query: {context['user_question']}", ""]
+        if context['text_input']:
+            lines += [f"Text: {context['text_input']}", ""]
+        if image:
+            img_data, mime_type = report_image_bytes(image)
+            lines += [f"![VISUAL DATA](data:{mime_type};base64,{base64.b64encode(img_data).decode('ascii')})", ""]
+
+        lines += ["## 2. MAGI DELIBERATION", ""]
+        for key, name in AGENT_NAMES.items():
+            if key in sections:
+                sec = sections[key]
+                lines += [f"**[{name}]** Vote: {sec['decision']}", "", sec['summary'], ""]
+
+        lines += ["## 3. FINAL INTEGRATION", ""]
+        if "INTEGRATION" in sections:
+            lines += [sections["INTEGRATION"]["raw"], ""]
+
+        if "SWOT" in sections:
+            lines += ["## 4. SWOT ANALYSIS", ""]
+            lines += [f"- **{k}**: {v}" for k, v in sections["SWOT"].items()]
+            lines.append("")
+        return "\n".join(lines).encode("utf-8")
+
+
+# ======================================================
+# PDF (reportlab は任意依存。日本語は組み込みの CID フォントで描画する)
+# ======================================================
+def create_pdf(context, sections, image: Optional[PreparedImage] = None) -> bytes:
+    try:
+        from reportlab.lib.pagesizes import A4
+        from reportlab.lib.styles import getSampleStyleSheet
+        from reportlab.lib.units import inch
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+        from reportlab.platypus import Image, Paragraph, SimpleDocTemplate, Spacer
+    except ImportError as e:
+        raise ReportFormatUnavailable("PDF export requires reportlab (pip install reportlab)") from e
+
+    with stage("create_pdf"):
+        font = "HeiseiKakuGo-W5"
+        if font not in pdfmetrics.getRegisteredFontNames():
+            pdfmetrics.registerFont(UnicodeCIDFont(font))
+        styles = getSampleStyleSheet()
+        for name in ("Title", "Heading1", "BodyText"):
+            styles[name].fontName = font
+
+        def para(text, style="BodyText"):
+            escaped = str(text).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+            return Paragraph(escaped.replace("\n", "<br/>"), styles[style])
+
+        story = [para("MAGI ANALYTICAL REPORT", "Title"), para("1. INPUT DATA", "Heading1"),
+                 para(f"Query: {context['user_question']}")]
+        if context['text_input']:
+            story.append(para(f"Text: {context['text_input']}"))
+        if image:
+            img_data, _ = report_image_bytes(image)
+            height = 2.5 * inch * image.height / max(image.width, 1)
+            story += [Spacer(1, 6), Image(io.BytesIO(img_data), width=2.5 * inch, height=height)]
+
+        story.append(para("2. MAGI DELIBERATION", "Heading1"))
+        for key, name in AGENT_NAMES.items():
+            if key in sections:
+                sec = sections[key]
+                story.append(para(f"[{name}] Vote: {sec['decision']}\n{sec['summary']}"))
+                story.append(Spacer(1, 4))
+
+        story.append(para("3. FINAL INTEGRATION", "Heading1"))
+        if "INTEGRATION" in sections:
+            story.append(para(sections["INTEGRATION"]["raw"]))
+
+        if "SWOT" in sections:
+            story.append(para("4. SWOT ANALYSIS", "Heading1"))
+            story += [para(f"{k}: {v}") for k, v in sections["SWOT"].items()]
+
+        buf = io.BytesIO()
+        SimpleDocTemplate(buf, pagesize=A4, title="MAGI ANALYTICAL REPORT").build(story)
+        return buf.getvalue()
+
+
+# ======================================================
+# 出力形式の登録と、バックグラウンド作成・一括出力
+# ======================================================
+@dataclass(frozen=True)
+class ReportFormat:
+    label: str
+    extension: str
+    mime_type: str
+    render: Callable[..., bytes]
+    requires: Optional[str] = None
+    # ZIP に入れる際に圧縮するか (docx は既に圧縮済み)
+    compress: bool = True
+
+    @property
+    def available(self) -> bool:
+        return self.requires is None or importlib.util.find_spec(self.requires) is not None
+
+
+REPORT_FORMATS: Dict[str, ReportFormat] = {
+    "docx": ReportFormat(
+        "DOCX", "docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        create_docx, compress=False,
+    ),
+    "pdf": ReportFormat("PDF", "pdf", "application/pdf", create_pdf, requires="reportlab"),
+    "md": ReportFormat("MARKDOWN", "md", "text/markdown", create_markdown),
+}
+
+
+def available_report_formats() -> Dict[str, ReportFormat]:
+    return {key: fmt for key, fmt in REPORT_FORMATS.items() if fmt.available}
+
+
+def render_report(fmt: str, context, sections, image: Optional[PreparedImage] = None) -> bytes:
+    return REPORT_FORMATS[fmt].render(context, sections, image)
+
+
+def submit_report(fmt: str, context, sections, image: Optional[PreparedImage] = None) -> Future:
+    """レポートをバックグラウンドで作成する。呼び出し後に context / sections が変更されても影響しないよう複製して渡す"""
+    return submit_with_context(
+        get_report_executor(), render_report, fmt, dict(context), copy.deepcopy(sections), image
+    )
+
+
+def write_reports_zip(fileobj, reports: Iterable[Tuple[str, Dict[str, Any], Dict[str, Any], Optional[PreparedImage]]],
+                      fmt: str = "docx") -> None:
+    """
+    (名前, context, sections, image) を1件ずつレポートにして ZIP に書き込む。
+    fileobj はシーク不能なストリームでもよく、全件をメモリに載せない。
+    """
+    report_format = REPORT_FORMATS[fmt]
+    compression = zipfile.ZIP_DEFLATED if report_format.compress else zipfile.ZIP_STORED
+    with zipfile.ZipFile(fileobj, "w", compression=compression) as zf:
+        for name, context, sections, image in reports:
+            zf.writestr(f"{name}.{report_format.extension}", render_report(fmt, context, sections, image))
@@ -0,0 +1,166 @@
+"""
+モデルルーティング (フェイルオーバー / ヘッジリクエスト)。
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+from google.api_core.exceptions import GoogleAPIError
+
+from .executors import notify, submit_with_context
+from .metrics import record
+from .models import BackendUnavailable, DEFAULT_MODEL, get_gemini_model
+from .ratelimit import generate_with_retry
+from .singleflight import get_single_flight, request_key
+
+
+@dataclass(frozen=True)
+class RoutePlan:
+    """リクエストの送り先。models の先頭から順に試し、hedge_percentile が指定されればヘッジする"""
+    models: Tuple[str, ...] = (DEFAULT_MODEL,)
+    hedge_percentile: Optional[float] = None
+
+    @property
+    def primary(self) -> str:
+        return self.models[0]
+
+
+class ModelRouter:
+    """
+    モデルごとの応答時間を記録し、フェイルオーバーとヘッジリクエストを行う。
+    ヘッジ: 1本目が過去の応答時間の指定パーセンタイルを超えたら、次のモデルにも同じ要求を送り、
+    先に返ってきた方を採用する (遅れた方の結果は捨てる)。
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor, history_size: int = 200, min_samples: int = 10):
+        self._executor = executor
+        self._min_samples = min_samples
+        self._latencies: Dict[str, deque] = {}
+        self._history_size = history_size
+        self._lock = threading.Lock()
+
+    def record_latency(self, model_name: str, seconds: float) -> None:
+        with self._lock:
+            self._latencies.setdefault(model_name, deque(maxlen=self._history_size)).append(seconds)
+
+    def latency_threshold(self, model_name: str, percentile: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._latencies.get(model_name, ()))
+        if len(samples) < self._min_samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * percentile / 100))
+        return samples[index]
+
+    def _call(
+        self,
+        model_name: str,
+        content,
+        stream: bool,
+        max_retries: int,
+        system_instruction: Optional[str] = None,
+        response_schema: Optional[str] = None,
+    ):
+        model = get_gemini_model(model_name, system_instruction, response_schema)
+        if stream:
+            return generate_with_retry(model, content, max_retries, stream)
+
+        # 同じモデル・同じ内容の要求が実行中なら、その応答を共有する
+        start = time.monotonic()
+        response, shared = get_single_flight().do(
+            request_key(model_name, content, system_instruction, response_schema),
+            generate_with_retry, model, content, max_retries, stream,
+        )
+        if shared:
+            record(coalesced=1)
+        else:
+            self.record_latency(model_name, time.monotonic() - start)
+        return response
+
+    def _hedged(
+        self,
+        primary: str,
+        backup: str,
+        content,
+        threshold: float,
+        system_instruction: Optional[str],
+        response_schema: Optional[str],
+    ):
+        first = submit_with_context(
+            self._executor, self._call, primary, content, False, 1, system_instruction, response_schema
+        )
+        done, _ = wait([first], timeout=threshold)
+        if done and first.exception() is None:
+            return first.result(), primary
+
+        pending = {first: primary} if not done else {}
+        second = submit_with_context(
+            self._executor, self._call, backup, content, False, 1, system_instruction, response_schema
+        )
+        pending[second] = backup
+        error: Optional[BaseException] = first.exception() if done else None
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = pending.pop(future)
+                if future.exception() is None:
+                    return future.result(), name
+                error = future.exception()
+        raise error
+
+    def generate(
+        self,
+        plan: RoutePlan,
+        content,
+        stream: bool = False,
+        system_instruction: Optional[str] = None,
+        response_schema: Optional[str] = None,
+    ):
+        """
+        plan に従って生成し、(response, 実際に応答したモデル名) を返す。
+        response_schema には RESPONSE_SCHEMAS の名前を渡す (JSON で返させる構造化出力)。
+        """
+        candidates = list(plan.models)
+        error: Optional[Exception] = None
+        while candidates:
+            name = candidates.pop(0)
+            # フォールバック先が残っている間は同じモデルで粘らず次へ回す
+            max_retries = 3 if not candidates else 1
+            try:
+                threshold = None
+                if plan.hedge_percentile and candidates and not stream:
+                    threshold = self.latency_threshold(name, plan.hedge_percentile)
+                if threshold is not None:
+                    return self._hedged(
+                        name, candidates.pop(0), content, threshold, system_instruction, response_schema
+                    )
+                return self._call(name, content, stream, max_retries, system_instruction, response_schema), name
+            except (GoogleAPIError, BackendUnavailable) as e:
+                error = e
+        raise error
+
+
+@lru_cache(maxsize=None)
+def get_model_router() -> ModelRouter:
+    executor = ThreadPoolExecutor(
+        max_workers=int(os.getenv("MAGI_HEDGE_WORKERS", "8")),
+        thread_name_prefix="magi-hedge",
+    )
+    return ModelRouter(executor, min_samples=int(os.getenv("MAGI_HEDGE_MIN_SAMPLES", "10")))
+
+
+def generate_routed(
+    plan: RoutePlan,
+    content,
+    stream: bool = False,
+    system_instruction: Optional[str] = None,
+    response_schema: Optional[str] = None,
+):
+    response, model_name = get_model_router().generate(plan, content, stream, system_instruction, response_schema)
+    if model_name != plan.primary:
+        notify(f"⚠️ {plan.primary} UNAVAILABLE. ROUTED TO {model_name}.", icon="🔀")
+    return response
@@ -0,0 +1,100 @@
+"""
+構造化出力 (JSON) モード: Gemini に response_schema で形式を固定した JSON を返させ、1回の走査で検証して
+parse_magi_output と同じ sections 形式に変換する。
+[SECTION:...] の正規表現による解析は、テキストで返ってきた場合のフォールバックとしてだけ使う。
+"""
+import json
+from typing import Any, Dict
+
+DECISIONS = ("可決", "否決", "保留")
+
+# sections のタグ → JSON のキー
+AGENT_FIELDS = {
+    "MAGI-LOGIC": "logic",
+    "MAGI-HUMAN": "human",
+    "MAGI-REALITY": "reality",
+    "MAGI-MEDIA": "media",
+}
+SWOT_FIELDS = {
+    "Strengths": "strengths",
+    "Weaknesses": "weaknesses",
+    "Opportunities": "opportunities",
+    "Threats": "threats",
+}
+
+
+class SchemaError(ValueError):
+    """構造化出力がスキーマに合わない"""
+
+
+def _object(properties: Dict[str, Any]) -> Dict[str, Any]:
+    return {"type": "object", "properties": properties, "required": list(properties)}
+
+
+def build_response_schema(enable_swot: bool) -> Dict[str, Any]:
+    """Gemini の response_schema (OpenAPI のサブセット)"""
+    vote = _object({
+        "decision": {"type": "string", "format": "enum", "enum": list(DECISIONS)},
+        "summary": {"type": "string"},
+    })
+    properties = {field: vote for field in AGENT_FIELDS.values()}
+    properties["integration"] = _object({"conclusion": {"type": "string"}, "detail": {"type": "string"}})
+    if enable_swot:
+        properties["swot"] = _object({
+            field: {"type": "array", "items": {"type": "string"}} for field in SWOT_FIELDS.values()
+        })
+    return _object(properties)
+
+
+# スキーマは名前で指定する (モデルのキャッシュ・相乗りのキーに使えるよう、ハッシュ可能な値で受け渡す)
+RESPONSE_SCHEMAS = {
+    "magi": build_response_schema(False),
+    "magi_swot": build_response_schema(True),
+}
+
+
+def response_schema_name(enable_swot: bool) -> str:
+    return "magi_swot" if enable_swot else "magi"
+
+
+def _field(data: Dict[str, Any], key: str, kind: type, path: str):
+    value = data.get(key)
+    if not isinstance(value, kind):
+        raise SchemaError(f"{path}.{key}: expected {kind.__name__}, got {type(value).__name__}")
+    return value
+
+
+def parse_magi_json(text: str) -> Dict[str, Dict[str, Any]]:
+    """
+    構造化出力を検証しながら sections に変換する (1回の走査)。
+    形式が合わない場合は SchemaError。swot は出力に含まれる場合だけ検証する。
+    """
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise SchemaError(f"invalid JSON: {e}") from e
+    if not isinstance(data, dict):
+        raise SchemaError("root: expected object")
+
+    sections: Dict[str, Dict[str, Any]] = {}
+    for tag, key in AGENT_FIELDS.items():
+        vote = _field(data, key, dict, "root")
+        decision = _field(vote, "decision", str, key)
+        if decision not in DECISIONS:
+            raise SchemaError(f"{key}.decision: {decision!r} is not one of {', '.join(DECISIONS)}")
+        summary = _field(vote, "summary", str, key)
+        sections[tag] = {"decision": decision, "summary": summary, "raw": f"判定: {decision}\n見解: {summary}"}
+
+    integration = _field(data, "integration", dict, "root")
+    conclusion = _field(integration, "conclusion", str, "integration")
+    detail = _field(integration, "detail", str, "integration")
+    # INTEGRATION には判定行がないため、parse_section と同じく decision は既定の保留のままにする
+    sections["INTEGRATION"] = {"decision": "保留", "summary": detail, "raw": f"結論: {conclusion}\n詳細: {detail}"}
+
+    if "swot" in data:
+        swot = _field(data, "swot", dict, "root")
+        sections["SWOT"] = {
+            label: "、".join(str(item) for item in _field(swot, key, list, "swot"))
+            for label, key in SWOT_FIELDS.items()
+        }
+    return sections
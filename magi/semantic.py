@@ -0,0 +1,303 @@
+"""
+意味的な類似検索: 過去の審議の質問文をローカル CPU の埋め込みモデルでベクトル化し、
+言い換えられた相談でも似た審議を見つけて再利用を提案する。
+
+ベクトルは正規化済み float32 として追記専用ファイルに保存し、numpy.memmap で読み込む。
+検索は行列積によるコサイン類似度をブロック単位で計算するため、数十万件でもメモリを使い切らない。
+numpy は類似検索を有効にした時だけ読み込む (起動時間を延ばさないため)。
+"""
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence
+
+from .budget import get_prompt_budget
+from .documents import truncate_tokens
+from .executors import submit_with_context
+from .history import HistoryStore, get_history_store
+from .metrics import stage
+from .models import BackendUnavailable
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger("magi")
+
+
+def recall_text(context: Dict[str, Any]) -> str:
+    """
+    埋め込みの対象 (質問と補足テキスト)。履歴には上限に収めた (長ければ要約した) 補足テキストが入るため、
+    検索側も審議に渡す形の context で呼ぶこと。上限を超える分は両側とも同じく切り詰める。
+    """
+    text_input = truncate_tokens(context.get("text_input") or "", get_prompt_budget().text_tokens)
+    parts = (context.get("user_question") or "", text_input)
+    return "\n".join(part for part in parts if part).strip()
+
+
+# ======================================================
+# 埋め込みモデル (CPU)
+# ======================================================
+class LocalEmbedder:
+    """
+    小型の多言語埋め込みモデルをプロセスで1度だけ読み込み、バッチ単位でベクトル化する。
+    transformers / torch は重いため、初めて使う時まで読み込まない。
+    """
+
+    def __init__(self, model_id: str, batch_size: int = 32, max_length: int = 256):
+        self.model_id = model_id
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self._loaded = None
+        self._load_error: Optional[Exception] = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._load_error is not None:
+                raise BackendUnavailable(f"embedding model unavailable: {self._load_error}")
+            if self._loaded is None:
+                try:
+                    import torch
+                    from transformers import AutoModel, AutoTokenizer
+
+                    tokenizer = AutoTokenizer.from_pretrained(self.model_id)
+                    model = AutoModel.from_pretrained(self.model_id)
+                    model.eval()
+                except Exception as e:
+                    self._load_error = e
+                    raise BackendUnavailable(f"embedding model unavailable: {e}") from e
+                self._loaded = (torch, tokenizer, model)
+            return self._loaded
+
+    def ready(self) -> bool:
+        """読み込み済みか (読み込まずに確かめる)。読み込みに失敗していれば BackendUnavailable"""
+        if self._load_error is not None:
+            raise BackendUnavailable(f"embedding model unavailable: {self._load_error}")
+        return self._loaded is not None
+
+    @property
+    def dim(self) -> int:
+        _, _, model = self._load()
+        return model.config.hidden_size
+
+    def embed(self, texts: Sequence[str]) -> "np.ndarray":
+        """正規化済みベクトル (len(texts), dim) を返す"""
+        import numpy as np
+
+        torch, tokenizer, model = self._load()
+        vectors = []
+        with stage("embed"), torch.no_grad():
+            for start in range(0, len(texts), self.batch_size):
+                # e5 系モデルは入力に "query: " を付ける前提で学習されている
+                batch = [f"query: {text}" for text in texts[start:start + self.batch_size]]
+                inputs = tokenizer(batch, padding=True, truncation=True, max_length=self.max_length, return_tensors="pt")
+                hidden = model(**inputs).last_hidden_state
+                mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+                pooled = (hidden * mask).sum(1) / mask.sum(1).clamp(min=1e-9)
+                vectors.append(torch.nn.functional.normalize(pooled, dim=-1).numpy().astype(np.float32))
+        return np.concatenate(vectors) if vectors else np.zeros((0, self.dim), dtype=np.float32)
+
+
+# ======================================================
+# ベクトル索引 (追記専用ファイル + memmap)
+# ======================================================
+class VectorIndex:
+    """
+    vectors.f32 (正規化済みベクトル) と ids.i64 (履歴の id) を同じ順序で追記する。
+    読み込みは memmap で、ファイルが伸びた時だけ開き直す。
+    """
+
+    def __init__(self, directory: str, dim: int, block_rows: int = 65_536):
+        os.makedirs(directory, exist_ok=True)
+        self.dim = dim
+        self.block_rows = block_rows
+        self._vectors_path = os.path.join(directory, "vectors.f32")
+        self._ids_path = os.path.join(directory, "ids.i64")
+        self._lock = threading.Lock()
+        self._vectors: Optional["np.ndarray"] = None
+        self._ids: Optional["np.ndarray"] = None
+        self._repair()
+
+    def _repair(self) -> None:
+        # 書き込み途中で止まった場合に備え、両ファイルを揃った行数に切り詰める
+        rows = min(self._file_rows(self._vectors_path, self.dim * 4), self._file_rows(self._ids_path, 8))
+        for path, row_bytes in ((self._vectors_path, self.dim * 4), (self._ids_path, 8)):
+            with open(path, "ab") as f:
+                f.truncate(rows * row_bytes)
+
+    @staticmethod
+    def _file_rows(path: str, row_bytes: int) -> int:
+        return os.path.getsize(path) // row_bytes if os.path.exists(path) else 0
+
+    def __len__(self) -> int:
+        return self._file_rows(self._ids_path, 8)
+
+    def last_id(self) -> int:
+        ids = self._load()[1]
+        return int(ids[-1]) if len(ids) else 0
+
+    def add(self, ids: Sequence[int], vectors: "np.ndarray") -> None:
+        import numpy as np
+
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        with self._lock:
+            with open(self._vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+            with open(self._ids_path, "ab") as f:
+                f.write(np.asarray(ids, dtype=np.int64).tobytes())
+            self._vectors = self._ids = None
+
+    def _load(self):
+        import numpy as np
+
+        with self._lock:
+            rows = len(self)
+            if self._ids is None or len(self._ids) != rows:
+                if rows == 0:
+                    self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+                    self._ids = np.zeros(0, dtype=np.int64)
+                else:
+                    self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+                    self._ids = np.memmap(self._ids_path, dtype=np.int64, mode="r", shape=(rows,))
+            return self._vectors, self._ids
+
+    def search(self, query: "np.ndarray", k: int = 3, threshold: float = 0.0) -> List[tuple]:
+        """コサイン類似度の上位 k 件 [(id, score)] (threshold 未満は除く)"""
+        import numpy as np
+
+        vectors, ids = self._load()
+        query = np.asarray(query, dtype=np.float32).reshape(self.dim)
+        best_scores = np.zeros(0, dtype=np.float32)
+        best_rows = np.zeros(0, dtype=np.int64)
+        with stage("vector_search"):
+            for start in range(0, len(vectors), self.block_rows):
+                scores = vectors[start:start + self.block_rows] @ query
+                if len(scores) > k:
+                    top = np.argpartition(scores, -k)[-k:]
+                else:
+                    top = np.arange(len(scores))
+                best_scores = np.concatenate([best_scores, scores[top]])
+                best_rows = np.concatenate([best_rows, top + start])
+                if len(best_scores) > k:
+                    keep = np.argpartition(best_scores, -k)[-k:]
+                    best_scores, best_rows = best_scores[keep], best_rows[keep]
+        order = np.argsort(-best_scores)
+        return [(int(ids[best_rows[i]]), float(best_scores[i])) for i in order if best_scores[i] >= threshold]
+
+
+# ======================================================
+# 履歴との連携
+# ======================================================
+@dataclass(frozen=True)
+class SimilarDeliberation:
+    id: int
+    score: float
+    user_question: str
+    conclusion: str
+    created: float
+
+
+class SemanticRecall:
+    """
+    履歴 (HistoryStore) の質問文を索引に取り込み、似た過去の審議を探す。
+    取り込みは専用の1スレッドで行い (ファイルへの書き手を1つにする)、未登録の履歴をまとめて埋め込む。
+    """
+
+    def __init__(
+        self,
+        store: HistoryStore,
+        embedder: LocalEmbedder,
+        directory: str,
+        top_k: int = 3,
+        threshold: float = 0.88,
+        sync_batch: int = 256,
+    ):
+        self.store = store
+        self.embedder = embedder
+        self.directory = directory
+        self.top_k = top_k
+        self.threshold = threshold
+        self.sync_batch = sync_batch
+        self._index: Optional[VectorIndex] = None
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="magi-embed")
+        self._sync: Optional[Future] = None
+        self._sync_lock = threading.Lock()
+
+    @property
+    def index(self) -> VectorIndex:
+        if self._index is None:
+            self._index = VectorIndex(self.directory, self.embedder.dim)
+        return self._index
+
+    def sync(self) -> int:
+        """索引にない履歴を古い順にバッチで埋め込んで追記し、追加した件数を返す"""
+        added = 0
+        while True:
+            rows = self.store.texts_after(self.index.last_id(), self.sync_batch)
+            if not rows:
+                return added
+            ids = [row_id for row_id, _ in rows]
+            self.index.add(ids, self.embedder.embed([recall_text(texts) for _, texts in rows]))
+            added += len(rows)
+
+    def sync_in_background(self) -> Future:
+        """取り込みを専用スレッドで開始する (実行中・待機中の取り込みがあればそれを返し、重ねて積まない)"""
+        with self._sync_lock:
+            if self._sync is None or self._sync.done():
+                self._sync = submit_with_context(self._writer, self.sync)
+                self._sync.add_done_callback(_log_sync_failure)
+            return self._sync
+
+    def find_similar(
+        self, context: Dict[str, Any], k: Optional[int] = None, threshold: Optional[float] = None
+    ) -> List[SimilarDeliberation]:
+        """
+        似た過去の審議を類似度の高い順に返す。未登録の履歴の取り込みはバックグラウンドで始めるだけで待たず、
+        その時点で索引にある分を検索する。埋め込みモデルの読み込みが済むまでは空で返す。
+        """
+        text = recall_text(context)
+        if not text:
+            return []
+        self.sync_in_background()
+        if not self.embedder.ready() or len(self.index) == 0:
+            return []
+        query = self.embedder.embed([text])[0]
+        matches = []
+        k = self.top_k if k is None else k
+        threshold = self.threshold if threshold is None else threshold
+        for entry_id, score in self.index.search(query, k, threshold):
+            entry = self.store.get_summary(entry_id)
+            if entry is not None:
+                matches.append(SimilarDeliberation(
+                    entry_id, score, entry.user_question, entry.conclusion, entry.created
+                ))
+        return matches
+
+
+def _log_sync_failure(future: Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("failed to update semantic index: %s", future.exception())
+
+
+@lru_cache(maxsize=None)
+def get_semantic_recall() -> Optional[SemanticRecall]:
+    """
+    MAGI_SEMANTIC_RECALL=1 の場合だけ有効 (埋め込みモデルに torch / transformers が必要)。
+    履歴が無効な場合も None。埋め込みモデルは MAGI_EMBEDDING_MODEL で差し替えられる
+    """
+    store = get_history_store()
+    if store is None or os.getenv("MAGI_SEMANTIC_RECALL", "0") != "1":
+        return None
+    embedder = LocalEmbedder(
+        os.getenv("MAGI_EMBEDDING_MODEL", "intfloat/multilingual-e5-small"),
+        batch_size=int(os.getenv("MAGI_EMBEDDING_BATCH", "32")),
+    )
+    directory = os.getenv("MAGI_SEMANTIC_INDEX_DIR", os.path.join(".magi_cache", "semantic"))
+    return SemanticRecall(
+        store, embedder, directory,
+        top_k=int(os.getenv("MAGI_SEMANTIC_TOP_K", "3")),
+        threshold=float(os.getenv("MAGI_SEMANTIC_THRESHOLD", "0.88")),
+    )
@@ -0,0 +1,86 @@
+"""
+同一リクエストの相乗り (single-flight)。
+同じキーの処理が実行中なら新たに実行せず、その完了を待って同じ結果 (または例外) を受け取る。
+"""
+import hashlib
+import threading
+from concurrent.futures import CancelledError, Future
+from functools import lru_cache
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+class SingleFlight:
+    """
+    最初の呼び出し (リーダー) だけが fn を実行し、実行中に来た同じキーの呼び出しはその Future を待つ。
+    リーダーが例外で終われば待機側にも同じ例外を送出する。
+    リーダーが中断された場合 (Streamlit の停止・再実行など) は Future をキャンセルし、
+    待機側のうち1つが改めてリーダーとして実行する。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Future] = {}
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+    def do(self, key: str, fn: Callable[..., Any], *args, timeout: Optional[float] = None) -> Tuple[Any, bool]:
+        """(結果, 他の呼び出しの結果を共有したか) を返す。timeout は待機側の待ち時間の上限"""
+        while True:
+            with self._lock:
+                future = self._calls.get(key)
+                leader = future is None
+                if leader:
+                    future = Future()
+                    self._calls[key] = future
+            if leader:
+                break
+            try:
+                return future.result(timeout), True
+            except CancelledError:
+                continue
+
+        try:
+            result = fn(*args)
+        except Exception as e:
+            self._forget(key, future)
+            future.set_exception(e)
+            raise
+        except BaseException:
+            self._forget(key, future)
+            future.cancel()
+            raise
+        self._forget(key, future)
+        future.set_result(result)
+        return result, False
+
+    def _forget(self, key: str, future: Future) -> None:
+        # 完了後に来た呼び出しは相乗りせず、新たに実行する
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+
+def request_key(
+    model_name: str, content, system_instruction: Optional[str] = None, response_schema: Optional[str] = None
+) -> str:
+    """モデル名・システム指示・出力スキーマ・送信内容 (テキスト・メディアのパート) から相乗り用のキーを作る"""
+    digest = hashlib.sha256(model_name.encode("utf-8"))
+    digest.update(b"\x03" + (system_instruction or "").encode("utf-8") + b"\x00")
+    digest.update(b"\x04" + (response_schema or "").encode("utf-8") + b"\x00")
+    parts = content if isinstance(content, (list, tuple)) else [content]
+    for part in parts:
+        if isinstance(part, dict):
+            digest.update(b"\x01" + part.get("mime_type", "").encode("utf-8") + b"\x00")
+            digest.update(bytes(part.get("data", b"")))
+        else:
+            digest.update(b"\x02" + str(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_single_flight() -> SingleFlight:
+    """全セッションで共有する相乗りテーブル"""
+    return SingleFlight()